@@ -28,6 +28,10 @@ setup(
     extras_require={
         'testing': [
             'pytest==3.5.0',
+        ],
+        # binary framing for structured messages; negotiated at connect time
+        'msgpack': [
+            'msgpack==0.5.6',
         ]
     },
     include_package_data=True,
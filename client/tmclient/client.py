@@ -1,14 +1,26 @@
 import os, time
 import asyncio
 import json
+from collections import deque
 import websockets
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
 import urwid
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from .config import Config
 from . import ui
 from .ui import Screen, Form, FormField, menu, menu_button, sub_menu
 from .screens import Splash, MainMenu, GameMain
 
+# protocol extensions we ask the server for on connect
+CAPABILITIES = ['state-delta', 'batch']
+if msgpack is not None:
+    CAPABILITIES.append('msgpack')
+
 class Client:
     def __init__(self, loop):
         self.loop = loop
@@ -17,6 +29,10 @@ class Client:
         self.ui = ui.UI(self.loop)
         self.listening = False
         self.authenticated = False
+        self.capabilities = set()
+        # messages unpacked from a BATCH or msgpack frame that haven't been
+        # handled yet
+        self.pending = deque()
         self.ui.base = urwid.Overlay(
             urwid.Filler(urwid.Text('connecting..', align='center')),
             ui.solidfill('░', 'background'),
@@ -40,18 +56,61 @@ class Client:
         self.recv_handler = handler
 
     async def connect(self):
-        self.connection = await websockets.connect(self.login_url)
+        self.connection = await websockets.connect(self.login_url, **self.ws_options())
+        await self.hello()
         time.sleep(0.3) # people love to wait
         self.ui.base = Splash(lambda _:self.show_menu())
 
+    def ws_options(self):
+        """Keyword arguments for websockets.connect that set up compression
+        according to the compression and max_window_bits config keys."""
+        if not self.config.get('compression'):
+            return dict(compression=None)
+        window_bits = self.config.get('max_window_bits')
+        return dict(compression=None, extensions=[ClientPerMessageDeflateFactory(
+            server_max_window_bits=window_bits,
+            client_max_window_bits=window_bits)])
+
+    async def hello(self):
+        capabilities = [c for c in CAPABILITIES
+                        if c != 'msgpack' or self.config.get('msgpack')]
+        await self.connection.send('HELLO {}'.format(
+            json.dumps({'capabilities': capabilities})))
+        response = await self.recv()
+        # servers that predate HELLO answer with an error; they only speak the
+        # original protocol.
+        if response.startswith('HELLO '):
+            self.capabilities = set(json.loads(response[6:])['capabilities'])
+
+    async def recv(self):
+        """Returns the next message from the server, unpacking BATCH and
+        msgpack frames into the messages they hold. Structured messages from
+        msgpack frames come back as (kind, payload) tuples; everything else
+        is text."""
+        if not self.pending:
+            frame = await self.connection.recv()
+            if isinstance(frame, bytes):
+                self.pending.extend(
+                    m if isinstance(m, str) else tuple(m)
+                    for m in msgpack.unpackb(frame, raw=False))
+            elif frame.startswith('BATCH '):
+                self.pending.extend(json.loads(frame[6:]))
+            else:
+                return frame
+        return self.pending.popleft()
+
     async def start_listen_loop(self):
         self.listening = True
-        async for server_msg in self.connection:
+        while True:
+            try:
+                server_msg = await self.recv()
+            except websockets.exceptions.ConnectionClosed:
+                break
             await self.recv_handler(server_msg)
 
     async def authenticate(self, username, password):
         await self.connection.send('LOGIN {}:{}'.format(username, password))
-        response = await self.connection.recv()
+        response = await self.recv()
         if response == 'LOGIN OK':
             self.authenticated = True
             self.ui.base = GameMain(self, self.loop, self.ui.loop, self.config)
@@ -60,7 +119,7 @@ class Client:
 
     async def register(self, username, password):
         await self.connection.send('REGISTER {}:{}'.format(username, password))
-        response = await self.connection.recv()
+        response = await self.recv()
         if response == 'REGISTER OK':
             self.config.set('username', username)
             self.config.set('password', password)
@@ -5,7 +5,12 @@ DEFAULT_CONFIG_PATH = os.path.expanduser('~/.config/tildemush/config.json')
 
 CONFIG_DEFAULTS = {
     'server_host':'localhost',
-    'server_port': 10014}
+    'server_port': 10014,
+    # permessage-deflate; max_window_bits (8-15) trades compression for memory
+    'compression': True,
+    'max_window_bits': 15,
+    # ask for binary msgpack frames if msgpack is installed
+    'msgpack': True}
 
 def ensure_config_file(path):
     if not os.path.exists(os.path.dirname(path)):
@@ -0,0 +1,39 @@
+"""Applies the patches the server sends in STATE-DELTA messages.
+
+A patch is a JSON merge patch (RFC 7386) with one addition: lists of objects
+that all have a shortname (room contents, inventory) are patched item by item.
+Such a list's patch looks like
+
+    {"~keyed": "shortname",
+     "items": {shortname: patch for that item, ...},
+     "order": [shortname, ...]}
+
+where "order" is only present if items were added, removed or reordered.
+
+This mirrors tmserver/delta.py; keep the two in step."""
+
+KEYED = '~keyed'
+
+
+def apply_patch(state, patch):
+    """Returns the result of applying patch to state. state isn't modified."""
+    if not isinstance(patch, dict):
+        return patch
+
+    if KEYED in patch:
+        key = patch[KEYED]
+        current = state if isinstance(state, list) else []
+        current_items = {i[key]: i for i in current}
+        order = patch.get('order', [i[key] for i in current])
+        items = patch['items']
+        return [apply_patch(current_items.get(k, {}), items[k]) if k in items
+                else current_items[k]
+                for k in order]
+
+    result = dict(state) if isinstance(state, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = apply_patch(result.get(k), v)
+    return result
@@ -7,6 +7,7 @@ import urwid
 
 from .config import Config
 from . import ui
+from .delta import apply_patch
 from .ui import Screen, Form, FormField, menu, menu_button, sub_menu, ColorText, ExternalEditor
 
 def quit_client(screen):
@@ -118,6 +119,8 @@ class GameMain(urwid.Frame):
                         "description": "a liminal space. type /look to open your eyes.",
                         "contains":[]}
                     }
+        self.state_version = None
+        self.resyncing = False
         self.scope = []
         self.hotkeys = self.load_hotkeys()
 
@@ -150,14 +153,17 @@ class GameMain(urwid.Frame):
         self.focus_prompt()
 
     async def on_server_message(self, server_msg):
-        if server_msg == 'COMMAND OK':
+        if isinstance(server_msg, tuple):
+            # structured messages from msgpack frames arrive decoded
+            await self.on_payload(*server_msg)
+        elif server_msg == 'COMMAND OK':
             pass
+        elif server_msg.startswith('STATE-DELTA'):
+            await self.on_payload('STATE-DELTA', json.loads(server_msg[12:]))
         elif server_msg.startswith('STATE'):
-            self.update_state(server_msg[6:])
+            await self.on_payload('STATE', json.loads(server_msg[6:]))
         elif server_msg.startswith('OBJECT'):
-            object_state = json.loads(server_msg[7:])
-            if object_state.get('edit'):
-                self.launch_witch(object_state)
+            await self.on_payload('OBJECT', json.loads(server_msg[7:]))
         elif server_msg.startswith('MAP'):
             self.worldmap_tab.update_map(server_msg[4:])
         else:
@@ -165,6 +171,15 @@ class GameMain(urwid.Frame):
 
         self.focus_prompt()
 
+    async def on_payload(self, kind, payload):
+        if kind == 'STATE-DELTA':
+            await self.update_state_delta(payload)
+        elif kind == 'STATE':
+            self.set_game_state(payload)
+        elif kind == 'OBJECT':
+            if payload.get('edit'):
+                self.launch_witch(payload)
+
     def launch_witch(self, data):
         tf = NamedTemporaryFile(delete=False, mode='w')
         tf.write(data["code"])
@@ -268,7 +283,28 @@ class GameMain(urwid.Frame):
         self.header = self.tab_headers
 
     def update_state(self, raw_state):
-        self.game_state = json.loads(raw_state)
+        self.set_game_state(json.loads(raw_state))
+
+    async def update_state_delta(self, state_delta):
+        """Applies a STATE-DELTA. If it patches a version of the state we
+        don't have, asks the server for the whole thing and ignores patches
+        until it arrives."""
+        if state_delta['base'] is None:
+            game_state = apply_patch({}, state_delta['patch'])
+            self.resyncing = False
+        elif self.resyncing:
+            return
+        elif state_delta['base'] == self.state_version:
+            game_state = apply_patch(self.game_state, state_delta['patch'])
+        else:
+            self.resyncing = True
+            await self.client_state.send('RESYNC')
+            return
+        self.state_version = state_delta['version']
+        self.set_game_state(game_state)
+
+    def set_game_state(self, game_state):
+        self.game_state = game_state
         self.update_scope()
         self.game_tab.refresh(self.game_state)
         self.witch_tab.refresh(self.game_state, self.scope)
@@ -0,0 +1,36 @@
+from tmclient.delta import apply_patch
+
+
+class TestApplyPatch():
+
+    state = {
+        'motd': 'welcome to tildemush',
+        'room': {
+            'name': 'foyer',
+            'contains': [
+                {'name': 'a horse', 'shortname': 'vilmibm/horse'},
+                {'name': 'a lamp', 'shortname': 'vilmibm/lamp'}]}}
+
+    def test_replaces_and_removes_keys(self):
+        result = apply_patch(self.state, {'motd': None, 'room': {'name': 'lobby'}})
+        assert 'motd' not in result
+        assert result['room']['name'] == 'lobby'
+        assert result['room']['contains'] == self.state['room']['contains']
+
+    def test_patches_keyed_items(self):
+        result = apply_patch(self.state, {'room': {'contains': {
+            '~keyed': 'shortname',
+            'items': {'vilmibm/lamp': {'name': 'a lit lamp'}}}}})
+        assert [o['name'] for o in result['room']['contains']] == ['a horse', 'a lit lamp']
+
+    def test_reorders_keyed_items(self):
+        result = apply_patch(self.state, {'room': {'contains': {
+            '~keyed': 'shortname',
+            'items': {'vilmibm/rock': {'name': 'a rock', 'shortname': 'vilmibm/rock'}},
+            'order': ['vilmibm/rock', 'vilmibm/horse']}}})
+        assert [o['shortname'] for o in result['room']['contains']] == [
+            'vilmibm/rock', 'vilmibm/horse']
+
+    def test_leaves_state_alone(self):
+        apply_patch(self.state, {'room': {'name': 'lobby'}})
+        assert self.state['room']['name'] == 'foyer'
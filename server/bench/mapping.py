@@ -0,0 +1,101 @@
+"""Times the native grid renderer against the boxgraph (Graph::Easy)
+subprocess on generated worlds of increasing size.
+
+    python bench/mapping.py --sizes 10,100,1000,10000 --boxgraph-max 1000
+
+No database is needed; each world is a random tree of rooms joined by exits
+in the six directions, mapped in full from its first room. "unplaced" counts
+exits the native renderer had to list under the map rather than draw. Graph::Easy gets
+very slow on large graphs, so it's only run up to --boxgraph-max rooms. "walk us"
+is how long a RoomGraph takes to find the rooms within three exits of the first
+one, averaged over --walks runs with the graph already loaded, and "path ms" is
+how long it takes to find the shortest way from the first room to the last
+one without PathCache's help."""
+import random
+import time
+
+import click
+
+from tmserver.constants import DIRECTIONS, REVERSE_DIRS
+from tmserver.containment import ContainmentIndex
+from tmserver.mapping import graph_easy, grid_map, mapfile
+from tmserver.topology import RoomGraph
+
+
+STEPS = {
+    'north': (0, -1, 0), 'south': (0, 1, 0),
+    'east': (1, 0, 0), 'west': (-1, 0, 0),
+    'above': (0, 0, 1), 'below': (0, 0, -1)}
+
+
+def make_world(rooms, seed):
+    """Grows a world one room at a time off of a random existing room, the
+    way builders tend to: rooms sit on a lattice (mostly on one floor) and
+    never overlap."""
+    rng = random.Random(seed)
+    directions = sorted(DIRECTIONS)
+    weights = [1 if d in ('above', 'below') else 6 for d in directions]
+    positions = {(0, 0, 0): 'Room 0'}
+    names = [((0, 0, 0), 'Room 0')]
+    edges = []
+    while len(names) < rooms:
+        (x, y, z), parent = rng.choice(names)
+        direction = rng.choices(directions, weights)[0]
+        dx, dy, dz = STEPS[direction]
+        position = (x + dx, y + dy, z + dz)
+        if position in positions:
+            continue
+        name = 'Room {}'.format(len(names))
+        positions[position] = name
+        names.append((position, name))
+        edges.append((parent, direction, name))
+    return edges
+
+
+def make_graph(edges):
+    """A RoomGraph over edges. Room n gets id n and exits get negative ids so
+    that they don't clash with rooms."""
+    ids = {'Room 0': 0}
+    contains = []
+    routes = []
+    for exit_id, (from_room, direction, to_room) in enumerate(edges, 1):
+        ids[to_room] = len(ids)
+        exit_id = -exit_id
+        contains.extend([(ids[from_room], exit_id), (ids[to_room], exit_id)])
+        routes.extend([
+            (exit_id, ids[from_room], direction, ids[to_room]),
+            (exit_id, ids[to_room], REVERSE_DIRS[direction], ids[from_room])])
+    return RoomGraph(ContainmentIndex(lambda: contains), lambda: routes)
+
+
+def timed(fn, *args):
+    started = time.monotonic()
+    result = fn(*args)
+    return result, time.monotonic() - started
+
+
+@click.command()
+@click.option('--sizes', default='10,100,1000,10000', help='comma separated room counts')
+@click.option('--boxgraph-max', default=1000, help='largest world to give boxgraph')
+@click.option('--seed', default=14, help='random seed for the generated worlds')
+@click.option('--walks', default=1000, help='neighbourhood walks to average')
+def main(sizes, boxgraph_max, seed, walks):
+    print('rooms   native s  unplaced  boxgraph s  walk us  path ms')
+    for rooms in [int(s) for s in sizes.split(',')]:
+        edges = make_world(rooms, seed)
+        graph = make_graph(edges)
+        graph.neighbourhood(0, 3)
+        _, walked = timed(lambda: [graph.neighbourhood(0, 3) for _ in range(walks)])
+        _, pathed = timed(graph.shortest_path, 0, rooms - 1)
+        rendered, native = timed(grid_map, edges, 'Room 0')
+        unplaced = rendered.count('-->')
+        boxgraph = '-'
+        if rooms <= boxgraph_max:
+            _, elapsed = timed(graph_easy, mapfile(edges))
+            boxgraph = '{:.3f}'.format(elapsed)
+        print('{:5d}  {:9.3f}  {:8d}  {:>10s}  {:7.1f}  {:7.1f}'.format(
+            rooms, native, unplaced, boxgraph, walked / walks * 1e6, pathed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
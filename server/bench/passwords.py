@@ -0,0 +1,41 @@
+"""Measures how many logins per second the password pool can verify for a
+range of pool sizes, to help pick TILDEMUSH_PASSWORD_WORKERS.
+
+    python bench/passwords.py --logins 64 --max-workers 8
+
+No database is needed; each simulated login is one bcrypt check."""
+import asyncio
+import os
+import time
+
+import click
+
+from tmserver.passwords import PasswordPool, hash_password
+
+
+async def storm(pool, logins, password_hash):
+    checks = [pool.check_password('foobarbazquux', password_hash)
+              for _ in range(logins)]
+    return await asyncio.gather(*checks)
+
+
+@click.command()
+@click.option('--logins', default=64, help='simultaneous logins per run')
+@click.option('--max-workers', default=os.cpu_count(), help='largest pool to try')
+def main(logins, max_workers):
+    loop = asyncio.get_event_loop()
+    password_hash = hash_password('foobarbazquux')
+    print('workers  seconds  logins/s')
+    for workers in range(1, max_workers + 1):
+        pool = PasswordPool(loop, workers=workers, queue_limit=logins)
+        # start the worker processes before timing anything
+        loop.run_until_complete(storm(pool, workers, password_hash))
+        started = time.monotonic()
+        loop.run_until_complete(storm(pool, logins, password_hash))
+        elapsed = time.monotonic() - started
+        pool.shutdown()
+        print('{:7d}  {:7.2f}  {:8.1f}'.format(workers, elapsed, logins / elapsed))
+
+
+if __name__ == '__main__':
+    main()
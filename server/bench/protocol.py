@@ -0,0 +1,96 @@
+"""Compares frame sizes and encoding cost for the ways a client state can go
+over the wire: JSON text or msgpack, each uncompressed or run through
+permessage-deflate at a range of window sizes.
+
+    python bench/protocol.py --items 200 --updates 500
+
+No database or network is needed; the states are made up, modelled on a
+crowded room, and each update moves one item into the player's inventory.
+Compression keeps its context between frames the way a websocket connection
+does."""
+import copy
+import json
+import time
+import zlib
+
+import click
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def make_state(items):
+    return {
+        'motd': 'welcome to tildemush',
+        'user': {
+            'username': 'vilmibm',
+            'display_name': 'vilmibm',
+            'description': 'a witch'},
+        'room': {
+            'name': 'the foyer',
+            'shortname': 'god/foyer',
+            'description': 'a grand, dusty foyer with a chandelier',
+            'contains': [dict(
+                name='thing {}'.format(i),
+                shortname='vilmibm/thing-{}'.format(i),
+                description='an unremarkable thing, number {}'.format(i))
+                for i in range(items)],
+            'exits': {'north': {'exit_name': 'oak door', 'room_name': 'the hall'}}},
+        'inventory': []}
+
+
+def make_updates(items, updates):
+    state = make_state(items)
+    states = []
+    for _ in range(updates):
+        state = copy.deepcopy(state)
+        if state['room']['contains']:
+            moved = state['room']['contains'].pop()
+            moved['contains'] = []
+            state['inventory'].append(moved)
+        states.append(state)
+    return states
+
+
+def encoders():
+    yield 'json', lambda s: ('STATE ' + json.dumps(s)).encode('utf-8')
+    if msgpack is not None:
+        yield 'msgpack', lambda s: msgpack.packb([['STATE', s]], use_bin_type=True)
+
+
+def run(encode, states, window_bits, level, mem_level):
+    compressor = None
+    if window_bits:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits, mem_level)
+    total = 0
+    started = time.process_time()
+    for state in states:
+        frame = encode(state)
+        if compressor is not None:
+            frame = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(frame)
+    return total, time.process_time() - started
+
+
+@click.command()
+@click.option('--items', default=200, help='objects in the room')
+@click.option('--updates', default=500, help='client states to send')
+@click.option('--level', default=6, help='zlib compression level')
+@click.option('--mem-level', default=5, help='zlib memory level')
+def main(items, updates, level, mem_level):
+    states = make_updates(items, updates)
+    if msgpack is None:
+        print('msgpack is not installed; only measuring json\n')
+    print('encoding  window  KiB/update  ms/update')
+    for name, encode in encoders():
+        for window_bits in (None, 9, 12, 15):
+            total, elapsed = run(encode, states, window_bits, level, mem_level)
+            print('{:8s}  {:>6s}  {:10.2f}  {:9.3f}'.format(
+                name, str(window_bits or 'off'),
+                total / updates / 1024, elapsed / updates * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,10 @@ setup(
         'testing': [
             'pytest==3.5.0',
             'pytest-asyncio==0.8.0'
+        ],
+        # binary framing for structured messages; negotiated at connect time
+        'msgpack': [
+            'msgpack==0.5.6',
         ]
     },
     #include_package_data=True,
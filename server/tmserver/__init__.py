@@ -5,19 +5,33 @@ import click
 from .core import GameServer
 from .logs import get_logger
 from .world import GameWorld
-from .migrations import init_db
+from .migrations import init_db, precompile_scripts
+from .revisions import REVISIONS
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--debug/--no-debug', default=False, help='Log to the console.')
 @click.option('--bind', default='127.0.0.1', help='bind IP')
 @click.option('--port', default=10014, help='server port')
-def _main(debug, bind, port):
+@click.pass_context
+def _main(ctx, debug, bind, port):
+    if ctx.invoked_subcommand is not None:
+        return
     gs = GameServer(GameWorld, logger=get_logger(debug), bind=bind, port=port)
     init_db()
+    REVISIONS.listen()
     gs.start()
 
 
+@_main.command()
+@click.option('--processes', default=None, type=int, help='compiler processes (defaults to cpu count)')
+def precompile(processes):
+    """Compile the WITCH scripts of every object ahead of time."""
+    init_db()
+    compiled, failed = precompile_scripts(processes)
+    print('precompiled {} script revisions ({} failed)'.format(compiled, failed))
+
+
 def main():
     try:
         _main()
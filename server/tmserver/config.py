@@ -1,6 +1,9 @@
 from os import environ
+import threading
+import time
 
-from playhouse.postgres_ext import PostgresqlExtDatabase
+from peewee import _savepoint
+from playhouse.pool import PooledPostgresqlExtDatabase
 
 DB_HOST = environ.get('PGHOST', 'localhost')
 DB_PORT = environ.get('PGPORT', 5432)
@@ -8,25 +11,203 @@ DB_UN = environ.get('PGUSER', 'tildemush')
 DB_PW = environ.get('PGPASSWORD', 'tildemush')
 DB_NAME = environ.get('PGDATABASE', 'tildemush')
 TEST_DB_NAME = DB_NAME + '_test'
+# connection pool settings. max connections is the size of the pool; stale
+# timeout is how many seconds a connection is reused before being recycled;
+# pool timeout is how many seconds to wait for a free connection before giving
+# up.
+DB_MAX_CONNECTIONS = int(environ.get('PGMAXCONNECTIONS', 20))
+DB_STALE_TIMEOUT = int(environ.get('PGSTALETIMEOUT', 300))
+DB_POOL_TIMEOUT = int(environ.get('PGPOOLTIMEOUT', 10))
 
 env = environ.get('TILDEMUSH_ENV', 'live')
 
+# How many distinct compiled WITCH scripts to keep around.
+ENGINE_CACHE_SIZE = int(environ.get('TILDEMUSH_ENGINE_CACHE_SIZE', 1024))
+
+# How many threads run game world code. With one, every command in the game is
+# handled in the order it arrived.
+WORLD_WORKERS = int(environ.get('TILDEMUSH_WORLD_WORKERS', 1))
+
+# Password hashing runs in a pool of this many processes. Once this many more
+# requests are waiting on it, logins and registrations are refused until it
+# catches up.
+PASSWORD_WORKERS = int(environ.get('TILDEMUSH_PASSWORD_WORKERS', 2))
+PASSWORD_QUEUE_LIMIT = int(environ.get('TILDEMUSH_PASSWORD_QUEUE_LIMIT', 64))
+
+# Log records are written to the database in batches of up to LOG_BATCH_SIZE,
+# at least every LOG_FLUSH_INTERVAL seconds. At most LOG_BUFFER_SIZE records
+# wait to be written; past that, new records are dropped.
+LOG_BATCH_SIZE = int(environ.get('TILDEMUSH_LOG_BATCH_SIZE', 100))
+LOG_FLUSH_INTERVAL = float(environ.get('TILDEMUSH_LOG_FLUSH_INTERVAL', 1.0))
+LOG_BUFFER_SIZE = int(environ.get('TILDEMUSH_LOG_BUFFER_SIZE', 10000))
+
+# Client state updates asked for within this many seconds of each other are
+# sent to a client as a single STATE message. 0 sends every update right away.
+STATE_TICK = float(environ.get('TILDEMUSH_STATE_TICK', 0.05))
+
+# Each session queues at most SEND_QUEUE_LIMIT messages for its client. When a
+# client falls that far behind, SEND_QUEUE_POLICY decides what happens:
+# 'drop-chatter' drops things said to it (and disconnects it only if game
+# state itself stops fitting); 'disconnect' disconnects it straight away.
+SEND_QUEUE_LIMIT = int(environ.get('TILDEMUSH_SEND_QUEUE_LIMIT', 256))
+SEND_QUEUE_POLICY = environ.get('TILDEMUSH_SEND_QUEUE_POLICY', 'drop-chatter')
+SEND_QUEUE_POLICIES = ('drop-chatter', 'disconnect')
+
+# permessage-deflate for client connections. WS_MAX_WINDOW_BITS (8-15) sizes
+# the window the server compresses with; smaller windows cost less memory per
+# connection but compress worse. WS_COMPRESSION_LEVEL and WS_MEM_LEVEL are
+# passed on to zlib.
+WS_COMPRESSION = environ.get('TILDEMUSH_WS_COMPRESSION', 'on') == 'on'
+WS_MAX_WINDOW_BITS = int(environ.get('TILDEMUSH_WS_MAX_WINDOW_BITS', 15))
+WS_COMPRESSION_LEVEL = int(environ.get('TILDEMUSH_WS_COMPRESSION_LEVEL', 6))
+WS_MEM_LEVEL = int(environ.get('TILDEMUSH_WS_MEM_LEVEL', 5))
+
+# How MAP requests are drawn: 'native' lays rooms out on a grid in process;
+# 'boxgraph' hands the mapfile to the bundled Graph::Easy script.
+MAP_RENDERER = environ.get('TILDEMUSH_MAP_RENDERER', 'native')
+# How many rendered maps to keep around.
+MAP_CACHE_SIZE = int(environ.get('TILDEMUSH_MAP_CACHE_SIZE', 512))
+# boxgraph runs in at most MAP_WORKERS subprocesses at once, each given
+# MAP_TIMEOUT seconds. Once MAP_QUEUE_LIMIT more requests are waiting, further
+# MAP requests are refused until it catches up.
+MAP_WORKERS = int(environ.get('TILDEMUSH_MAP_WORKERS', 2))
+MAP_TIMEOUT = float(environ.get('TILDEMUSH_MAP_TIMEOUT', 5.0))
+MAP_QUEUE_LIMIT = int(environ.get('TILDEMUSH_MAP_QUEUE_LIMIT', 32))
+
+# How many /path results to keep around.
+PATH_CACHE_SIZE = int(environ.get('TILDEMUSH_PATH_CACHE_SIZE', 1024))
+
+
+class PoolStats:
+    """Counters for how long threads wait to get a connection out of the pool
+    and how long they hold on to it once they have it."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.checkins = 0
+        self.checkout_total = 0.0
+        self.checkout_max = 0.0
+
+    def waited(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def returned(self, seconds):
+        with self._lock:
+            self.checkins += 1
+            self.checkout_total += seconds
+            self.checkout_max = max(self.checkout_max, seconds)
+
+    def as_dict(self):
+        return dict(
+            checkouts=self.checkouts,
+            wait_total=self.wait_total,
+            wait_max=self.wait_max,
+            checkins=self.checkins,
+            checkout_total=self.checkout_total,
+            checkout_max=self.checkout_max)
+
+
+class _UndoingSavepoint(_savepoint):
+    """A savepoint that runs the on_rollback functions registered since it
+    began when it's rolled back to."""
+    def _begin(self):
+        self.mark = len(self.db._undo_log())
+        super()._begin()
+
+    def rollback(self):
+        super().rollback()
+        self.db._undo(self.mark)
+
+
+class MeteredPooledDatabase(PooledPostgresqlExtDatabase):
+    """Also lets in-memory copies of rows (see models.py) be put back when
+    the transaction that changed them is rolled back; see on_rollback."""
+    def __init__(self, *args, **kwargs):
+        self.stats = PoolStats()
+        self._checked_out = {}
+        # when each thread started asking for a connection
+        self._waiting = threading.local()
+        # each thread's on_rollback functions for its open transaction
+        self._undos = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def _undo_log(self):
+        if not hasattr(self._undos, 'log'):
+            self._undos.log = []
+        return self._undos.log
+
+    def on_rollback(self, fn, *args):
+        """Calls fn(*args) if the transaction (or savepoint) we're in is rolled
+        back. Outside of a transaction changes are already committed, so this
+        does nothing."""
+        if self.in_transaction():
+            self._undo_log().append((fn, args))
+
+    def _undo(self, mark=0):
+        log = self._undo_log()
+        for fn, args in reversed(log[mark:]):
+            fn(*args)
+        # anything those registered goes too
+        del log[mark:]
+
+    def savepoint(self):
+        return _UndoingSavepoint(self)
+
+    def commit(self):
+        result = super().commit()
+        self._undo_log().clear()
+        return result
+
+    def rollback(self):
+        result = super().rollback()
+        self._undo()
+        return result
+
+    def connect(self, reuse_if_open=False):
+        # with a timeout the pool calls _connect until one is free and
+        # returns None either way, so the wait is recorded in _connect
+        self._waiting.started = time.monotonic()
+        return super().connect(reuse_if_open)
+
+    def _connect(self, *args, **kwargs):
+        conn = super()._connect(*args, **kwargs)
+        now = time.monotonic()
+        self.stats.waited(now - getattr(self._waiting, 'started', now))
+        self._checked_out[self.conn_key(conn)] = now
+        return conn
+
+    def _close(self, conn, close_conn=False):
+        checked_out = self._checked_out.pop(self.conn_key(conn), None)
+        if checked_out is not None:
+            self.stats.returned(time.monotonic() - checked_out)
+        super()._close(conn, close_conn)
+
+
+_db = None
+
 def get_db():
-    db = None
+    """Returns the process-wide database handle, creating it on first use."""
+    global _db
+    if _db is not None:
+        return _db
 
+    db_name = DB_NAME
     if env == 'test':
-        db = PostgresqlExtDatabase(
-            TEST_DB_NAME,
-            user=DB_UN,
-            password=DB_PW,
-            host=DB_HOST,
-            port=DB_PORT)
-    else:
-        db = PostgresqlExtDatabase(
-            DB_NAME,
-            user=DB_UN,
-            password=DB_PW,
-            host=DB_HOST,
-            port=DB_PORT)
-
-    return db
+        db_name = TEST_DB_NAME
+
+    _db = MeteredPooledDatabase(
+        db_name,
+        max_connections=DB_MAX_CONNECTIONS,
+        stale_timeout=DB_STALE_TIMEOUT,
+        timeout=DB_POOL_TIMEOUT,
+        user=DB_UN,
+        password=DB_PW,
+        host=DB_HOST,
+        port=DB_PORT)
+
+    return _db
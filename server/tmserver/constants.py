@@ -1,4 +1,6 @@
 DIRECTIONS = {'north', 'south', 'west', 'east', 'above', 'below'}
+# for when exits need to be looked at in a stable order
+DIRECTION_ORDER = ['north', 'east', 'south', 'west', 'above', 'below']
 REVERSE_DIRS = {
     'north': 'south',
     'south': 'north',
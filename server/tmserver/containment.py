@@ -0,0 +1,101 @@
+import threading
+
+
+class ContainmentIndex:
+    """An in-memory copy of the Contains table, indexed in both directions
+    (outer id -> inner ids and inner id -> outer ids) so that the containment
+    checks every command makes are dictionary lookups rather than queries.
+
+    The Contains table stays the durable copy. The index is loaded from it in
+    one query the first time it's used and is kept up to date as Contains rows
+    are created and removed (see Contains in models.py). Ids are kept in the
+    order their rows were created.
+
+    Functions in `listeners` are called with an outer id whenever what that
+    object contains changes, or with None when it could be anything."""
+    def __init__(self, loader):
+        # loader returns an iterable of (outer_id, inner_id) pairs
+        self.loader = loader
+        self.listeners = []
+        self._lock = threading.RLock()
+        self.clear()
+
+    def _changed(self, outer_id):
+        for fn in self.listeners:
+            fn(outer_id)
+
+    def clear(self):
+        """Forgets everything; the index is reloaded on next use."""
+        with self._lock:
+            self.inners = {}
+            self.outers = {}
+            self.loaded = False
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            for outer_id, inner_id in self.loader():
+                self._add(outer_id, inner_id)
+            self.loaded = True
+
+    def _add(self, outer_id, inner_id):
+        self.inners.setdefault(outer_id, {})[inner_id] = None
+        self.outers.setdefault(inner_id, {})[outer_id] = None
+
+    def _remove(self, outer_id, inner_id):
+        self.inners.get(outer_id, {}).pop(inner_id, None)
+        self.outers.get(inner_id, {}).pop(outer_id, None)
+
+    def add(self, outer_id, inner_id):
+        with self._lock:
+            if self.loaded:
+                self._add(outer_id, inner_id)
+        self._changed(outer_id)
+
+    def remove(self, outer_id, inner_id):
+        with self._lock:
+            if self.loaded:
+                self._remove(outer_id, inner_id)
+        self._changed(outer_id)
+
+    def remove_inner(self, inner_id):
+        """Takes inner_id out of everything that contains it."""
+        with self._lock:
+            if not self.loaded:
+                self._changed(None)
+                return
+            outer_ids = list(self.outers.get(inner_id, {}))
+            for outer_id in outer_ids:
+                self._remove(outer_id, inner_id)
+        for outer_id in outer_ids:
+            self._changed(outer_id)
+
+    def forget(self, obj_id):
+        """Drops every edge touching obj_id, for when it's deleted."""
+        self.remove_inner(obj_id)
+        with self._lock:
+            if self.loaded:
+                for inner_id in list(self.inners.get(obj_id, {})):
+                    self._remove(obj_id, inner_id)
+        self._changed(obj_id)
+
+    def inners_of(self, outer_id):
+        self._ensure_loaded()
+        with self._lock:
+            return list(self.inners.get(outer_id, {}))
+
+    def outers_of(self, inner_id):
+        self._ensure_loaded()
+        with self._lock:
+            return list(self.outers.get(inner_id, {}))
+
+    def all_ids(self):
+        """Returns the ids of every object that contains or is contained by
+        something."""
+        self._ensure_loaded()
+        with self._lock:
+            return {i for i, s in self.inners.items() if s} \
+                 | {i for i, s in self.outers.items() if s}
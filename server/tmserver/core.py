@@ -1,36 +1,222 @@
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
 import json
 import re
 
+from peewee import IntegrityError
 import websockets as ws
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
+from . import config
+from . import delta
 from .errors import ClientError, UserValidationError, RevisionError, ClientQuit, UserError
+from .mapping import MapJob, MapRenderPool
 from .models import UserAccount
+from .passwords import PasswordPool
+from .unit_of_work import unit_of_work
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 LOGIN_RE = re.compile(r'^LOGIN ([^:\n]+?):(.+)$')
 REGISTER_RE = re.compile(r'^REGISTER ([^:\n]+?):(.+)$')
 COMMAND_RE = re.compile(r'^COMMAND ([^ ]+) ?(.*)$')
 REVISION_RE = re.compile(r'^REVISION (.+)$')
+HELLO_RE = re.compile(r'^HELLO (.+)$')
 # TODO ensure that object shortnames are ending up in the client state so they
 # can be sent in REVISION messages
 REVISION_KEYS = ('shortname', 'code', 'current_rev')
+# protocol extensions a client can ask for with HELLO. Clients that never say
+# HELLO get the original protocol.
+CAPABILITIES = {'state-delta', 'batch'}
+if msgpack is not None:
+    CAPABILITIES.add('msgpack')
 
 LOOP = asyncio.get_event_loop()
 
 
 # TODO auth_required login for checking associated user_sessions
 
+class WorldRunner:
+    """Game world code is synchronous and talks to the database; this runs
+    it on a dedicated executor so that the event loop stays free for socket
+    I/O.
+
+    With a single worker (the default), world calls run one at a time in the
+    order they were submitted. With more workers, only calls made on behalf of
+    a single session are ordered (a session waits on each of its messages
+    before reading the next one) and world code must be safe to run
+    concurrently."""
+    def __init__(self, loop, workers=None):
+        if workers is None:
+            workers = config.WORLD_WORKERS
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='tmworld')
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    async def run(self, fn, *args):
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            return await self.loop.run_in_executor(
+                self.executor, functools.partial(self._call, fn, *args))
+        finally:
+            self.queue_depth -= 1
+
+    def _call(self, fn, *args):
+        # each call checks a connection out of the pool and hands it back
+        # when it's done, rather than its worker thread holding one forever
+        db = config.get_db()
+        # the pool ignores reuse_if_open, so look before connecting
+        opened = db.is_closed()
+        if opened:
+            db.connect()
+        try:
+            return fn(*args)
+        finally:
+            if opened:
+                db.close()
+
+
+class ClientStateScheduler:
+    """Coalesces client state updates. Game world code asks for a session's
+    STATE to be sent far more often than it needs to be (a single move can ask
+    several times for each player in two rooms); rather than building and
+    sending a payload each time, requests mark the session dirty and, `tick`
+    seconds after the first request, one STATE goes to each dirty session.
+
+    With a tick of 0 every request is sent right away.
+
+    `requested` and `sent` count update requests and STATE messages built.
+    A session whose state can't be built or sent is logged and skipped; the
+    rest of the tick still goes out."""
+    def __init__(self, loop, world_runner, tick=None, logger=None):
+        if tick is None:
+            tick = config.STATE_TICK
+        if logger is None:
+            logger = logging.getLogger('tmserver')
+        self.loop = loop
+        self.logger = logger
+        self.world_runner = world_runner
+        self.tick = tick
+        self.requested = 0
+        self.sent = 0
+        self._dirty = set()
+        self._flush_handle = None
+
+    def request(self, session):
+        """Safe to call from game world code running off of the event
+        loop."""
+        if self.tick <= 0:
+            self.requested += 1
+            self.sent += 1
+            session.handle_client_update(
+                session.game_world.client_state(session.user_account))
+            return
+        self.loop.call_soon_threadsafe(self._mark, session)
+
+    def _mark(self, session):
+        self.requested += 1
+        self._dirty.add(session)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.tick, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        sessions, self._dirty = self._dirty, set()
+        asyncio.ensure_future(self._send(sessions), loop=self.loop)
+
+    async def _send(self, sessions):
+        try:
+            states = await self.world_runner.run(self._client_states, sessions)
+        except Exception as e:
+            self.logger.error('failed to build client states: {}'.format(e))
+            return
+        for session, client_state in states:
+            try:
+                session.handle_client_update(client_state)
+            except Exception as e:
+                self.logger.error('failed to send client state to {}: {}'.format(
+                    session, e))
+        self.sent += len(states)
+
+    def _client_states(self, sessions):
+        states = []
+        # players in the same room share the room part of their states
+        rooms = {}
+        with unit_of_work():
+            for session in sessions:
+                # they may have logged out since asking
+                if not session.associated:
+                    continue
+                try:
+                    if session.game_world.get_session(session.user_account.id) is not session:
+                        continue
+                except ClientError:
+                    continue
+                try:
+                    client_state = session.game_world.client_state(
+                        session.user_account, rooms)
+                except Exception as e:
+                    self.logger.error('failed to build client state for {}: {}'.format(
+                        session, e))
+                    continue
+                states.append((session, client_state))
+        return states
+
+
 class UserSession:
-    """An instance of this class represents a user's session."""
-    def __init__(self, loop, game_world, websocket, logger=None):
+    """An instance of this class represents a user's session.
+
+    Everything sent to the client goes through a bounded queue, the outbox,
+    which a single writer task drains. A client that asked for the batch
+    capability gets whatever has piled up in the outbox as one BATCH frame
+    holding a JSON list of messages.
+
+    Messages are either text or, for structured ones like STATE, a (kind,
+    payload) pair that's only encoded when it's written: as "KIND <json>" text
+    by default, or as part of a binary msgpack frame for clients that asked
+    for msgpack. A msgpack frame is always a list whose items are text
+    messages or [kind, payload] lists."""
+    def __init__(self, loop, game_world, websocket, logger=None, state_scheduler=None,
+                 queue_limit=None, queue_policy=None):
         if logger is None:
             logger = logging.getLogger('tmserver')
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        if queue_limit is None:
+            queue_limit = config.SEND_QUEUE_LIMIT
+        if queue_policy is None:
+            queue_policy = config.SEND_QUEUE_POLICY
+        if queue_policy not in config.SEND_QUEUE_POLICIES:
+            raise ValueError('unknown send queue policy: {}'.format(queue_policy))
         self.logger = logger
         self.loop = loop
         self.websocket = websocket
         self.game_world = game_world
+        self.state_scheduler = state_scheduler
         self.user_account = None
+        self.capabilities = set()
+        self._held = None
+        self.queue_limit = queue_limit
+        self.queue_policy = queue_policy
+        # pairs of (message, is_chatter)
+        self.outbox = deque()
+        self.max_queue_depth = 0
+        self.dropped = 0
+        self.frames = 0
+        self.closing = False
+        self._writer = None
+        # the last client state sent to a state-delta client and its version
+        self._last_state = None
+        self.state_version = 0
 
     @property
     def associated(self):
@@ -45,22 +231,144 @@ class UserSession:
         # we will need to support basic abuse control like blocking other
         # users, so having a sender_obj here might be useful for interaction
         # filtering. rn it's unused though.
-        asyncio.ensure_future(
-            self.client_send(message),
-            loop=self.loop)
+        self.send(message, chatter=True)
+
+    def request_client_update(self):
+        """Asks for this session's client state to be sent. With a
+        scheduler, requests made close together result in a single STATE."""
+        if self.state_scheduler is None:
+            self.handle_client_update(
+                self.game_world.client_state(self.user_account))
+        else:
+            self.state_scheduler.request(self)
+
+    def negotiate(self, requested):
+        """Turns on whichever of the requested capabilities the server
+        supports and returns them."""
+        self.capabilities = set(requested) & CAPABILITIES
+        return self.capabilities
 
     def handle_client_update(self, client_state):
         self.logger.info('sending client_update to {}'.format(self.user_account.username))
-        asyncio.ensure_future(
-            self.client_send('STATE {}'.format(json.dumps(client_state))),
-            loop=self.loop)
+        if 'state-delta' not in self.capabilities:
+            self.send(('STATE', client_state))
+            return
+
+        # Messages reach the client in the order they're sent, so by the time
+        # it gets this patch it has applied the one that produced
+        # _last_state. A client that finds itself out of step anyway says
+        # RESYNC and gets a whole state (base null) next.
+        base = None
+        patch = client_state
+        if self._last_state is not None:
+            base = self.state_version
+            patch = delta.diff(self._last_state, client_state)
+            if patch is None:
+                return
+        self.state_version += 1
+        self._last_state = client_state
+        self.send(('STATE-DELTA', dict(
+            version=self.state_version, base=base, patch=patch)))
+
+    def resync(self):
+        """Sends the whole client state again, for a state-delta client that
+        has lost track of it."""
+        self._last_state = None
+        self.request_client_update()
 
     def send_object_state(self, object_state):
-        asyncio.ensure_future(
-            self.client_send('OBJECT {}'.format(json.dumps(object_state))),
-            loop=self.loop)
+        self.send(('OBJECT', object_state))
+
+    def send(self, message, chatter=False):
+        """Schedules message to be sent to the client. This is safe to call
+        from game world code running off of the event loop. chatter is for
+        things said to the user, which are dropped first when the client
+        falls behind."""
+        self.loop.call_soon_threadsafe(self._deliver, message, chatter)
+
+    def _deliver(self, message, chatter=False):
+        if self._held is not None:
+            self._held.append((message, chatter))
+            return
+        self._enqueue(message, chatter)
+
+    def reply(self, message):
+        """Queues a reply to the message being handled. Unlike send(), this
+        must be called on the event loop and isn't held back."""
+        self._enqueue(message, False)
+
+    @property
+    def queue_depth(self):
+        return len(self.outbox)
+
+    def _enqueue(self, message, chatter):
+        if self.closing:
+            return
+        if message[0] == 'STATE':
+            # a full client state makes any older one still waiting moot
+            stale = [m for m in self.outbox if m[0][0] == 'STATE']
+            for m in stale:
+                self.outbox.remove(m)
+        if len(self.outbox) >= self.queue_limit:
+            if chatter and self.queue_policy == 'drop-chatter':
+                self.dropped += 1
+                return
+            self.logger.warning('send queue full for {}, disconnecting'.format(self))
+            self.close()
+            return
+        self.outbox.append((message, chatter))
+        self.max_queue_depth = max(self.max_queue_depth, len(self.outbox))
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write(), loop=self.loop)
+
+    async def _write(self):
+        try:
+            while self.outbox:
+                if 'batch' in self.capabilities:
+                    messages = [m for m, _ in self.outbox]
+                    self.outbox.clear()
+                else:
+                    messages = [self.outbox.popleft()[0]]
+                self.frames += 1
+                await self.client_send(self.encode(messages))
+        except ws.exceptions.ConnectionClosed:
+            self.outbox.clear()
+        finally:
+            self._writer = None
+
+    def encode(self, messages):
+        """Returns the frame to send for a list of messages."""
+        if 'msgpack' in self.capabilities:
+            return msgpack.packb(
+                [m if isinstance(m, str) else list(m) for m in messages],
+                use_bin_type=True)
+        texts = [m if isinstance(m, str) else '{} {}'.format(m[0], json.dumps(m[1]))
+                 for m in messages]
+        if len(texts) == 1:
+            return texts[0]
+        return 'BATCH {}'.format(json.dumps(texts))
+
+    def close(self):
+        """Drops anything waiting to be sent and closes the connection."""
+        self.closing = True
+        self.outbox.clear()
+        asyncio.ensure_future(self.websocket.close(), loop=self.loop)
+
+    def hold(self):
+        """Until release() is called, messages passed to send() are kept
+        back. GameServer holds a session while it handles one of the
+        session's messages so that its reply (like COMMAND OK) goes out before
+        anything the message caused."""
+        self._held = []
+
+    def release(self):
+        held, self._held = self._held, None
+        for message, chatter in held or []:
+            self._enqueue(message, chatter)
 
     async def client_send(self, message):
+        """Writes a frame to the websocket. Only the outbox's writer should
+        call this; everything else goes through send() or reply()."""
         await self.websocket.send(message)
 
     def dispatch_action(self, action, action_args):
@@ -85,7 +393,7 @@ class UserSession:
         return return_payload, revision_exception
 
     def handle_map(self):
-        return self.game_world.render_map(self.user_account.player_obj)
+        return self.game_world.handle_map(self.user_account.player_obj)
 
     def handle_disconnect(self):
         if not self.associated:
@@ -117,7 +425,8 @@ class ConnectionMap:
 
 
 class GameServer:
-    def __init__(self, game_world, loop=LOOP, bind='127.0.0.1', port=10014, logger=None):
+    def __init__(self, game_world, loop=LOOP, bind='127.0.0.1', port=10014, logger=None,
+                 state_tick=None):
         self.loop = loop
         self.game_world = game_world
         if logger is None:
@@ -126,71 +435,101 @@ class GameServer:
         self.bind = bind
         self.port = port
         self.connections = ConnectionMap()
+        self.world_runner = WorldRunner(loop)
+        self.passwords = PasswordPool(loop)
+        self.map_renderer = MapRenderPool(loop)
+        self.state_scheduler = ClientStateScheduler(
+            loop, self.world_runner, state_tick, logger=self.logger)
 
     async def handle_connection(self, websocket, path):
         self.logger.info('Handling initial connection at path {}'.format(path))
-        user_session = UserSession(self.loop, self.game_world, websocket)
+        user_session = UserSession(
+            self.loop, self.game_world, websocket, state_scheduler=self.state_scheduler)
         self.logger.info('Registering user context {}'.format(user_session))
         self.connections.add(websocket, user_session)
         try:
             async for message in websocket:
                 await self.handle_message(user_session, message)
         except (ws.exceptions.ConnectionClosed, ClientQuit):
-            self.logger.info('Client disconnect {}'.format(user_session))
-            user_session.handle_disconnect()
-            self.connections.remove(websocket)
+            pass
+        # the loop also ends quietly when the connection is closed cleanly,
+        # for instance by a session whose send queue overflowed
+        self.logger.info('Client disconnect {}'.format(user_session))
+        await self.world_runner.run(user_session.handle_disconnect)
+        self.connections.remove(websocket)
 
     async def handle_message(self, user_session, message):
         self.logger.info("Handling message '{}' for {}".format(
             message, user_session))
+        user_session.hold()
+        try:
+            await self._handle_message(user_session, message)
+        finally:
+            user_session.release()
+
+    async def _handle_message(self, user_session, message):
+        run = self.world_runner.run
         try:
             if message.startswith('LOGIN'):
-                self.handle_login(user_session, message)
+                await self.handle_login(user_session, message)
                 self.logger.info('telling {} about having logged them in'.format(
                     user_session.user_account.username))
-                await user_session.client_send('LOGIN OK')
+                user_session.reply('LOGIN OK')
             elif message.startswith('REGISTER'):
                 try:
-                    self.handle_registration(user_session, message)
-                    await user_session.client_send('REGISTER OK')
+                    await self.handle_registration(user_session, message)
+                    user_session.reply('REGISTER OK')
                 except UserValidationError as e:
-                    await user_session.client_send('ERROR: {}'.format(e))
+                    user_session.reply('ERROR: {}'.format(e))
             elif message.startswith('COMMAND'):
                 try:
-                    self.handle_command(user_session, message)
+                    await run(self.handle_command, user_session, message)
                 except UserError as e:
-                    await user_session.client_send('{{red}}{}{{/}}'.format(e))
+                    user_session.reply('{{red}}{}{{/}}'.format(e))
                 else:
                     # TODO consider switching this to COMMAND ACK and sending
                     # as soon as we get the command. This is really only useful
                     # in that it tells the client "yes, i saw you; if you don't
                     # get a response it's not because i didn't see you."
-                    await user_session.client_send('COMMAND OK')
+                    user_session.reply('COMMAND OK')
             elif message.startswith('REVISION'):
-                revision_result, revision_exception = self.handle_revision(user_session, message)
+                revision_result, revision_exception = await run(self.handle_revision, user_session, message)
                 if revision_exception:
                     # TODO consider something more specific than ERROR
-                    await user_session.client_send('ERROR: {}'.format(revision_exception))
+                    user_session.reply('ERROR: {}'.format(revision_exception))
                 user_session.send_object_state(revision_result)
             elif message.startswith('MAP'):
                 # For now, we return a map of the room a user is currently in +
                 # what they can reach in 2 hops. In the future this message
                 # could include a room to arbitrarily map from (ie as a user
                 # scrolls the map client side).
-                rendered_map = self.handle_map(user_session)
-                await user_session.client_send('MAP\n{}'.format(rendered_map))
+                rendered_map = await run(self.handle_map, user_session)
+                if isinstance(rendered_map, MapJob):
+                    # boxgraph runs in a subprocess so the game carries on
+                    # while it draws
+                    rendered_map = rendered_map.done(
+                        await self.map_renderer.render(rendered_map.mapfile))
+                user_session.reply('MAP\n{}'.format(rendered_map))
             elif message.startswith('QUIT'):
                 self.logger.info('Client quit {}'.format(user_session))
                 raise ClientQuit()
             elif message.startswith('PING'):
-                await user_session.client_send('PONG')
+                user_session.reply('PONG')
+            elif message.startswith('HELLO'):
+                capabilities = user_session.negotiate(self.parse_hello(message))
+                user_session.reply('HELLO {}'.format(
+                    json.dumps(dict(capabilities=sorted(capabilities)))))
+            elif message.startswith('RESYNC'):
+                if not user_session.associated:
+                    raise ClientError('not logged in')
+                await run(user_session.resync)
             else:
                 # TODO clients should format said things (ie things a user
                 # types not prefixed with a / command) with "COMMAND SAY"
-                #await user_session.client_send('you said {}'.format(message))
+                #user_session.reply('you said {}'.format(message))
                 raise ClientError('message not understood')
         except ClientError as e:
-            await user_session.client_send('ERROR: {}'.format(e))
+            user_session.reply('ERROR: {}'.format(e))
 
     def handle_command(self, user_session, message):
         if not user_session.associated:
@@ -204,17 +543,17 @@ class GameServer:
             raise ClientError('malformed command message: {}'.format(message))
         return match.groups()
 
-    def handle_login(self, user_session, message):
+    async def handle_login(self, user_session, message):
         if user_session.associated:
             raise ClientError('log out first')
         username, password = self.parse_login(message)
-        user_accounts = UserAccount.select().where(UserAccount.username==username)
-        if len(user_accounts) == 0:
+        user_account = await self.world_runner.run(
+            UserAccount.get_or_none, UserAccount.username==username)
+        if user_account is None:
             raise ClientError('no such user')
-        user_account = user_accounts[0]
-        if user_account.check_password(password):
+        if await self.passwords.check_password(password, user_account.password):
             self.logger.info('logging in user {}'.format(user_account.username))
-            user_session.associate(user_account)
+            await self.world_runner.run(user_session.associate, user_account)
         else:
             raise ClientError('bad password')
 
@@ -224,13 +563,23 @@ class GameServer:
             raise ClientError('malformed login message: {}'.format(message))
         return match.groups()
 
-    def handle_registration(self, user_session, message):
+    async def handle_registration(self, user_session, message):
         if user_session.associated:
             raise ClientError('log out first')
         username, password = self.parse_registration(message)
         u = UserAccount(username=username, password=password)
-        u.validate()
-        u.save()
+        await self.world_runner.run(u.validate)
+        u.set_password_hash(await self.passwords.hash_password(password))
+        await self.world_runner.run(self._save_account, u)
+
+    def _save_account(self, user_account):
+        # validate ran before the (slow) password hash, so someone else may
+        # have taken the username since
+        try:
+            with config.get_db().atomic():
+                user_account.save()
+        except IntegrityError:
+            raise UserValidationError('username taken: {}'.format(user_account.username))
 
     def parse_registration(self, message):
         """Given a registration message like REGISTER vilmibm:abc123, parse and
@@ -265,6 +614,22 @@ class GameServer:
 
         return payload
 
+    def parse_hello(self, message):
+        """Given a message like HELLO {"capabilities": ["state-delta"]},
+        returns the list of capabilities the client asked for."""
+        match = HELLO_RE.fullmatch(message)
+        if match is None:
+            raise ClientError('malformed hello message: {}'.format(message))
+        try:
+            payload = json.loads(match.groups()[0])
+            capabilities = payload['capabilities']
+        except Exception as e:
+            raise ClientError('failed to parse hello payload: {}'.format(match.groups()[0]))
+        if not isinstance(capabilities, list) \
+           or not all(isinstance(c, str) for c in capabilities):
+            raise ClientError('capabilities should be a list of strings')
+        return capabilities
+
     def handle_map(self, user_session):
         if not user_session.associated:
             raise ClientError('not logged in')
@@ -275,9 +640,22 @@ class GameServer:
         self.logger.info('Starting up asyncio loop')
         # I'm cargo culting these asyncio calls from the websockets
         # documentation
-        self.loop.run_until_complete(
-            ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop))
+        self.loop.run_until_complete(self._get_ws_server())
         self.loop.run_forever()
 
     def _get_ws_server(self):
-        return ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop)
+        return ws.serve(self.handle_connection, self.bind, self.port, loop=self.loop,
+                        **self.ws_options())
+
+    def ws_options(self):
+        """Keyword arguments for websockets.serve that set up compression
+        as configured."""
+        if not config.WS_COMPRESSION:
+            return dict(compression=None)
+        # only the server's own window is set; requiring a client window size
+        # would turn away clients that don't offer one.
+        return dict(compression=None, extensions=[ServerPerMessageDeflateFactory(
+            server_max_window_bits=config.WS_MAX_WINDOW_BITS,
+            compress_settings=dict(
+                level=config.WS_COMPRESSION_LEVEL,
+                memLevel=config.WS_MEM_LEVEL))])
@@ -0,0 +1,92 @@
+"""Patches between two client states, for STATE-DELTA.
+
+A patch is a JSON merge patch (RFC 7386) with one addition: lists of objects
+that all have a shortname (room contents, inventory) are diffed item by item
+instead of being resent whole. Such a list's patch looks like
+
+    {"~keyed": "shortname",
+     "items": {shortname: patch for that item, ...},
+     "order": [shortname, ...]}
+
+where "order" is only present if items were added, removed or reordered. As
+in any merge patch, a null value removes its key, so states shouldn't rely on
+keys whose value is null.
+
+tmclient has its own copy of apply_patch; keep the two in step."""
+
+KEYED = '~keyed'
+KEY = 'shortname'
+
+_UNCHANGED = object()
+
+
+def _is_keyed(value):
+    return isinstance(value, list) \
+        and all(isinstance(i, dict) and KEY in i for i in value)
+
+
+def _diff(old, new):
+    if old == new:
+        return _UNCHANGED
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = {k: None for k in old if k not in new}
+        for k, v in new.items():
+            if k not in old:
+                patch[k] = v
+                continue
+            sub = _diff(old[k], v)
+            if sub is not _UNCHANGED:
+                patch[k] = sub
+        return patch
+
+    if _is_keyed(old) and _is_keyed(new):
+        old_items = {i[KEY]: i for i in old}
+        items = {}
+        for i in new:
+            if i[KEY] not in old_items:
+                items[i[KEY]] = i
+                continue
+            sub = _diff(old_items[i[KEY]], i)
+            if sub is not _UNCHANGED:
+                items[i[KEY]] = sub
+        patch = {KEYED: KEY, 'items': items}
+        order = [i[KEY] for i in new]
+        if order != [i[KEY] for i in old]:
+            patch['order'] = order
+        return patch
+
+    return new
+
+
+def diff(old, new):
+    """Returns a patch that turns the state old into the state new, or None if
+    they're the same."""
+    patch = _diff(old, new)
+    if patch is _UNCHANGED:
+        return None
+    return patch
+
+
+def apply_patch(state, patch):
+    """Returns the result of applying patch to state. state isn't modified."""
+    if not isinstance(patch, dict):
+        return patch
+
+    if KEYED in patch:
+        key = patch[KEYED]
+        current = state if isinstance(state, list) else []
+        current_items = {i[key]: i for i in current}
+        order = patch.get('order', [i[key] for i in current])
+        items = patch['items']
+        return [apply_patch(current_items.get(k, {}), items[k]) if k in items
+                else current_items[k]
+                for k in order]
+
+    result = dict(state) if isinstance(state, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = apply_patch(result.get(k), v)
+    return result
@@ -20,5 +20,6 @@ class UserError(Exception):
 
 class ClientQuit(Exception): pass
 class WitchError(Exception): pass
+class MigrationError(Exception): pass
 class UserValidationError(Exception):
     code = 8
@@ -0,0 +1,64 @@
+class IdentityMap:
+    """Keeps exactly one live python object per database row. peewee hands
+    back a brand new model instance for every query; anything we hang off of
+    an instance (like a compiled WITCH engine) is lost the moment the row is
+    fetched again. Running query results through canonical() means the same
+    row always yields the same object.
+
+    Objects are indexed by id and by shortname."""
+    def __init__(self):
+        self.by_id = {}
+        self.by_shortname = {}
+
+    def clear(self):
+        self.by_id = {}
+        self.by_shortname = {}
+
+    def get(self, obj_id):
+        return self.by_id.get(obj_id)
+
+    def get_by_shortname(self, shortname):
+        return self.by_shortname.get(shortname)
+
+    def add(self, obj):
+        self.by_id[obj.id] = obj
+        self.by_shortname[obj.shortname] = obj
+        return obj
+
+    def remove(self, obj):
+        if self.by_id.get(obj.id) is obj:
+            del self.by_id[obj.id]
+        if self.by_shortname.get(obj.shortname) is obj:
+            del self.by_shortname[obj.shortname]
+
+    def canonical(self, obj):
+        """Given a freshly loaded instance, returns the live instance for its
+        row. If we already had one, it's refreshed with the newly loaded column
+        values (so callers still see what's in the DB) and returned instead."""
+        if obj is None:
+            return None
+
+        existing = self.by_id.get(obj.id)
+        if existing is None:
+            return self.add(obj)
+
+        if existing is obj:
+            return existing
+
+        if existing.shortname != obj.shortname:
+            self.remove(existing)
+
+        for k, v in obj.__data__.items():
+            # a foreign key pointing somewhere new means the cached related
+            # instance is stale.
+            if k in existing.__rel__ and existing.__data__.get(k) != v:
+                del existing.__rel__[k]
+            existing.__data__[k] = v
+
+        return self.add(existing)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
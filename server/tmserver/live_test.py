@@ -27,8 +27,7 @@ def setup_horse():
                     "name" "snoozy"
                     "description" "a horse"})
               (hears "pet"
-                (set-data "num-pets" (+ 1 (get-data "num-pets")))
-                  (if (= 0 (% (get-data "num-pets") 5))
+                (if (= 0 (% (incr-data "num-pets") 5))
                     (says "neigh neigh neigh i am horse"))))''')
     snoozy = GameObject.create(
         author=vil,
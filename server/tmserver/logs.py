@@ -1,22 +1,91 @@
+from datetime import datetime
 import os
 import logging
+import queue
+import threading
 
+from . import config
 from .models import Log
 
 class PGHandler(logging.Handler):
-    def __init__(self, level=logging.NOTSET):
+    """Writes log records to the Log table. emit() only queues a record; a
+    background thread writes queued records with one multi-row INSERT once
+    batch_size of them are waiting or every flush_interval seconds, whichever
+    comes first.
+
+    The queue holds at most buffer_size records. Records that arrive when it's
+    full are counted in `dropped` and discarded. Messages are cut to fit the
+    raw column. If a batch's INSERT fails its rows are retried one at a time,
+    so only the rows that still fail are lost; they're counted in `failed`."""
+    def __init__(self, level=logging.NOTSET, batch_size=None, flush_interval=None,
+                 buffer_size=None):
         super().__init__(level)
         self.env = os.environ.get('TILDEMUSH_ENV', 'live')
+        self.batch_size = batch_size or config.LOG_BATCH_SIZE
+        self.flush_interval = flush_interval or config.LOG_FLUSH_INTERVAL
+        self.buffer = queue.Queue(buffer_size or config.LOG_BUFFER_SIZE)
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._flusher = threading.Thread(
+            target=self._run, name='tmlog', daemon=True)
+        self._flusher.start()
 
     def emit(self, record):
-        # TODO there may end up being a bit of a skew between when a call to
-        # log is issued and when the created_at is set for a Log record. For
-        # the sake of expediency i'm ok with that, but if it ends up being an
-        # issue this should parse and use record.created
-        Log.create(
+        row = dict(
             env=self.env,
-            raw=record.getMessage(),
-            level=record.levelname)
+            raw=record.getMessage()[:Log.raw.max_length],
+            level=record.levelname,
+            created_at=datetime.utcfromtimestamp(record.created))
+        try:
+            self.buffer.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.buffer.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Writes everything queued so far."""
+        with self._flush_lock:
+            rows = []
+            while True:
+                try:
+                    rows.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                try:
+                    Log.insert_many(batch).execute()
+                    self.written += len(batch)
+                except Exception:
+                    self._insert_each(batch)
+
+    def _insert_each(self, rows):
+        for row in rows:
+            try:
+                Log.insert(row).execute()
+                self.written += 1
+            except Exception:
+                # logging about failing to log would just end up back here.
+                self.failed += 1
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+        super().close()
 
 
 def get_logger(debug=False):
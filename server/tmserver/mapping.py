@@ -1,7 +1,8 @@
 # There are three phases to mapping:
 # 1. walking rooms
 # 2. generating the mapfile
-# 3. calling out to Graph::Easy and passing the mapfile
+# 3. rendering it, either in process with grid_map (the default) or by calling
+#    out to Graph::Easy and passing the mapfile (see MAP_RENDERER in config)
 #
 # a mapfile looks like this:
 #
@@ -12,73 +13,469 @@
 # connected to the east to room B, we only map the eastern connection: not the
 # corresponding western direction.
 #
-# TODO This code is pretty slow right now and should have plenty of room for
-# optimization
+# Walking uses ROOM_GRAPH (see topology.py), so it doesn't touch the database
+# for rooms that have been seen before.
+import asyncio
 from os import path
 import subprocess
 import sys
+import threading
 
-from collections import OrderedDict
-from .constants import DIRECTIONS
-from .models import GameObject
+from collections import OrderedDict, deque
+from . import config
+from .constants import DIRECTION_ORDER
+from .errors import ClientError
+from .models import GameObject, ROOM_GRAPH
+from .scripting import DATA_LISTENERS
 
-def render_map(world, room, distance=2):
-    mapfile = from_room(world, room, distance)
-    return graph_easy(mapfile)
+# where a room lands on the grid relative to the room it's reached from, in
+# order of preference. There's no third dimension to draw, so above and below
+# borrow whichever side is free, like Graph::Easy does (see grid_layout).
+GRID_STEPS = {
+    'north': [(0, -1), (1, 0), (-1, 0), (0, 1)],
+    'east': [(1, 0), (0, 1), (0, -1), (-1, 0)],
+    'south': [(0, 1), (-1, 0), (1, 0), (0, -1)],
+    'west': [(-1, 0), (0, -1), (0, 1), (1, 0)],
+    'above': [(1, 0), (0, -1), (0, 1), (-1, 0)],
+    'below': [(1, 0), (0, 1), (0, -1), (-1, 0)],
+}
+# characters between two columns and lines between two rows of rooms
+COLUMN_GAP = 9
+ROW_GAP = 3
+ROW_HEIGHT = 3
 
 
-def graph_easy(mapfile_content):
+class MapCache:
+    """A bounded LRU of rendered maps keyed by (origin room id, distance,
+    renderer).
+
+    Each entry remembers the ids of the rooms its walk looked at. When one of
+    those is renamed or its exits change (ROOM_GRAPH tells us), only the
+    entries that saw it are dropped, so players in an untouched part of the
+    world keep getting their map from memory."""
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries = OrderedDict()
+            # room id -> keys of the entries that depend on it
+            self.dependents = {}
+            # bumped by every invalidation so a render that raced one isn't
+            # cached
+            self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, rendered, room_ids, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._drop(key)
+            self.entries[key] = (rendered, room_ids)
+            for room_id in room_ids:
+                self.dependents.setdefault(room_id, set()).add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for room_id in entry[1]:
+            keys = self.dependents.get(room_id, set())
+            keys.discard(key)
+            if not keys:
+                self.dependents.pop(room_id, None)
+
+    def invalidate(self, *room_ids):
+        with self._lock:
+            self.generation += 1
+            for room_id in room_ids:
+                for key in list(self.dependents.get(room_id, ())):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def room_changed(self, room_id):
+        """For ROOM_GRAPH.listeners."""
+        if room_id is not None:
+            self.invalidate(room_id)
+            return
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries = OrderedDict()
+            self.dependents = {}
+
+    def data_changed(self, obj, keys):
+        if 'name' in keys:
+            self.invalidate(obj.id)
+
+    @property
+    def stats(self):
+        return dict(
+            size=len(self.entries),
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+MAP_CACHE = MapCache(config.MAP_CACHE_SIZE)
+DATA_LISTENERS.append(MAP_CACHE.data_changed)
+ROOM_GRAPH.listeners.append(MAP_CACHE.room_changed)
+
+
+class MapJob:
+    """A map whose rooms have been walked but that still has to go through
+    boxgraph. Call done() with the result to cache it."""
+    def __init__(self, key, mapfile, seen, generation):
+        self.key = key
+        self.mapfile = mapfile
+        self.seen = seen
+        self.generation = generation
+
+    def done(self, rendered):
+        MAP_CACHE.put(self.key, rendered, self.seen, self.generation)
+        return rendered
+
+
+def plan_map(world, room, distance=2, renderer=None):
+    """Does the part of rendering a map that needs the game world. Returns
+    the rendered map if it's cached or can be drawn in process, otherwise a
+    MapJob for boxgraph."""
+    if renderer is None:
+        renderer = config.MAP_RENDERER
+    key = (room.id, distance, renderer)
+    rendered = MAP_CACHE.get(key)
+    if rendered is not None:
+        return rendered
+
+    generation = MAP_CACHE.generation
+    seen = {room.id}
+    edges = edges_from_room(world, room, distance, seen)
+    if renderer == 'boxgraph':
+        return MapJob(key, mapfile(edges), seen, generation)
+    rendered = grid_map(edges, room.name)
+    MAP_CACHE.put(key, rendered, seen, generation)
+    return rendered
+
+
+def render_map(world, room, distance=2, renderer=None):
+    planned = plan_map(world, room, distance, renderer)
+    if isinstance(planned, MapJob):
+        return planned.done(graph_easy(planned.mapfile))
+    return planned
+
+
+def boxgraph_path():
     # TODO use when we can have py37: with resources.path(__package__, 'boxgraph') as p:
     tmserver_install_path = path.dirname(sys.modules['tmserver'].__file__)
-    boxgraph_path = path.join(tmserver_install_path, 'boxgraph')
-    completed = subprocess.run([boxgraph_path],
+    return path.join(tmserver_install_path, 'boxgraph')
+
+
+class MapRenderPool:
+    """Runs boxgraph in subprocesses without blocking the event loop.
+
+    At most `workers` renders run at once. Up to `queue_limit` more wait
+    their turn; past that, new requests are turned away with a ClientError.
+    A render that takes longer than `timeout` seconds is killed.
+
+    renders, timeouts, failures and rejected count outcomes; total_wait and
+    max_wait are seconds spent waiting for a turn."""
+    def __init__(self, loop, workers=None, timeout=None, queue_limit=None, command=None):
+        if workers is None:
+            workers = config.MAP_WORKERS
+        if timeout is None:
+            timeout = config.MAP_TIMEOUT
+        if queue_limit is None:
+            queue_limit = config.MAP_QUEUE_LIMIT
+        if command is None:
+            command = [boxgraph_path()]
+        self.loop = loop
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_limit = queue_limit
+        self.command = command
+        self._slots = asyncio.Semaphore(workers, loop=loop)
+        self.queue_depth = 0
+        self.renders = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def render(self, mapfile_content):
+        if self.queue_depth >= self.queue_limit:
+            self.rejected += 1
+            raise ClientError('server busy, try again shortly')
+
+        queued_at = self.loop.time()
+        self.queue_depth += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queue_depth -= 1
+        waited = self.loop.time() - queued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+        try:
+            return await self._run(mapfile_content)
+        finally:
+            self._slots.release()
+
+    async def _run(self, mapfile_content):
+        process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            loop=self.loop)
+        try:
+            stdout, _ = await asyncio.wait_for(
+                process.communicate(mapfile_content.encode('utf-8')),
+                self.timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            self.timeouts += 1
+            raise ClientError('the map took too long to draw')
+        if process.returncode != 0:
+            self.failures += 1
+            raise ClientError('failed to draw the map')
+        self.renders += 1
+        return stdout.decode('utf-8')
+
+    @property
+    def stats(self):
+        return dict(
+            renders=self.renders,
+            timeouts=self.timeouts,
+            failures=self.failures,
+            rejected=self.rejected,
+            queue_depth=self.queue_depth,
+            total_wait=self.total_wait,
+            max_wait=self.max_wait)
+
+
+def graph_easy(mapfile_content):
+    completed = subprocess.run([boxgraph_path()],
                                input=mapfile_content,
                                capture_output=True,
                                text=True)
     # TODO error handling
     return completed.stdout
 
-def mapfile_for_room(world, mapped, room):
-    return [
-        '[ {from_room} ] -- {direction} --> [ {to_room} ]'.format(
-            from_room=room.name,
-            direction=d,
-            to_room=r.name)
-        for d,r in adjacent(world, room)
-        if r.shortname not in mapped]
+def mapfile(edges):
+    return '\n'.join(
+        '[ {} ] -- {} --> [ {} ]'.format(from_room, direction, to_room)
+        for from_room, direction, to_room in edges)
 
 def adjacent(world, room):
-    out = []
-    for d in DIRECTIONS:
-        e = world.resolve_exit(room, d)
-        if e is None: continue
-        route = e.get_data('exit').get(room.shortname)
-        target_room = GameObject.get_or_none(GameObject.shortname==route[1])
-        out.append((d,target_room))
-
-    return out
-
-def build_queue(world, queue, room):
-    if queue[room.shortname] == 0:
-        return
-    else:
-        for d,r in adjacent(world, room):
-            if r.shortname in queue: continue
-            queue[r.shortname] = queue[room.shortname] - 1
-            build_queue(world, queue, r)
+    """Returns (direction, room) for each exit out of room."""
+    exits = ROOM_GRAPH.exits(room.id)
+    targets = {o.id: o for o in GameObject.by_ids([t for _, t in exits.values()])}
+    return [(d, targets[t]) for d, (_, t) in exits.items() if t in targets]
 
-def from_room(world, room, distance=3):
+def edges_from_room(world, room, distance=3, seen=None):
+    """Returns (from room name, direction, to room name) for every exit out
+    of the rooms within distance of room, leaving out the way back along
+    exits already listed. If seen is given, the ids of every room looked at
+    are added to it."""
     if distance < 0:
         raise ValueError('distance must be greater than 0')
 
-    queue = OrderedDict()
-    queue[room.shortname] = distance
-    build_queue(world, queue, room)
+    hops = ROOM_GRAPH.neighbourhood(room.id, distance)
+    room_exits = [(room_id, ROOM_GRAPH.exits(room_id)) for room_id in hops]
+    room_ids = set(hops)
+    for _, exits in room_exits:
+        room_ids.update(t for _, t in exits.values())
+    rooms = {o.id: o for o in GameObject.by_ids(list(room_ids))}
+    if seen is not None:
+        seen.update(room_ids)
+
     mapped = set()
-    mapfile = []
-    for room_name in queue.keys():
-        room = GameObject.get(GameObject.shortname==room_name)
-        mapfile.extend(mapfile_for_room(world, mapped, room))
-        mapped.add(room_name)
+    edges = []
+    for room_id, exits in room_exits:
+        for direction in DIRECTION_ORDER:
+            route = exits.get(direction)
+            if route is None or route[1] in mapped or route[1] not in rooms:
+                continue
+            edges.append((rooms[room_id].name, direction, rooms[route[1]].name))
+        mapped.add(room_id)
+
+    return edges
+
+def from_room(world, room, distance=3):
+    return mapfile(edges_from_room(world, room, distance))
+
+
+def _free_cell(taken, x, y):
+    """The nearest cell to (x, y) that nothing is in, searching outwards
+    ring by ring."""
+    radius = 0
+    while True:
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                if max(abs(dx), abs(dy)) != radius:
+                    continue
+                if (x + dx, y + dy) not in taken:
+                    return x + dx, y + dy
+        radius += 1
+
+def _next_to(taken, x, y, direction):
+    for dx, dy in GRID_STEPS[direction]:
+        if (x + dx, y + dy) not in taken:
+            return x + dx, y + dy
+    dx, dy = GRID_STEPS[direction][0]
+    return _free_cell(taken, x + dx, y + dy)
+
+def _floor(exits, root, placed):
+    """Lays out root and the rooms joined to it by north, south, east and west
+    exits that aren't in placed, relative to root. Returns their cells and
+    the above and below exits leading off of them."""
+    cells = {root: (0, 0)}
+    taken = {(0, 0)}
+    vertical = []
+    pending = deque([root])
+    while pending:
+        room = pending.popleft()
+        x, y = cells[room]
+        for direction, to_room in exits.get(room, []):
+            if to_room in cells or to_room in placed:
+                continue
+            if direction in ('above', 'below'):
+                vertical.append((room, direction, to_room))
+                continue
+            cells[to_room] = _next_to(taken, x, y, direction)
+            taken.add(cells[to_room])
+            pending.append(to_room)
+    return cells, vertical
+
+def grid_layout(edges, origin):
+    """Assigns each room named in edges a (column, row) cell, walking out
+    from origin breadth first and putting each room next to the one it was
+    reached from in the direction of the exit when that cell is free.
+
+    A room above or below gets a free cell beside the room it hangs off of if
+    it's on its own; if it leads on to more rooms, that whole floor is laid
+    out to the right of everything else so it can't collide with this one."""
+    exits = {}
+    for from_room, direction, to_room in edges:
+        exits.setdefault(from_room, []).append((direction, to_room))
+    for room_exits in exits.values():
+        room_exits.sort(key=lambda e: (DIRECTION_ORDER.index(e[0]), e[1]))
+
+    cells, vertical = _floor(exits, origin, {})
+    vertical = deque(vertical)
+    while vertical:
+        from_room, direction, to_room = vertical.popleft()
+        if to_room in cells:
+            continue
+        floor, more = _floor(exits, to_room, cells)
+        x, y = cells[from_room]
+        if len(floor) == 1:
+            cells[to_room] = _next_to(set(cells.values()), x, y, direction)
+        else:
+            left = max(cx for cx, _ in cells.values()) + 2
+            floor_left = min(fx for fx, _ in floor.values())
+            for room, (fx, fy) in floor.items():
+                cells[room] = (left + fx - floor_left, y + fy)
+        vertical.extend(more)
+
+    # anything not reachable from origin along the listed exits
+    taken = set(cells.values())
+    for from_room, _, to_room in edges:
+        for room in (from_room, to_room):
+            if room not in cells:
+                cells[room] = _free_cell(taken, 0, 0)
+                taken.add(cells[room])
+
+    return cells
+
+def grid_map(edges, origin):
+    """Draws the rooms in edges as boxes on a grid, joined by labelled
+    arrows, without leaving the process. Exits between rooms that didn't end
+    up side by side are listed under the map instead."""
+    cells = grid_layout(edges, origin)
+    min_x = min(x for x, _ in cells.values())
+    min_y = min(y for _, y in cells.values())
+    cells = {room: (x - min_x, y - min_y) for room, (x, y) in cells.items()}
+    columns = max(x for x, _ in cells.values()) + 1
+    rows = max(y for _, y in cells.values()) + 1
+
+    widths = [0] * columns
+    for room, (x, _) in cells.items():
+        widths[x] = max(widths[x], len(room) + 4)
+    lefts = []
+    left = 0
+    for width in widths:
+        lefts.append(left)
+        left += width + COLUMN_GAP
+    tops = [y * (ROW_HEIGHT + ROW_GAP) for y in range(rows)]
+
+    canvas = [[' '] * (left - COLUMN_GAP)
+              for _ in range(rows * (ROW_HEIGHT + ROW_GAP) - ROW_GAP)]
+
+    def write(x, y, text):
+        canvas[y][x:x + len(text)] = text
+
+    for room, (x, y) in cells.items():
+        left, top = lefts[x], tops[y]
+        write(left, top, '┌' + '─' * (len(room) + 2) + '┐')
+        write(left, top + 1, '│ ' + room + ' │')
+        write(left, top + 2, '└' + '─' * (len(room) + 2) + '┘')
+
+    unplaced = []
+    drawn = set()
+    for from_room, direction, to_room in edges:
+        (x1, y1), (x2, y2) = cells[from_room], cells[to_room]
+        pair = frozenset([from_room, to_room])
+        if pair in drawn or abs(x1 - x2) + abs(y1 - y2) != 1:
+            unplaced.append((from_room, direction, to_room))
+            continue
+        drawn.add(pair)
+        if y1 == y2:
+            x, y = min(x1, x2), y1
+            start = lefts[x] + len(min((from_room, to_room), key=lambda r: cells[r][0])) + 4
+            end = lefts[x + 1]
+            line = list('─' * (end - start - 2))
+            if x2 > x1:
+                line[-1] = '>'
+            else:
+                line[0] = '<'
+            write(start + 1, tops[y] + 1, ''.join(line))
+            write(start + 2, tops[y], direction)
+        else:
+            x, y = x1, min(y1, y2)
+            column = lefts[x] + 2
+            for i in range(ROW_GAP):
+                write(column, tops[y] + ROW_HEIGHT + i, '│')
+            if y2 > y1:
+                write(column, tops[y] + ROW_HEIGHT + ROW_GAP - 1, '∨')
+            else:
+                write(column, tops[y] + ROW_HEIGHT, '∧')
+            write(column + 2, tops[y] + ROW_HEIGHT + ROW_GAP // 2, direction)
 
-    return '\n'.join(mapfile)
+    lines = [''.join(row).rstrip() for row in canvas]
+    if unplaced:
+        lines.append('')
+        lines.extend('{} --{}--> {}'.format(*e) for e in unplaced)
+    return '\n'.join(lines) + '\n'
@@ -1,8 +1,13 @@
+import multiprocessing
+
 import peewee as pw
 import playhouse.migrate as m
 
 from .config import get_db
-from .models import MODELS, GameObject, UserAccount
+from .errors import MigrationError
+from .mapping import MAP_CACHE
+from .models import MODELS, LIVE_OBJECTS, CONTAINMENT, PATH_CACHE, ROOM_GRAPH, GameObject, UserAccount, ScriptRevision, Contains, Exit, shortname_ids
+from .scripting import ACTION_INTEREST, BYTECODE_VERSION, ENGINE_CACHE, compile_witch, witch_namespace
 import logging
 
 def logging_env_column(db, migrator):
@@ -14,12 +19,72 @@ def logging_remove_actor_column(db, migrator):
     m.migrate(
         migrator.drop_column('log', 'actor_id'))
 
+def duplicate_contains():
+    """Returns (outer_obj_id, inner_obj_id, count) for every containment
+    that's recorded more than once."""
+    count = pw.fn.COUNT(Contains.id)
+    return list(Contains.select(Contains.outer_obj, Contains.inner_obj, count)\
+                        .group_by(Contains.outer_obj, Contains.inner_obj)\
+                        .having(count > 1)\
+                        .tuples())
+
+def check_duplicate_contains():
+    """Raises a MigrationError listing any duplicate Contains rows, since the
+    unique index on Contains can't be built while there are some."""
+    duplicates = duplicate_contains()
+    if duplicates:
+        raise MigrationError('duplicate contains rows (outer, inner, count): {}'.format(
+            ', '.join(str(d) for d in duplicates)))
+
+def hot_path_indexes(db, migrator):
+    """Adds the indexes that the models' Meta now declare to databases
+    created before they did. Refuses to run while there are duplicate Contains
+    rows."""
+    check_duplicate_contains()
+
+    indexes = [
+        ('contains', ('outer_obj_id', 'inner_obj_id'), True),
+        ('gameobject', ('author_id', 'is_player_obj'), False),
+        ('gameobject', ('author_id', 'is_sanctum'), False),
+        ('scriptrevision', ('script_id', 'created_at'), False),
+    ]
+    for table, columns, unique in indexes:
+        existing = {i.name for i in db.get_indexes(table)}
+        if m.make_index_name(table, columns) in existing:
+            continue
+        m.migrate(migrator.add_index(table, columns, unique))
+
+def game_object_data_jsonb(db, migrator):
+    """GameObject.data went from json to jsonb so that single keys can be
+    updated in place."""
+    db.execute_sql(
+        'ALTER TABLE gameobject ALTER COLUMN data TYPE jsonb USING data::jsonb')
+
+def exit_table(db, migrator):
+    """Exit rows mirror the routes in exit objects' data['exit']; this makes
+    the table and fills it in from the data that's already there."""
+    db.create_tables([Exit], safe=True)
+    exits = list(GameObject.select()\
+                           .where(GameObject.data.contains('exit'),
+                                  GameObject.is_player_obj == False))
+    shortnames = set()
+    for exit_obj in exits:
+        for room, (_, target) in exit_obj.data['exit'].items():
+            shortnames.update((room, target))
+    ids = shortname_ids(shortnames)
+    for exit_obj in exits:
+        Exit.sync(exit_obj, ids)
+    ROOM_GRAPH.clear()
+
 # These are largely historical, but may be of use once there exists a
 # long-running tildemush instance. in test and dev, i'm repeatedly trashing the
 # db with reset_db.
 MIGRATIONS = [
     logging_env_column,
-    logging_remove_actor_column
+    logging_remove_actor_column,
+    hot_path_indexes,
+    game_object_data_jsonb,
+    exit_table,
 ]
 
 def initialize():
@@ -32,6 +97,11 @@ def migrate(migrations=MIGRATIONS):
         migration(db, migrator)
 
 def init_db():
+    # create_tables also builds any index in the models' Meta that a database
+    # made before it was declared lacks, so report duplicates before that
+    # fails on them
+    if Contains.table_exists():
+        check_duplicate_contains()
     get_db().create_tables(MODELS, safe=True)
     logging.getLogger('tmserver').info("db tables: {}".format(get_db().get_tables()))
 
@@ -50,4 +120,47 @@ def init_db():
 
 def reset_db():
     get_db().drop_tables(MODELS)
+    # ids get reused once the tables are recreated, so anything we remember
+    # about old rows is now a lie.
+    LIVE_OBJECTS.clear()
+    CONTAINMENT.clear()
+    ROOM_GRAPH.clear()
+    PATH_CACHE.clear()
+    ACTION_INTEREST.clear()
+    MAP_CACHE.clear()
     init_db()
+
+def _precompile(rev):
+    """Runs in a worker process; compiles a single (id, code) revision pair.
+    Nothing in here may touch the database."""
+    rev_id, code = rev
+    try:
+        _, bytecode = compile_witch(code, witch_namespace(lambda data: None))
+    except Exception:
+        return rev_id, None
+    return rev_id, bytecode
+
+def precompile_scripts(processes=None):
+    """Compiles every script revision that a game object is currently using
+    and persists the resulting bytecode. The hy compilation is spread across
+    worker processes. Returns a tuple of (compiled, failed) counts."""
+    revisions = {r.id: r for r in ScriptRevision.select()\
+                                               .join(GameObject, on=(GameObject.script_revision==ScriptRevision.id))\
+                                               .distinct()}
+    todo = [(r.id, r.code) for r in revisions.values()
+            if r.load_bytecode(BYTECODE_VERSION, ENGINE_CACHE.key(r.code)) is None]
+    if not todo:
+        return 0, 0
+
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_precompile, todo)
+
+    compiled = 0
+    for rev_id, bytecode in results:
+        if bytecode is None:
+            continue
+        rev = revisions[rev_id]
+        rev.store_bytecode(BYTECODE_VERSION, ENGINE_CACHE.key(rev.code), bytecode)
+        compiled += 1
+
+    return compiled, len(results) - compiled
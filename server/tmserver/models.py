@@ -2,20 +2,45 @@ from datetime import datetime
 import itertools
 import re
 
-import bcrypt
 import peewee as pw
-from playhouse.signals import Model, pre_save, post_save
-from playhouse.postgres_ext import JSONField
+from playhouse.signals import Model, pre_save, post_save, post_delete
+from playhouse.postgres_ext import BinaryJSONField
 
 from . import config
+from . import passwords
+from .containment import ContainmentIndex
 from .errors import UserValidationError, ClientError
-from .scripting import ScriptedObjectMixin
+from .identity import IdentityMap
+from .revisions import REVISIONS
+from .scripting import ACTION_INTEREST, DATA_LISTENERS, ScriptedObjectMixin, data_changed
+from .topology import PathCache, RoomGraph
 from .util import strip_color_codes, collapse_whitespace
 
 
 BAD_USERNAME_CHARS_RE = re.compile(r'[\:\'";%]')
 MIN_PASSWORD_LEN = 12
 
+# Every GameObject we hand out goes through this so that a given row is always
+# the same python object (and keeps its compiled WITCH engine).
+LIVE_OBJECTS = IdentityMap()
+
+# Who contains whom, kept in memory. Contains is still the durable copy.
+CONTAINMENT = ContainmentIndex(
+    lambda: Contains.select(Contains.outer_obj, Contains.inner_obj)\
+                    .order_by(Contains.id)\
+                    .tuples())
+CONTAINMENT.listeners.append(ACTION_INTEREST.invalidate)
+
+# Which rooms lead where, kept in memory; see topology.py.
+ROOM_GRAPH = RoomGraph(
+    CONTAINMENT,
+    lambda: Exit.select(Exit.exit_obj, Exit.room, Exit.direction, Exit.target)\
+                .tuples())
+CONTAINMENT.listeners.append(ROOM_GRAPH.room_changed)
+# Recent shortest paths through it, for /path and /travel.
+PATH_CACHE = PathCache(config.PATH_CACHE_SIZE)
+ROOM_GRAPH.listeners.append(PATH_CACHE.room_changed)
+
 class BaseModel(Model):
     created_at = pw.DateTimeField(default=datetime.utcnow)
     class Meta:
@@ -33,14 +58,19 @@ class UserAccount(BaseModel):
     updated_at = pw.DateTimeField(null=True)
     is_god = pw.BooleanField(default=False)
 
+    _password_hashed = False
+
     def _hash_password(self):
-        self.password = bcrypt.hashpw(self.password.encode('utf-8'), bcrypt.gensalt())
+        self.password = passwords.hash_password(self.password)
+
+    def set_password_hash(self, password_hash):
+        """Use an already hashed password (see PasswordPool) instead of having
+        the plaintext one hashed on save."""
+        self.password = password_hash
+        self._password_hashed = True
 
     def check_password(self, plaintext_password):
-        pw = self.password
-        if type(self.password) == type(''):
-            pw = self.password.encode('utf-8')
-        return bcrypt.checkpw(plaintext_password.encode('utf-8'), pw)
+        return passwords.check_password(plaintext_password, self.password)
 
     # TODO should this be a class method?
     # TODO should this just run in pre_save?
@@ -77,7 +107,7 @@ def pre_user_save(cls, instance, created):
     if not created:
         instance.updated_at = datetime.utcnow()
 
-    if created and instance.password:
+    if created and instance.password and not instance._password_hashed:
         instance._hash_password()
 
 
@@ -112,11 +142,55 @@ class ScriptRevision(BaseModel):
     code = pw.TextField()
     script = pw.ForeignKeyField(Script)
 
+    class Meta:
+        indexes = (
+            # latest_script_rev
+            (('script', 'created_at'), False),
+        )
+
+    def load_bytecode(self, version, code_hash):
+        """Returns persisted bytecode for this revision if there is some that
+        was compiled by the given hy/python version from code matching
+        code_hash."""
+        bc = ScriptBytecode.get_or_none(
+            ScriptBytecode.script_revision==self,
+            ScriptBytecode.version==version)
+        if bc is None or bc.code_hash != code_hash:
+            return None
+        return bytes(bc.code)
+
+    def store_bytecode(self, version, code_hash, bytecode):
+        with config.get_db().atomic():
+            ScriptBytecode.delete().where(
+                ScriptBytecode.script_revision==self,
+                ScriptBytecode.version==version).execute()
+            ScriptBytecode.create(
+                script_revision=self,
+                version=version,
+                code_hash=code_hash,
+                code=bytecode)
+
 @pre_save(sender=ScriptRevision)
 def pre_scriptrev_save(cls, instance, created):
     instance.code = instance.code.lstrip().rstrip()
 
 
+class ScriptBytecode(BaseModel):
+    """Marshalled python code compiled from a ScriptRevision's WITCH code so
+    that a freshly started server doesn't have to run every script through hy
+    again. Rows are only trusted for the hy/python version that wrote them and
+    only while code_hash still matches the revision's code."""
+    script_revision = pw.ForeignKeyField(ScriptRevision, backref='bytecode')
+    version = pw.CharField()
+    code_hash = pw.CharField()
+    code = pw.BlobField()
+
+    class Meta:
+        indexes = (
+            (('script_revision', 'version'), True),
+        )
+
+
 class Permission(BaseModel):
     """There are four types of permissions for a game object: read, write,
     carry, and execute.
@@ -171,25 +245,34 @@ class GameObject(BaseModel, ScriptedObjectMixin):
     script_revision = pw.ForeignKeyField(ScriptRevision, null=True)
     is_player_obj = pw.BooleanField(default=False)
     is_sanctum = pw.BooleanField(default=False)
-    data = JSONField(default=dict)
+    data = BinaryJSONField(default=dict)
     perms = pw.ForeignKeyField(Permission, backref='obj', null=True)
 
+    class Meta:
+        indexes = (
+            # player_obj and sanctum lookups
+            (('author', 'is_player_obj'), False),
+            (('author', 'is_sanctum'), False),
+        )
+
     @classmethod
-    def create_scripted_object(cls, author, shortname, obj_type='item', format_dict=None):
+    def create_scripted_object(cls, author, shortname, obj_type='item', data=None):
         """This function does the necessary shenanigans to create a
         script/scriptrev/obj. It creates them all in the DB and returns the
-        GameObject."""
+        GameObject. data (name, description and so on) starts off the
+        object's data; the script is the obj_type template as is."""
 
-        if format_dict is None:
-            format_dict = {
+        if data is None:
+            data = {
                 'name': 'an object',
                 'description': 'a perfect gray sphere'
             }
+        data = dict(data)
 
-        if 'description' in format_dict:
-            format_dict['description'] = collapse_whitespace(format_dict['description'])
+        if 'description' in data:
+            data['description'] = collapse_whitespace(data['description'])
 
-        script_code = cls.get_template(obj_type).format(**format_dict)
+        script_code = cls.get_template(obj_type)
         with config.get_db().atomic():
             script = Script.create(
                 author=author,
@@ -201,11 +284,51 @@ class GameObject(BaseModel, ScriptedObjectMixin):
                 perms=Permission(),
                 author=author,
                 shortname=shortname,
-                script_revision=scriptrev)
+                script_revision=scriptrev,
+                data=data)
             game_obj.init_scripting()
 
         return game_obj
 
+    @classmethod
+    def get(cls, *query, **filters):
+        """Like peewee's get, but always returns the live instance for the
+        matching row. get_or_none and get_by_id both funnel through here."""
+        return LIVE_OBJECTS.canonical(super().get(*query, **filters))
+
+    @classmethod
+    def by_id(cls, obj_id):
+        """Returns the live object with the given id, only hitting the DB if
+        we've never seen it."""
+        obj = LIVE_OBJECTS.get(obj_id)
+        if obj is None:
+            obj = cls.get_by_id(obj_id)
+        return obj
+
+    @classmethod
+    def by_shortname(cls, shortname):
+        """Returns the live object with the given shortname or None, only
+        hitting the DB if we've never seen it."""
+        obj = LIVE_OBJECTS.get_by_shortname(shortname)
+        if obj is None:
+            obj = cls.get_or_none(cls.shortname==shortname)
+        return obj
+
+    @classmethod
+    def by_ids(cls, obj_ids):
+        """Returns a list of the live objects with the given ids, fetching any
+        we've never seen in a single query."""
+        missing = [i for i in obj_ids if LIVE_OBJECTS.get(i) is None]
+        if missing:
+            list(cls.live(cls.select().where(cls.id.in_(missing))))
+        return [o for o in map(LIVE_OBJECTS.get, obj_ids) if o is not None]
+
+    @classmethod
+    def live(cls, query):
+        """Given a GameObject select query, returns a generator of the live
+        instances for the rows it returns."""
+        return (LIVE_OBJECTS.canonical(o) for o in query)
+
     @property
     def name(self):
         return self.get_data('name', self.shortname)
@@ -216,13 +339,13 @@ class GameObject(BaseModel, ScriptedObjectMixin):
 
     @property
     def contains(self):
-        return (c.inner_obj for c in Contains.select().where(Contains.outer_obj==self))
+        return GameObject.by_ids(CONTAINMENT.inners_of(self.id))
 
     @property
     def contained_by(self):
-        """Returns a generator of all the objects that contain the calling
+        """Returns a list of all the objects that contain the calling
         object."""
-        return (c.outer_obj for c in Contains.select().where(Contains.inner_obj==self))
+        return GameObject.by_ids(CONTAINMENT.outers_of(self.id))
 
     @property
     def neighbors(self):
@@ -233,12 +356,12 @@ class GameObject(BaseModel, ScriptedObjectMixin):
     def room(self):
         """Unlike contained_by, this method either returns the single thing
         that contains the calling obj or raises."""
-        model_set = list(Contains.select().where(Contains.inner_obj==self))
-        if not model_set:
+        outer_ids = CONTAINMENT.outers_of(self.id)
+        if not outer_ids:
             return None
-        if len(model_set) > 1:
+        if len(outer_ids) > 1:
             raise ClientError("Bad state: room() called but obj contained by multiple things.")
-        return model_set[0].outer_obj
+        return GameObject.by_id(outer_ids[0])
 
 
     @property
@@ -358,9 +481,46 @@ class GameObject(BaseModel, ScriptedObjectMixin):
 @post_save(sender=GameObject)
 def on_game_object_create(cls, instance, created):
     if not created: return
+    LIVE_OBJECTS.add(instance)
+    config.get_db().on_rollback(LIVE_OBJECTS.remove, instance)
     instance.perms = Permission.create()
     instance.save()
 
+@post_delete(sender=GameObject)
+def on_game_object_delete(cls, instance):
+    db = config.get_db()
+    LIVE_OBJECTS.remove(instance)
+    db.on_rollback(LIVE_OBJECTS.add, instance)
+    for outer_id in CONTAINMENT.outers_of(instance.id):
+        db.on_rollback(CONTAINMENT.add, outer_id, instance.id)
+    for inner_id in CONTAINMENT.inners_of(instance.id):
+        db.on_rollback(CONTAINMENT.add, instance.id, inner_id)
+    CONTAINMENT.forget(instance.id)
+    # its Exit rows went with it
+    db.on_rollback(ROOM_GRAPH.update, instance.id, ROOM_GRAPH.routes_of(instance.id))
+    ROOM_GRAPH.update(instance.id, {})
+    # as far as anything derived from its data is concerned, all of it changed
+    data_changed(instance, set(instance.data or {}) - {'exit'})
+
+@REVISIONS.subscribe
+def on_script_revised(script_id, revision_id):
+    """Flags the live objects running some revision of the changed script so
+    that their engines check for the new one on next use."""
+    rev_ids = {r.id for r in ScriptRevision.select(ScriptRevision.id)\
+                                           .where(ScriptRevision.script==script_id)}
+    for obj in LIVE_OBJECTS:
+        if obj.script_revision_id in rev_ids and obj.script_revision_id != revision_id:
+            obj._revision_pending = True
+            ACTION_INTEREST.object_changed(obj.id)
+
+@REVISIONS.subscribe_resync
+def on_revisions_resync():
+    """We may have missed notifications, so every live object checks for a
+    newer revision on next use."""
+    for obj in LIVE_OBJECTS:
+        obj._revision_pending = True
+    ACTION_INTEREST.clear()
+
 class Editing(BaseModel):
     user_account = pw.ForeignKeyField(UserAccount)
     game_obj = pw.ForeignKeyField(GameObject)
@@ -370,6 +530,107 @@ class Contains(BaseModel):
     outer_obj = pw.ForeignKeyField(GameObject)
     inner_obj = pw.ForeignKeyField(GameObject)
 
+    class Meta:
+        indexes = (
+            (('outer_obj', 'inner_obj'), True),
+        )
+
+    @classmethod
+    def unlink(cls, inner_obj, outer_obj=None):
+        """Takes inner_obj out of outer_obj, or out of everything if outer_obj
+        is None. Containment should only ever be removed through here so that
+        CONTAINMENT stays in step with the table."""
+        query = cls.delete().where(cls.inner_obj==inner_obj)
+        if outer_obj is not None:
+            query = query.where(cls.outer_obj==outer_obj)
+        query.execute()
+
+        db = config.get_db()
+        if outer_obj is None:
+            for outer_id in CONTAINMENT.outers_of(inner_obj.id):
+                db.on_rollback(CONTAINMENT.add, outer_id, inner_obj.id)
+            CONTAINMENT.remove_inner(inner_obj.id)
+        else:
+            if inner_obj.id in CONTAINMENT.inners_of(outer_obj.id):
+                db.on_rollback(CONTAINMENT.add, outer_obj.id, inner_obj.id)
+            CONTAINMENT.remove(outer_obj.id, inner_obj.id)
+
+
+@post_save(sender=Contains)
+def on_contains_create(cls, instance, created):
+    if created:
+        CONTAINMENT.add(instance.outer_obj_id, instance.inner_obj_id)
+        config.get_db().on_rollback(
+            CONTAINMENT.remove, instance.outer_obj_id, instance.inner_obj_id)
+
+
+class Exit(BaseModel):
+    """One route through an exit object: going direction from room through
+    exit_obj leads to target. These rows mirror the exit's data['exit'] (room
+    shortname -> (direction, target shortname)) so that a room's exits are
+    found with an indexed lookup instead of by reading the data of everything
+    in it; sync() rewrites them whenever that data changes.
+
+    An exit still only works from rooms that contain it. That's up to
+    Contains, as before."""
+    room = pw.ForeignKeyField(GameObject, backref='+', on_delete='CASCADE')
+    direction = pw.CharField()
+    target = pw.ForeignKeyField(GameObject, backref='+', on_delete='CASCADE')
+    exit_obj = pw.ForeignKeyField(GameObject, backref='+', on_delete='CASCADE')
+
+    class Meta:
+        indexes = (
+            (('room', 'direction'), False),
+            (('exit_obj', 'room'), True),
+        )
+
+    @classmethod
+    def routes_from_data(cls, exit_data, ids=None):
+        """Given an exit's data['exit'], returns its routes as a dict of room
+        id -> (direction, target room id), leaving out any that mention a room
+        that doesn't exist. ids maps shortnames to ids; it's looked up if not
+        given."""
+        exit_data = exit_data or {}
+        if ids is None:
+            shortnames = set(exit_data) | {t for _, t in exit_data.values()}
+            ids = shortname_ids(shortnames)
+        return {ids[room]: (direction, ids[target])
+                for room, (direction, target) in exit_data.items()
+                if room in ids and target in ids}
+
+    @classmethod
+    def sync(cls, exit_obj, ids=None):
+        """Rewrites exit_obj's rows from its data and returns its routes (see
+        routes_from_data)."""
+        routes = cls.routes_from_data((exit_obj.data or {}).get('exit'), ids)
+        with config.get_db().atomic():
+            cls.delete().where(cls.exit_obj==exit_obj.id).execute()
+            if routes:
+                cls.insert_many([
+                    dict(room=room_id, direction=direction,
+                         target=target_id, exit_obj=exit_obj.id)
+                    for room_id, (direction, target_id) in routes.items()]).execute()
+        return routes
+
+
+def shortname_ids(shortnames):
+    """Returns a dict of shortname -> id for those of shortnames that exist."""
+    if not shortnames:
+        return {}
+    return dict(GameObject.select(GameObject.shortname, GameObject.id)\
+                          .where(GameObject.shortname.in_(list(shortnames)))\
+                          .tuples())
+
+
+def on_data_changed(obj, keys):
+    """Keeps Exit and ROOM_GRAPH in step with exit objects' data."""
+    if 'exit' in keys and not obj.is_player_obj:
+        routes = ROOM_GRAPH.routes_of(obj.id)
+        ROOM_GRAPH.update(obj.id, Exit.sync(obj))
+        config.get_db().on_rollback(ROOM_GRAPH.update, obj.id, routes)
+
+DATA_LISTENERS.append(on_data_changed)
+
 
 class LastSeen(BaseModel):
     user_account = pw.ForeignKeyField(UserAccount)
@@ -381,4 +642,4 @@ class Log(BaseModel):
     raw = pw.CharField()
 
 
-MODELS = [UserAccount, Log, GameObject, Contains, Script, ScriptRevision, Permission, Editing, LastSeen]
+MODELS = [UserAccount, Log, GameObject, Contains, Exit, Script, ScriptRevision, ScriptBytecode, Permission, Editing, LastSeen]
@@ -0,0 +1,79 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import functools
+
+import bcrypt
+
+from . import config
+from .errors import ClientError
+
+
+def hash_password(plaintext_password):
+    return bcrypt.hashpw(plaintext_password.encode('utf-8'), bcrypt.gensalt())
+
+
+def check_password(plaintext_password, password_hash):
+    if type(password_hash) == type(''):
+        password_hash = password_hash.encode('utf-8')
+    return bcrypt.checkpw(plaintext_password.encode('utf-8'), password_hash)
+
+
+class PasswordPool:
+    """bcrypt is deliberately slow. Run on the event loop, a burst of logins
+    (say, every client reconnecting after a restart) stalls the whole game, so
+    password work goes to a pool of worker processes instead.
+
+    At most `workers` hashes run at once. Up to `queue_limit` more wait their
+    turn; past that, new requests are turned away with a ClientError rather
+    than left to pile up. `completed`, `failed` and `rejected` count how
+    requests turned out.
+
+    The pool's processes are started on first use."""
+    def __init__(self, loop, workers=None, queue_limit=None):
+        if workers is None:
+            workers = config.PASSWORD_WORKERS
+        if queue_limit is None:
+            queue_limit = config.PASSWORD_QUEUE_LIMIT
+        self.loop = loop
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.executor = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self):
+        return max(0, self.pending - self.workers)
+
+    async def run(self, fn, *args):
+        if self.queue_depth >= self.queue_limit:
+            self.rejected += 1
+            raise ClientError('server busy, try again shortly')
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.pending += 1
+        try:
+            result = await self.loop.run_in_executor(
+                self.executor, functools.partial(fn, *args))
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        return result
+
+    async def hash_password(self, plaintext_password):
+        return await self.run(hash_password, plaintext_password)
+
+    async def check_password(self, plaintext_password, password_hash):
+        return await self.run(check_password, plaintext_password, password_hash)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
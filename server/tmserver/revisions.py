@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import select
+import threading
+import uuid
+
+import psycopg2
+
+from .config import get_db
+
+CHANNEL = 'tildemush_revisions'
+
+
+class RevisionNotifier:
+    """Tells interested parties that a script has a new revision, so that game
+    objects only look for a new revision when there is one instead of on every
+    engine access.
+
+    publish() delivers to subscribers in this process right away and sends a
+    Postgres NOTIFY so that other server processes hear about it too; a
+    process that wants to hear from others calls listen(), which starts a
+    thread LISTENing on its own connection.
+
+    Subscribers are called with (script_id, revision_id). If the LISTEN
+    connection is lost, the thread keeps reconnecting, waiting retry_delay
+    seconds at first and doubling up to max_retry_delay. Anything published
+    while it was away is lost, so once it's back resync subscribers are
+    called (with no arguments) to assume any script may have changed."""
+    def __init__(self, channel=CHANNEL, retry_delay=1.0, max_retry_delay=60.0):
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # lets us ignore our own NOTIFYs when they come back around
+        self.origin = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        self.subscribers = []
+        self.resync_subscribers = []
+        self.listener = None
+        self._stopping = threading.Event()
+        self.published = 0
+        self.received = 0
+        self.reconnects = 0
+
+    def subscribe(self, fn):
+        self.subscribers.append(fn)
+        return fn
+
+    def subscribe_resync(self, fn):
+        self.resync_subscribers.append(fn)
+        return fn
+
+    def publish(self, script_id, revision_id):
+        """Should be called once the new revision is committed."""
+        self.published += 1
+        self._deliver(script_id, revision_id)
+        payload = json.dumps(dict(
+            origin=self.origin, script=script_id, revision=revision_id))
+        get_db().execute_sql('SELECT pg_notify(%s, %s)', (self.channel, payload))
+
+    def _deliver(self, script_id, revision_id):
+        for fn in self.subscribers:
+            fn(script_id, revision_id)
+
+    def handle_notify(self, payload):
+        message = json.loads(payload)
+        if message['origin'] == self.origin:
+            return
+        self.received += 1
+        self._deliver(message['script'], message['revision'])
+
+    def _resync(self):
+        for fn in self.resync_subscribers:
+            fn()
+
+    def listen(self):
+        if self.listener is not None:
+            return
+        self._stopping.clear()
+        self.listener = threading.Thread(
+            target=self._listen, name='tmrevisions', daemon=True)
+        self.listener.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self.listener is not None:
+            self.listener.join()
+            self.listener = None
+
+    def _connect(self):
+        db = get_db()
+        conn = psycopg2.connect(database=db.database, **db.connect_params)
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN {}'.format(self.channel))
+        return conn
+
+    def _listen(self):
+        logger = logging.getLogger('tmserver')
+        delay = self.retry_delay
+        connected_before = False
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                if connected_before:
+                    self.reconnects += 1
+                    logger.info('listening for revisions again')
+                    self._resync()
+                connected_before = True
+                delay = self.retry_delay
+                self._receive(conn)
+            except Exception as e:
+                logger.error(
+                    'lost revision notifications, reconnecting in {}s: {}'.format(delay, e))
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _receive(self, conn):
+        while not self._stopping.is_set():
+            if select.select([conn], [], [], 1) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    self.handle_notify(notify.payload)
+                except Exception as e:
+                    logging.getLogger('tmserver').error(
+                        'failed to handle revision notification {}: {}'.format(
+                            notify.payload, e))
+
+
+REVISIONS = RevisionNotifier()
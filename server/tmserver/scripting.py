@@ -1,49 +1,88 @@
+from collections import OrderedDict
+import copy
+import hashlib
+import importlib.util
 import io
+import json
+import marshal
 import os
+import threading
+import weakref
 
 import hy
+import peewee as pw
 
+from . import config
 from .config import get_db
 from .errors import ClientError, WitchError
+from .unit_of_work import current_unit
 from .util import split_args
 
 WITCH_HEADER = '(require [tmserver.witch_header [*]])'
 
-# Note an awful thing here; since we call .format on the script templates, we
-# have to escape the WITCH macro's {}. {{}} is not the Hy that we want, but we
-# need it in the templates.
-# TODO consider using shortname instead of name for the string passed to (witch)
+def _header_hash():
+    path = os.path.join(os.path.dirname(__file__), 'witch_header.hy')
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+# Persisted bytecode is only good for the hy and python that produced it and
+# for the WITCH macros it was expanded with.
+BYTECODE_VERSION = 'hy-{}-py-{}-witch-{}'.format(
+    hy.__version__, importlib.util.MAGIC_NUMBER.hex(), _header_hash())
+
+# The templates don't mention the object they're for: create_scripted_object
+# keeps name, description and the like in the new object's data, which (has
+# ...) defaults never overwrite. Every object made from a template then runs
+# the same code and shares one compiled engine (see EngineCache).
 SCRIPT_TEMPLATES = {
     'item': '''
-    (witch "{name}"
-      (has {{"name" "{name}"
-            "description" "{description}"}}))
+    (witch "item"
+      (has {"name" "an object"
+            "description" "a perfect gray sphere"}))
     ''',
     'player': '''
-    (witch "{name}"
-      (has {{"name" "{name}"
-            "description" "{description}"}}))
+    (witch "player"
+      (has {"name" "a player"
+            "description" "a gaseous cloud"}))
     ''',
     'room': '''
-    (witch "{name}"
-      (has {{"name" "{name}"
-            "description" "{description}"}}))
+    (witch "room"
+      (has {"name" "a room"
+            "description" "an empty room"}))
     ''',
     'exit': '''
-    (witch "{name}"
-      (has {{"name" "{name}"
-            "description" "{description}"}})
+    (witch "exit"
+      (has {"name" "an exit"
+            "description" "a way out"})
       (hears "go" (move-sender arg))),
     ''',
     'portkey': '''
-    (witch "{name}"
-      (has {{"name" "{name}"
-            "description" "{description}"
-            "target" "{target_room_name}"}})
+    (witch "portkey"
+      (has {"name" "a teleport stone"
+            "description" "a smooth stone"
+            "target" "god/foyer"})
       (hears "touch"
         (teleport-sender (get-data "target"))))
     '''}
 
+# Built in handlers that only do anything when the receiver is a player.
+PLAYER_ACTIONS = {'contain', 'say', 'announce', 'whisper'}
+
+
+def say_message(sender, action_args):
+    return '{} says, \"{}\"'.format(sender.name, action_args)
+
+
+def announce_message(sender, action_args):
+    return "The very air around you seems to shake as {}'s booming voice says {}".format(
+        sender.name, action_args)
+
+
+# What a player hears for these actions doesn't depend on the player, so
+# GameWorld builds the message once and hands it to every player that hasn't
+# scripted their own handler for the action.
+BROADCAST_MESSAGES = {'say': say_message, 'announce': announce_message}
+
 class ScriptEngine:
     CONTAIN_TYPES = {'acquired', 'entered', 'lost', 'freed'}
     def __init__(self):
@@ -52,6 +91,8 @@ class ScriptEngine:
                          'say': self._say_handler,
                          'announce': self._announce_handler,
                          'whisper': self._whisper_handler}
+        # the actions a script registered handlers for with (hears ...)
+        self.actions = set()
 
     @staticmethod
     def noop(*args, **kwargs):
@@ -77,13 +118,12 @@ class ScriptEngine:
 
     def _announce_handler(self, receiver, sender, action_args):
         if receiver.user_account:
-            msg = "The very air around you seems to shake as {}'s booming voice says {}".format(
-                sender.name, action_args)
+            msg = announce_message(sender, action_args)
             self.game_world.user_hears(receiver, sender, msg)
 
     def _say_handler(self, receiver, sender, action_args):
         if receiver.user_account:
-            msg = '{} says, \"{}\"'.format(sender.name, action_args)
+            msg = say_message(sender, action_args)
             self.game_world.user_hears(receiver, sender, msg)
 
     def _whisper_handler(self, receiver, sender, action_args):
@@ -93,11 +133,190 @@ class ScriptEngine:
 
     def add_handler(self, action, fn):
         self.handlers[action] = fn
+        self.actions.add(action)
 
     def handler(self, game_world, action):
         self._ensure_game_world(game_world)
         return self.handlers.get(action, self.noop)
 
+class ActionInterestIndex:
+    """For each container, which of the objects directly inside it handle
+    which actions. Broadcasting an action to a room then only touches the
+    objects that will do something with it instead of every object (and
+    engine) in the room.
+
+    A container's entry is built on first use and dropped when what it
+    contains changes (see ContainmentIndex.listeners) or when the engine of
+    something inside it changes."""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.by_container = {}
+            self.indexed_in = {}
+
+    def interested(self, container, action):
+        """Returns the objects directly inside container that handle
+        action."""
+        with self._lock:
+            entry = self.by_container.get(container.id)
+            if entry is None:
+                entry = self._build(container)
+            return list(entry.get(action, ()))
+
+    def _build(self, container):
+        entry = {}
+        for o in container.contains:
+            for action in o.handled_actions():
+                entry.setdefault(action, []).append(o)
+            self.indexed_in.setdefault(o.id, set()).add(container.id)
+        self.by_container[container.id] = entry
+        return entry
+
+    def invalidate(self, container_id):
+        """Forgets container_id's entry; None forgets everything."""
+        with self._lock:
+            if container_id is None:
+                self.clear()
+            else:
+                self.by_container.pop(container_id, None)
+
+    def object_changed(self, obj_id):
+        """Forgets the entries of everything obj_id was indexed inside of."""
+        with self._lock:
+            for container_id in self.indexed_in.pop(obj_id, ()):
+                self.by_container.pop(container_id, None)
+
+
+ACTION_INTEREST = ActionInterestIndex()
+
+
+def witch_namespace(ensure_obj_data):
+    return {'ScriptEngine': ScriptEngine,
+            'ensure_obj_data': ensure_obj_data}
+
+
+def compile_witch(script_text, namespace):
+    """Prepends the (witch) macro definition to script_text and then reads
+    and evals the combined code in namespace. Returns a tuple of the result of
+    the last form and the marshalled python code for every form, suitable for
+    handing to run_bytecode later."""
+    compiled = []
+    def keep_code(body, expr):
+        compiled.append((compile(body, '<witch_body>', 'exec'),
+                         compile(expr, '<witch>', 'eval')))
+
+    with_header = '{}\n{}'.format(WITCH_HEADER, script_text)
+    buff = io.StringIO(with_header)
+    stop = False
+    result = None
+    while not stop:
+        try:
+            tree = hy.read(buff)
+            result = hy.eval(tree,
+                             namespace=namespace,
+                             module_name=__name__,
+                             ast_callback=keep_code)
+        except EOFError:
+            stop = True
+    return result, marshal.dumps(compiled)
+
+
+def run_bytecode(bytecode, namespace):
+    """Runs code produced by compile_witch without involving hy at all."""
+    result = None
+    for body, expr in marshal.loads(bytecode):
+        exec(body, namespace)
+        result = eval(expr, namespace)
+    return result
+
+
+class EngineCache:
+    """A bounded LRU of compiled WITCH engines keyed by a hash of their code.
+
+    The handlers a witch script defines take their receiver as an argument, so
+    a compiled engine can be shared by every object running byte-identical
+    code. The only per-object part of compiling a script is the (has ...)
+    data, so we remember that alongside the engine and apply it to each object
+    that picks the engine up.
+
+    The objects holding an engine are remembered (weakly) too. When an entry
+    is evicted they let go of it, so that engines nobody has used lately can
+    be freed; they rebuild it on next use."""
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(code):
+        return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+    def get(self, code, holder=None):
+        """Returns (engine, data) for code or None. holder is the object that
+        is going to use the engine."""
+        key = self.key(code)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            engine, data, holders = entry
+            if holder is not None:
+                holders[id(holder)] = holder
+        return engine, data
+
+    def put(self, code, engine, data, holder=None):
+        key = self.key(code)
+        holders = weakref.WeakValueDictionary()
+        if holder is not None:
+            holders[id(holder)] = holder
+        evicted = []
+        with self._lock:
+            self.entries[key] = (engine, data, holders)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                evicted.append(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+        for engine, _, holders in evicted:
+            for obj in list(holders.values()):
+                obj.drop_engine(engine)
+
+    def clear(self):
+        with self._lock:
+            self.entries = OrderedDict()
+
+    @property
+    def stats(self):
+        return dict(
+            size=len(self.entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+ENGINE_CACHE = EngineCache(config.ENGINE_CACHE_SIZE)
+
+# functions called with (obj, keys) once keys of a game object's data have
+# been written, for things that keep copies of what's derived from them
+DATA_LISTENERS = []
+
+
+def data_changed(obj, keys):
+    for fn in DATA_LISTENERS:
+        fn(obj, keys)
+
+
 class ScriptedObjectMixin:
     """This database-less class implements the runtime behavior of a tildemush
     object. The GameObject represents all of the stuff that's persisted about a
@@ -114,6 +333,13 @@ class ScriptedObjectMixin:
     def get_template(cls, obj_type):
         return SCRIPT_TEMPLATES[obj_type]
 
+    # Set when we hear (see revisions.py) that our script may have a newer
+    # revision than the one our engine was built from.
+    _revision_pending = False
+
+    # Whether we've ever had an engine; ENGINE_CACHE can take it away again.
+    _engine_built = False
+
     @property
     def engine(self):
         # TODO sadness, a circular dependency got introduced here
@@ -122,8 +348,14 @@ class ScriptedObjectMixin:
         # smaller files; until then i'm going to be disgusting and add a
         # .latest_script_rev method to GameObject
         if not hasattr(self, '_engine'):
+            if not self._engine_built:
+                # a newer revision may have been announced before we were
+                # loaded (or while we were evicted, or to another process),
+                # so check once
+                self._revision_pending = True
             self.init_scripting()
-        else:
+        if self._revision_pending:
+            self._revision_pending = False
             with get_db().atomic():
                 # TODO this looks stupid and weird. Consider some kind of
                 # 'live_script_rev' that is probably just an alias for
@@ -141,7 +373,12 @@ class ScriptedObjectMixin:
                         # TODO log
                     else:
                         self.save()
-        return self._engine
+        engine = getattr(self, '_engine', None)
+        if engine is None:
+            # ENGINE_CACHE dropped it while we were looking
+            self.init_scripting()
+            engine = self._engine
+        return engine
 
     def init_scripting(self):
         if self.script_revision is None:
@@ -152,6 +389,23 @@ class ScriptedObjectMixin:
             except Exception as e:
                 raise WitchError(
                     ';_; There is a problem with your witch script: {}'.format(e))
+        self._engine_built = True
+        ACTION_INTEREST.object_changed(self.id)
+
+    def drop_engine(self, engine):
+        """Called by ENGINE_CACHE when it evicts engine."""
+        if self.__dict__.get('_engine') is engine:
+            self.__dict__.pop('_engine', None)
+
+    def handled_actions(self):
+        """Returns the set of actions that handle_action does something
+        for."""
+        if self.is_player_obj:
+            return self.engine.actions | PLAYER_ACTIONS
+        return self.engine.actions
+
+    def handles(self, action):
+        return action in self.handled_actions()
 
     def handle_action(self, game_world, sender_obj, action, action_args):
         self._ensure_world(game_world)
@@ -171,11 +425,67 @@ class ScriptedObjectMixin:
     # scripts. For now, eh.
     # lol this would have saved me some debugging earlier when i mixed up - and _
     def set_data(self, key, value):
-        self.data[key] = value
-        self.save()
+        unit = current_unit()
+        if unit is not None:
+            unit.write(self, key, value)
+            return
+        with get_db().atomic():
+            data = self._fetch_data()
+            data[key] = value
+            self._write_data(data, {key})
 
     def get_data(self, key, default=None):
-        return self.get_by_id(self.id).data.get(key, default)
+        unit = current_unit()
+        if unit is not None:
+            return unit.read(self).get(key, default)
+        return self._fetch_data().get(key, default)
+
+    def _fetch_data(self):
+        """Reads just this object's data column from the DB, refreshing
+        self.data with it."""
+        if self.id is None:
+            return self.data
+        cls = type(self)
+        data = cls.select(cls.data).where(cls.id==self.id).scalar()
+        self.data = data if data is not None else {}
+        return self.data
+
+    def _write_data(self, data, keys):
+        """Writes the given keys of data to this object's data column. Only
+        those keys are sent; the rest of the stored document is left alone."""
+        cls = type(self)
+        self.data = data
+        if not keys:
+            return
+        expr = pw.fn.COALESCE(cls.data, pw.Cast('{}', 'jsonb'))
+        for key in keys:
+            expr = pw.fn.jsonb_set(
+                expr,
+                pw.Value([key], unpack=False),
+                pw.Cast(json.dumps(data[key]), 'jsonb'))
+        cls.update(data=expr).where(cls.id==self.id).execute()
+        data_changed(self, keys)
+
+    def incr_data(self, key, amount=1):
+        """Atomically adds amount to the number stored under key (a missing
+        key counts as 0) and returns the result. Unlike a get-data/set-data
+        pair, concurrent increments can't clobber each other."""
+        unit = current_unit()
+        if unit is not None:
+            unit.settle(self, key)
+
+        cls = type(self)
+        cursor = get_db().execute_sql(
+            'UPDATE "{}" SET data = jsonb_set(COALESCE(data, \'{{}}\'), %s, '
+            'to_jsonb(COALESCE((data->>%s)::numeric, 0) + %s)) '
+            'WHERE id = %s RETURNING data->%s'.format(cls._meta.table_name),
+            ([key], key, amount, self.id, key))
+        value = cursor.fetchone()[0]
+
+        self.data[key] = value
+        if unit is not None:
+            unit.absorb(self, key, value)
+        return value
 
     def tell_sender(self, sender_obj, action, args):
         self.game_world.dispatch_action(sender_obj, action, args)
@@ -196,33 +506,66 @@ class ScriptedObjectMixin:
 
     def _execute_script(self, witch_code):
         """Given a pile of script revision code, this function prepends the
-        (witch) macro definition and then reads and evals the combined code."""
+        (witch) macro definition and then reads and evals the combined code.
+
+        Compiled engines are shared via ENGINE_CACHE; on a hit we only have to
+        apply the script's default data to this object. Failing that, we run
+        the revision's persisted bytecode if there is any and only fall back
+        to hy when there isn't."""
         script_text = self.script_revision.code
-        with_header = '{}\n{}'.format(WITCH_HEADER, script_text)
-        buff = io.StringIO(with_header)
-        stop = False
+        cached = ENGINE_CACHE.get(script_text, self)
+        if cached is not None:
+            engine, data = cached
+            self._ensure_data(copy.deepcopy(data))
+            return engine
+
+        defaults = {}
+        def ensure_obj_data(data):
+            defaults.update(copy.deepcopy(data))
+            self._ensure_data(data)
+
+        code_hash = ENGINE_CACHE.key(script_text)
         result = None
-        while not stop:
+        bytecode = self.script_revision.load_bytecode(BYTECODE_VERSION, code_hash)
+        if bytecode is not None:
             try:
-                tree = hy.read(buff)
-                result = hy.eval(tree,
-                                 namespace={'ScriptEngine': ScriptEngine,
-                                            'ensure_obj_data': lambda data: self._ensure_data(data)})
-            except EOFError:
-                stop = True
+                result = run_bytecode(bytecode, witch_namespace(ensure_obj_data))
+            except Exception:
+                # TODO log; we just recompile from source below.
+                bytecode = None
+
+        if bytecode is None:
+            result, bytecode = compile_witch(script_text, witch_namespace(ensure_obj_data))
+            if isinstance(result, ScriptEngine):
+                self.script_revision.store_bytecode(BYTECODE_VERSION, code_hash, bytecode)
+
+        if isinstance(result, ScriptEngine):
+            ENGINE_CACHE.put(script_text, result, defaults, self)
+
         return result
 
     def _ensure_data(self, data_mapping):
         """Given the default values for some gameobject's script, initialize
-        this object's data column to those defaults. Saves the instance."""
+        this object's data column to those defaults. Only missing keys are
+        written and keys already stored win over the defaults."""
         if data_mapping == {}:
             return
 
-        for k,v in data_mapping.items():
-            if k not in self.data:
-                self.data[k] = v
+        missing = {k: v for k, v in data_mapping.items() if k not in self.data}
+        if not missing:
+            return
+        self.data.update(missing)
+
+        if self.id is None:
+            self.save()
+            return
 
-        self.save()
+        cls = type(self)
+        cls.update(data=pw.Cast(json.dumps(missing), 'jsonb').concat(
+                                pw.fn.COALESCE(cls.data, pw.Cast('{}', 'jsonb'))))\
+           .where(cls.id==self.id)\
+           .execute()
+        data_changed(self, set(missing))
 
     def _ensure_world(self, game_world):
         if not hasattr(self, 'game_world'):
@@ -83,7 +83,8 @@ def state(event_loop):
         pytest.exit('Run tildemush tests with TILDEMUSH_ENV=test')
     reset_db()
     GameWorld.reset()
-    gs = GameServer(GameWorld, loop=event_loop, logger=mock.Mock(), port=5555)
+    # these tests count STATE messages, so send one for every update
+    gs = GameServer(GameWorld, loop=event_loop, logger=mock.Mock(), port=5555, state_tick=0)
     server_future = gs._get_ws_server()
     asyncio.ensure_future(server_future, loop=event_loop)
     yield
@@ -98,6 +99,32 @@ async def test_garbage(client):
 async def test_ping(client):
     await client.send('PING', ['PONG'])
 
+@pytest.mark.asyncio
+async def test_hello(client):
+    await client.send('HELLO {"capabilities": ["state-delta", "telepathy"]}',
+                      ['HELLO {"capabilities": ["state-delta"]}'])
+
+@pytest.mark.asyncio
+async def test_hello_malformed(client):
+    await client.send('HELLO state-delta', ['ERROR: failed to parse hello payload'])
+
+@pytest.mark.asyncio
+async def test_state_delta(client):
+    await client.send('HELLO {"capabilities": ["state-delta"]}', ['HELLO'])
+    await client.send('REGISTER vilmibm:foobarbazquux', ['REGISTER OK'])
+    await client.send('LOGIN vilmibm:foobarbazquux', ['LOGIN OK'])
+    msg = await client.assert_recv('STATE-DELTA')
+    payload = json.loads(msg[len('STATE-DELTA '):])
+    assert payload['version'] == 1
+    assert payload['base'] is None
+    assert payload['patch']['user']['username'] == 'vilmibm'
+
+    await client.send('RESYNC')
+    msg = await client.assert_recv('STATE-DELTA')
+    payload = json.loads(msg[len('STATE-DELTA '):])
+    assert payload['version'] == 2
+    assert payload['base'] is None
+
 @pytest.mark.asyncio
 async def test_registration_success(client):
     await client.send('REGISTER vilmibm:foobarbazquux', ['REGISTER OK'])
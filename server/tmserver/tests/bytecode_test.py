@@ -0,0 +1,54 @@
+from unittest import mock
+
+from ..migrations import _precompile, precompile_scripts
+from ..models import UserAccount, GameObject, ScriptBytecode
+from ..scripting import BYTECODE_VERSION, ENGINE_CACHE, ScriptEngine, run_bytecode, witch_namespace
+
+from .tm_test_case import TildemushTestCase
+
+class ScriptBytecodeTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        ENGINE_CACHE.clear()
+        self.vil = UserAccount.create(
+            username='vilmibm',
+            password='foobarbazquux')
+        self.banana = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/banana', 'item', dict(
+                name='A Banana',
+                description='Still green.'))
+
+    def test_bytecode_persisted(self):
+        rev = self.banana.script_revision
+        assert rev.load_bytecode(BYTECODE_VERSION, ENGINE_CACHE.key(rev.code)) is not None
+
+    def test_stale_bytecode_ignored(self):
+        rev = self.banana.script_revision
+        assert rev.load_bytecode(BYTECODE_VERSION, ENGINE_CACHE.key('(witch "other")')) is None
+        assert rev.load_bytecode('hy-0.0.0-py-0000', ENGINE_CACHE.key(rev.code)) is None
+
+    def test_init_skips_hy(self):
+        ENGINE_CACHE.clear()
+        with mock.patch('tmserver.scripting.hy.read') as m:
+            self.banana.init_scripting()
+        assert not m.called
+        assert isinstance(self.banana.engine, ScriptEngine)
+
+    def test_precompile_worker(self):
+        rev = self.banana.script_revision
+        rev_id, bytecode = _precompile((rev.id, rev.code))
+        assert rev_id == rev.id
+        seen = []
+        engine = run_bytecode(bytecode, witch_namespace(seen.append))
+        assert isinstance(engine, ScriptEngine)
+        assert seen == [dict(name='A Banana', description='Still green.')]
+
+    def test_precompile_bad_script(self):
+        assert _precompile((1, '(lol')) == (1, None)
+
+    def test_precompile_scripts(self):
+        ScriptBytecode.delete().execute()
+        compiled, failed = precompile_scripts(processes=1)
+        assert failed == 0
+        assert compiled == ScriptBytecode.select().count()
+        assert compiled > 0
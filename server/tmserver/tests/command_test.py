@@ -2,7 +2,7 @@ import unittest.mock as mock
 
 from ..errors import ClientError
 from ..models import UserAccount
-from ..core import GameServer, UserSession
+from ..core import GameServer, UserSession, LOOP
 from ..world import GameWorld
 
 from .tm_test_case import TildemushTestCase
@@ -15,7 +15,7 @@ class CommandTest(TildemushTestCase):
         self.user_session = UserSession(None, GameWorld, None)
         self.vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
         msg = 'LOGIN vilmibm:foobarbazquux'
-        self.server.handle_login(self.user_session, msg)
+        LOOP.run_until_complete(self.server.handle_login(self.user_session, msg))
 
     def test_parses_command(self):
         command_msgs = [
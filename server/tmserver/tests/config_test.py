@@ -0,0 +1,20 @@
+from ..config import get_db, MeteredPooledDatabase
+from ..models import BaseModel, UserAccount
+from .tm_test_case import TildemushTestCase
+
+class DatabaseHandleTest(TildemushTestCase):
+    def test_single_handle(self):
+        assert get_db() is get_db()
+        assert BaseModel._meta.database is get_db()
+        assert isinstance(get_db(), MeteredPooledDatabase)
+
+    def test_pool_stats(self):
+        db = get_db()
+        db.close()
+        checkouts = db.stats.checkouts
+        checkins = db.stats.checkins
+        UserAccount.select().count()
+        db.close()
+        assert db.stats.checkouts == checkouts + 1
+        assert db.stats.checkins == checkins + 1
+        assert db.stats.as_dict()['wait_max'] >= 0
@@ -1,4 +1,12 @@
-from ..models import UserAccount, GameObject, Contains
+from unittest import mock
+
+import peewee as pw
+
+from ..config import get_db
+from ..errors import MigrationError
+from ..migrations import duplicate_contains, init_db
+from ..models import UserAccount, GameObject, Contains, CONTAINMENT, LIVE_OBJECTS, ScriptRevision
+from ..scripting import ACTION_INTEREST
 from ..world import GameWorld
 
 from .tm_test_case import TildemushTestCase
@@ -91,6 +99,121 @@ class ContainTest(TildemushTestCase):
         assert [] == list(self.phone.contains)
         assert None == self.app.room
 
+    def test_index_matches_table(self):
+        GameWorld.put_into(self.room, self.phone)
+        GameWorld.put_into(self.phone, self.app)
+        GameWorld.put_into(self.room, self.app)
+        assert CONTAINMENT.inners_of(self.room.id) == [self.phone.id, self.app.id]
+        assert CONTAINMENT.outers_of(self.app.id) == [self.room.id]
+        assert CONTAINMENT.inners_of(self.phone.id) == []
+
+        CONTAINMENT.clear()
+        assert CONTAINMENT.inners_of(self.room.id) == [self.phone.id, self.app.id]
+        assert CONTAINMENT.outers_of(self.app.id) == [self.room.id]
+
+        GameWorld.remove_from(self.room, self.app)
+        assert self.app.room is None
+        assert [self.phone] == list(self.room.contains)
+
+    def test_rollback_undoes_index_changes(self):
+        GameWorld.put_into(self.room, self.phone)
+        with self.assertRaises(RuntimeError):
+            with get_db().atomic():
+                ghost = GameObject.create_scripted_object(
+                    author=self.vil,
+                    shortname='ghost')
+                GameWorld.put_into(self.room, ghost)
+                GameWorld.remove_from(self.room, self.phone)
+                raise RuntimeError('a contain handler blew up')
+        assert LIVE_OBJECTS.get(ghost.id) is None
+        assert CONTAINMENT.inners_of(self.room.id) == [self.phone.id]
+        assert [self.phone] == list(self.room.contains)
+
+    def test_savepoint_rollback_undoes_index_changes(self):
+        with get_db().atomic():
+            GameWorld.put_into(self.room, self.phone)
+            with self.assertRaises(RuntimeError):
+                with get_db().atomic():
+                    GameWorld.put_into(self.room, self.app)
+                    raise RuntimeError('a contain handler blew up')
+        assert CONTAINMENT.inners_of(self.room.id) == [self.phone.id]
+        CONTAINMENT.clear()
+        assert CONTAINMENT.inners_of(self.room.id) == [self.phone.id]
+
+    def test_interested_objects(self):
+        player_obj = self.vil.player_obj
+        horse = GameObject.create_scripted_object(
+            author=self.vil,
+            shortname='horse')
+        horse.script_revision = ScriptRevision.create(
+            script=horse.script_revision.script,
+            code='(witch "horse" (has {"name" "horse"}) (hears "pet" (says "neigh")))')
+        horse.save()
+        horse.init_scripting()
+        assert horse.engine.actions == {'pet'}
+
+        GameWorld.put_into(self.room, player_obj)
+        GameWorld.put_into(self.room, self.phone)
+        assert GameWorld.interested_objects(player_obj, 'pet') == set()
+        assert GameWorld.interested_objects(player_obj, 'say') == {player_obj}
+
+        GameWorld.put_into(self.room, horse)
+        assert GameWorld.interested_objects(player_obj, 'pet') == {horse}
+
+        GameWorld.put_into(player_obj, horse)
+        assert GameWorld.interested_objects(player_obj, 'pet') == {horse}
+        assert ACTION_INTEREST.interested(self.room, 'pet') == []
+
+    def test_listeners(self):
+        session = mock.Mock()
+        GameWorld.register_session(self.vil, session)
+        player_obj = self.vil.player_obj
+        foyer = GameObject.by_shortname('god/foyer')
+        assert GameWorld.listeners(foyer) == [(player_obj, session)]
+
+        GameWorld.put_into(self.room, self.phone)
+        GameWorld.put_into(self.room, player_obj)
+        assert GameWorld.listeners(foyer) == []
+        assert GameWorld.listeners(self.room) == [(player_obj, session)]
+
+        GameWorld.unregister_session(self.vil)
+        assert GameWorld.listeners(self.room) == []
+
+    def test_say_is_built_once(self):
+        snoozy = UserAccount.create(
+            username='snoozy',
+            password='foobarbazquux')
+        vil_session = mock.Mock()
+        snoozy_session = mock.Mock()
+        GameWorld.register_session(self.vil, vil_session)
+        GameWorld.register_session(snoozy, snoozy_session)
+        snoozy_session.handle_hears.assert_not_called()
+        vil_session.handle_hears.assert_called_once_with(
+            snoozy.player_obj, 'snoozy fades in.')
+
+        GameWorld.dispatch_action(self.vil.player_obj, 'say', 'hi')
+        vil_hears = vil_session.handle_hears.call_args[0]
+        snoozy_hears = snoozy_session.handle_hears.call_args[0]
+        assert snoozy_hears == (self.vil.player_obj, 'vilmibm says, "hi"')
+        assert vil_hears[1] is snoozy_hears[1]
+
+    def test_contains_is_unique(self):
+        GameWorld.put_into(self.room, self.phone)
+        assert [] == duplicate_contains()
+        with self.assertRaises(pw.IntegrityError):
+            with get_db().atomic():
+                Contains.create(outer_obj=self.room, inner_obj=self.phone)
+
+    def test_init_db_reports_duplicates(self):
+        # what a database from before the unique index could hold
+        GameWorld.put_into(self.room, self.phone)
+        for index in get_db().get_indexes('contains'):
+            if index.unique and index.columns == ['outer_obj_id', 'inner_obj_id']:
+                get_db().execute_sql('DROP INDEX "{}"'.format(index.name))
+        Contains.insert(outer_obj=self.room, inner_obj=self.phone).execute()
+        with self.assertRaisesRegex(MigrationError, 'duplicate contains rows'):
+            init_db()
+
     def test_all_active_objects(self):
         player_obj = self.vil.player_obj
         cigar = GameObject.create_scripted_object(
@@ -0,0 +1,96 @@
+import asyncio
+import copy
+from unittest import mock
+
+from ..core import UserSession
+from ..delta import apply_patch, diff
+from ..world import GameWorld
+from .tm_test_case import TildemushUnitTestCase
+
+STATE = {
+    'motd': 'welcome to tildemush',
+    'room': {
+        'name': 'foyer',
+        'shortname': 'god/foyer',
+        'contains': [
+            dict(name='a horse', shortname='vilmibm/horse', description='neigh'),
+            dict(name='a lamp', shortname='vilmibm/lamp', description='unlit')],
+        'exits': {'north': {'exit_name': 'door', 'room_name': 'hall'}},
+    },
+    'inventory': [
+        dict(name='a bag', shortname='vilmibm/bag', description='a bag', contains=[])],
+}
+
+
+class DiffTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.new = copy.deepcopy(STATE)
+
+    def test_unchanged(self):
+        assert diff(STATE, self.new) is None
+
+    def test_only_changed_items(self):
+        self.new['room']['contains'][1]['description'] = 'lit'
+        patch = diff(STATE, self.new)
+        assert patch == {'room': {'contains': {
+            '~keyed': 'shortname',
+            'items': {'vilmibm/lamp': {'description': 'lit'}}}}}
+        assert apply_patch(STATE, patch) == self.new
+
+    def test_moved_item(self):
+        horse = self.new['room']['contains'].pop(0)
+        horse['contains'] = []
+        self.new['inventory'][0]['contains'].append(horse)
+        del self.new['room']['exits']['north']
+        patch = diff(STATE, self.new)
+        assert patch['room']['contains']['order'] == ['vilmibm/lamp']
+        assert patch['room']['exits'] == {'north': None}
+        assert apply_patch(STATE, patch) == self.new
+
+    def test_whole_state(self):
+        assert apply_patch({}, STATE) == STATE
+
+
+class StateDeltaSessionTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.session = UserSession(self.loop, GameWorld, mock.Mock(), logger=mock.Mock())
+        self.session.user_account = mock.Mock()
+        self.sent = []
+        self.session.send = self.sent.append
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_negotiate(self):
+        assert self.session.negotiate(['state-delta', 'telepathy']) == {'state-delta'}
+
+    def test_full_state_without_capability(self):
+        self.session.handle_client_update(STATE)
+        assert self.sent == [('STATE', STATE)]
+
+    def test_deltas(self):
+        self.session.negotiate(['state-delta'])
+        self.session.handle_client_update(STATE)
+        new = copy.deepcopy(STATE)
+        new['room']['name'] = 'lobby'
+        self.session.handle_client_update(new)
+        self.session.handle_client_update(new)
+
+        assert len(self.sent) == 2
+        assert [kind for kind, _ in self.sent] == ['STATE-DELTA', 'STATE-DELTA']
+        first, second = [payload for _, payload in self.sent]
+        assert first == dict(version=1, base=None, patch=STATE)
+        assert second == dict(version=2, base=1, patch={'room': {'name': 'lobby'}})
+
+    def test_resync(self):
+        self.session.negotiate(['state-delta'])
+        self.session.game_world = mock.Mock()
+        self.session.game_world.client_state.return_value = STATE
+        self.session.handle_client_update(STATE)
+        self.session.resync()
+
+        kind, resent = self.sent[-1]
+        assert resent == dict(version=2, base=None, patch=STATE)
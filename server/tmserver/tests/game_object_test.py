@@ -3,10 +3,11 @@ from unittest import mock
 from .. import models
 from ..errors import WitchError
 from ..models import UserAccount, GameObject, Contains, Script, ScriptRevision
-from ..scripting import ScriptEngine
+from ..scripting import ScriptEngine, EngineCache, ENGINE_CACHE
+from ..unit_of_work import unit_of_work
 from ..world import GameWorld
 
-from .tm_test_case import TildemushTestCase
+from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
 
 class FuzzyMatchTest(TildemushTestCase):
     def setUp(self):
@@ -116,6 +117,54 @@ class GameObjectDataTest(TildemushTestCase):
         self.snoozy.set_data('num_pets', self.snoozy.get_data('num_pets') + 1)
         assert 1 == GameObject.get_by_id(self.snoozy.id).get_data('num_pets')
 
+    def stored_data(self):
+        return GameObject.select(GameObject.data)\
+                         .where(GameObject.id==self.snoozy.id)\
+                         .scalar()
+
+    def test_set_data_only_writes_key(self):
+        self.snoozy._ensure_data({'num_pets': 0, 'aw': 'yis'})
+        GameObject.update(data={'num_pets': 0, 'aw': 'nah'})\
+                  .where(GameObject.id==self.snoozy.id).execute()
+        self.snoozy.data['aw'] = 'stale'
+        with unit_of_work():
+            self.snoozy.set_data('num_pets', 1)
+            self.snoozy.data['aw'] = 'stale'
+        assert {'num_pets': 1, 'aw': 'nah'} == self.stored_data()
+
+    def test_incr_data(self):
+        assert 1 == self.snoozy.incr_data('num_pets')
+        assert 4 == self.snoozy.incr_data('num_pets', 3)
+        assert 4 == self.stored_data()['num_pets']
+        with unit_of_work():
+            self.snoozy.set_data('num_pets', 10)
+            assert 11 == self.snoozy.incr_data('num_pets')
+            assert 11 == self.snoozy.get_data('num_pets')
+        assert 11 == self.stored_data()['num_pets']
+
+    def test_unit_of_work(self):
+        self.snoozy._ensure_data({'num_pets': 0, 'aw': 'yis'})
+        with unit_of_work() as unit:
+            with mock.patch('tmserver.models.GameObject.select',
+                            wraps=GameObject.select) as select_m:
+                assert 0 == self.snoozy.get_data('num_pets')
+                self.snoozy.set_data('num_pets', 1)
+                assert 1 == self.snoozy.get_data('num_pets')
+                assert 'yis' == self.snoozy.get_data('aw')
+            assert 1 == select_m.call_count
+            assert 0 == self.stored_data()['num_pets']
+            with unit_of_work() as inner_unit:
+                assert inner_unit is unit
+        assert 1 == self.stored_data()['num_pets']
+        assert 'yis' == self.stored_data()['aw']
+
+    def test_unit_of_work_flushes_on_error(self):
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                self.snoozy.set_data('num_pets', 5)
+                raise ValueError()
+        assert 5 == self.stored_data()['num_pets']
+
     def test_handles_new_default_keys(self):
         some_data = {
             'smoked': False,
@@ -144,7 +193,7 @@ class GameObjectComparisonTest(TildemushTestCase):
         self.snoozy = GameObject.create_scripted_object(
             author=self.vil,
             shortname='snoozy',
-            format_dict=dict(
+            data=dict(
                 name='snoozy',
                 description='a horse'))
 
@@ -156,9 +205,13 @@ class GameObjectComparisonTest(TildemushTestCase):
         snoozy = GameObject.get_by_id(self.snoozy.id)
         assert snoozy == self.snoozy
 
+        # GameObject.get always hands back the live instance, so build a
+        # detached copy to compare against.
         revision = ScriptRevision.create(code='(witch)', script=self.snoozy.script_revision.script)
-        snoozy = GameObject.get_by_id(self.snoozy.id)
-        snoozy.script_revision = revision
+        snoozy = GameObject(
+            author=self.snoozy.author,
+            shortname=self.snoozy.shortname,
+            script_revision=revision)
         assert snoozy != self.snoozy
 
     def test_hash_operations(self):
@@ -166,8 +219,10 @@ class GameObjectComparisonTest(TildemushTestCase):
         assert snoozy.__hash__() == self.snoozy.__hash__()
 
         revision = ScriptRevision.create(code='(witch)', script=self.snoozy.script_revision.script)
-        snoozy = GameObject.get_by_id(self.snoozy.id)
-        snoozy.script_revision = revision
+        snoozy = GameObject(
+            author=self.snoozy.author,
+            shortname=self.snoozy.shortname,
+            script_revision=revision)
         assert snoozy.__hash__() != self.snoozy.__hash__()
 
 
@@ -237,3 +292,66 @@ class GameObjectScriptEngineTest(TildemushTestCase):
         with mock.patch('tmserver.scripting.ScriptEngine.noop') as mock_noop:
             self.snoozy.handle_action(GameWorld, 'poke', self.vil, [])
             assert mock_noop.called
+
+
+class EngineCacheTest(TildemushUnitTestCase):
+    def test_lru(self):
+        cache = EngineCache(2)
+        cache.put('(witch "a")', 'a', {})
+        cache.put('(witch "b")', 'b', {})
+        assert cache.get('(witch "a")') == ('a', {})
+        cache.put('(witch "c")', 'c', {})
+        assert cache.get('(witch "b")') is None
+        assert cache.get('(witch "a")') == ('a', {})
+        assert cache.stats == dict(size=2, hits=2, misses=1, evictions=1)
+
+
+class SharedEngineTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        ENGINE_CACHE.clear()
+        self.vil = UserAccount.create(
+            username='vilmibm',
+            password='foobarbazquux')
+
+    def test_template_shares_engine(self):
+        banana = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/banana', 'item', dict(
+                name='A Banana', description='Still green.'))
+        hits = ENGINE_CACHE.hits
+        apple = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/apple', 'item', dict(
+                name='An Apple', description='Quite red.'))
+        assert ENGINE_CACHE.hits == hits + 1
+        assert banana.engine is apple.engine
+        assert apple.data == dict(name='An Apple', description='Quite red.')
+        assert banana.name == 'A Banana'
+
+    def test_eviction_drops_engine(self):
+        banana = GameObject.create_scripted_object(
+            self.vil, 'vilmibm/banana', 'item', dict(
+                name='A Banana', description='Still green.'))
+        engine = banana.engine
+        with mock.patch.object(ENGINE_CACHE, 'size', 0):
+            ENGINE_CACHE.put('(witch "other")', ScriptEngine(), {})
+        assert '_engine' not in banana.__dict__
+        assert banana.engine is not engine
+        assert banana.engine.handlers.keys() == engine.handlers.keys()
+
+    def test_data_not_shared(self):
+        code = '''
+            (witch "horse"
+              (has {"pets" []}))'''
+        horses = []
+        for shortname in ('snoozy', 'dozy'):
+            script = Script.create(name=shortname, author=self.vil)
+            rev = ScriptRevision.create(script=script, code=code)
+            horse = GameObject.create(
+                author=self.vil,
+                shortname=shortname,
+                script_revision=rev)
+            horse.init_scripting()
+            horses.append(horse)
+        snoozy, dozy = horses
+        snoozy.data['pets'].append('vilmibm')
+        assert dozy.data['pets'] == []
@@ -0,0 +1,58 @@
+from unittest import mock
+
+from ..models import UserAccount, GameObject, LIVE_OBJECTS
+from ..world import GameWorld
+
+from .tm_test_case import TildemushTestCase
+
+class IdentityMapTest(TildemushTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vil = UserAccount.create(
+            username='vilmibm',
+            password='foobarbazquux')
+        self.room = GameObject.create_scripted_object(
+            author=self.vil,
+            shortname='foul-foyer',
+            obj_type='room')
+        self.phone = GameObject.create_scripted_object(
+            author=self.vil,
+            shortname='pixel-2')
+
+    def test_get_returns_live_object(self):
+        assert GameObject.get_by_id(self.phone.id) is self.phone
+        assert GameObject.get(GameObject.shortname=='pixel-2') is self.phone
+        assert GameObject.get_or_none(GameObject.shortname=='pixel-2') is self.phone
+
+    def test_by_shortname(self):
+        assert GameObject.by_shortname('pixel-2') is self.phone
+        assert GameObject.by_shortname('pixel-3') is None
+
+    def test_by_id(self):
+        assert GameObject.by_id(self.room.id) is self.room
+
+    def test_refreshes_from_db(self):
+        GameObject.update(data={'name': 'a pager'})\
+                  .where(GameObject.id==self.phone.id).execute()
+        assert GameObject.get_by_id(self.phone.id).data == {'name': 'a pager'}
+        assert self.phone.data == {'name': 'a pager'}
+
+    def test_containment_returns_live_objects(self):
+        GameWorld.put_into(self.room, self.phone)
+        assert list(self.room.contains)[0] is self.phone
+        assert list(self.phone.contained_by)[0] is self.room
+        assert self.phone.room is self.room
+
+    def test_engine_survives_queries(self):
+        engine = self.phone.engine
+        GameWorld.put_into(self.room, self.phone)
+        with mock.patch('tmserver.scripting.ScriptedObjectMixin.init_scripting') as m:
+            for o in self.room.contains:
+                o.engine
+        assert not m.called
+        assert list(self.room.contains)[0].engine is engine
+
+    def test_cleared_on_reset(self):
+        assert len(LIVE_OBJECTS) > 0
+        LIVE_OBJECTS.clear()
+        assert GameObject.by_id(self.phone.id) is not self.phone
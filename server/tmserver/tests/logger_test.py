@@ -1,3 +1,4 @@
+from datetime import datetime
 import logging
 import unittest.mock as mock
 import unittest
@@ -14,25 +15,68 @@ class TestPGHandler(TildemushTestCase):
         self.mock_log_record = mock.Mock()
         self.mock_log_record.getMessage.return_value = 'sweet'
         self.mock_log_record.levelname = 'INFO'
+        self.mock_log_record.created = 1525000000.5
+
+    def tearDown(self):
+        self.pgh.close()
 
     def test_respects_env(self):
         self.assertEqual('test', self.pgh.env)
 
     def test_sets_created_at(self):
         self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
         logs = Log.select()
-        self.assertIsNotNone(logs[0].created_at)
+        self.assertEqual(logs[0].created_at, datetime(2018, 4, 29, 11, 6, 40, 500000))
 
     def test_levels(self):
         self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
         logs = Log.select()
         self.assertEqual(logs[0].level, 'INFO')
 
     def test_msg(self):
         self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
         logs = Log.select()
         self.assertEqual(logs[0].raw, 'sweet')
 
+    def test_batches(self):
+        self.pgh.batch_size = 2
+        for _ in range(5):
+            self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
+        self.assertEqual(5, Log.select().count())
+        self.assertEqual(5, self.pgh.written)
+
+    def test_truncates_long_messages(self):
+        self.mock_log_record.getMessage.return_value = 'REVISION ' + 'x' * 1000
+        self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
+        self.assertEqual(Log.raw.max_length, len(Log.select()[0].raw))
+        self.assertEqual(0, self.pgh.failed)
+
+    def test_bad_row_spares_batch(self):
+        bad_record = mock.Mock()
+        bad_record.getMessage.return_value = 'sour'
+        bad_record.levelname = None
+        bad_record.created = 1525000000.5
+        self.pgh.emit(self.mock_log_record)
+        self.pgh.emit(bad_record)
+        self.pgh.emit(self.mock_log_record)
+        self.pgh.flush()
+        self.assertEqual(2, Log.select().count())
+        self.assertEqual(2, self.pgh.written)
+        self.assertEqual(1, self.pgh.failed)
+
+    def test_drops_when_full(self):
+        pgh = PGHandler(buffer_size=2, flush_interval=60)
+        for _ in range(3):
+            pgh.emit(self.mock_log_record)
+        self.assertEqual(1, pgh.dropped)
+        pgh.close()
+        self.assertEqual(2, Log.select().count())
+
 
 class TestLogging(TildemushUnitTestCase):
     def test_debug_ignores_pg(self):
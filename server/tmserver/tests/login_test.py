@@ -3,7 +3,7 @@ import unittest
 
 from ..errors import ClientError
 from ..models import UserAccount
-from ..core import GameServer, UserSession
+from ..core import GameServer, UserSession, LOOP
 from ..world import GameWorld
 
 from .tm_test_case import TildemushTestCase
@@ -37,7 +37,7 @@ class TestLogin(TildemushTestCase):
         with self.assertRaisesRegex(
                 ClientError,
                 'no such user'):
-            self.server.handle_login(UserSession(None, GameWorld, None), msg)
+            LOOP.run_until_complete(self.server.handle_login(UserSession(None, GameWorld, None), msg))
 
     def test_bad_password(self):
         vil = UserAccount.create(username='vilmibm', password='12345678901')
@@ -45,13 +45,13 @@ class TestLogin(TildemushTestCase):
         with self.assertRaisesRegex(
                 ClientError,
                 'bad password'):
-            self.server.handle_login(UserSession(None, GameWorld, None), msg)
+            LOOP.run_until_complete(self.server.handle_login(UserSession(None, GameWorld, None), msg))
 
     def test_success(self):
         user_session = UserSession(None, GameWorld, None)
         vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
         msg = 'LOGIN vilmibm:foobarbazquux'
-        self.server.handle_login(user_session, msg)
+        LOOP.run_until_complete(self.server.handle_login(user_session, msg))
         self.assertTrue(user_session.associated)
         self.assertEqual(user_session.user_account.username, 'vilmibm')
         self.assertEqual('UserSession<vilmibm>', str(user_session))
@@ -64,4 +64,4 @@ class TestLogin(TildemushTestCase):
         with self.assertRaisesRegex(
                 ClientError,
                 'log out first'):
-            self.server.handle_login(user_session, 'LOGIN vilmibm:foobarbazquux')
+            LOOP.run_until_complete(self.server.handle_login(user_session, 'LOGIN vilmibm:foobarbazquux'))
@@ -1,8 +1,11 @@
+import asyncio
 from unittest.mock import Mock
+
+from ..errors import ClientError
 from ..migrations import reset_db
 from ..models import GameObject
 from ..world import GameWorld
-from ..mapping import from_room, graph_easy
+from ..mapping import MAP_CACHE, MapCache, MapRenderPool, edges_from_room, from_room, graph_easy, grid_map, render_map
 from .tm_test_case import TildemushUnitTestCase
 
 RENDERED_MAP = '''                      ┌────────────────┐         ┌─────────────┐  north   ┌───────────┐  north   ┌───────────────────────┐
@@ -37,6 +40,19 @@ RENDERED_MAP = '''                      ┌────────────
                                                  └─────────────┘
 '''
 
+GRID_MAP = '''┌────┐  west   ┌───┐  east   ┌───┐  above  ┌───┐
+│ Bb │ <────── │ A │ ──────> │ C │ ──────> │ E │
+└────┘         └───┘         └───┘         └───┘
+                 │
+                 │ south
+                 ∨
+               ┌───┐
+               │ D │
+               └───┘
+
+C --north--> D
+'''
+
 class TestMapping(TildemushUnitTestCase):
     @classmethod
     def tearDownClass(cls):
@@ -181,3 +197,102 @@ class TestMapping(TildemushUnitTestCase):
         mapfile = from_room(GameWorld, self.foyer, distance=2)
         rendered = graph_easy(mapfile)
         assert rendered == RENDERED_MAP
+
+    def test_grid_map(self):
+        edges = [('A', 'west', 'Bb'), ('A', 'east', 'C'), ('A', 'south', 'D'),
+                 ('C', 'north', 'D'), ('C', 'above', 'E')]
+        assert grid_map(edges, 'A') == GRID_MAP
+
+    def test_grid_map_lone_room(self):
+        assert grid_map([], 'Foyer') == '┌───────┐\n│ Foyer │\n└───────┘\n'
+
+    def test_edges_from_room_distance(self):
+        edges = edges_from_room(GameWorld, self.foyer, 0)
+        assert edges
+        assert {from_room for from_room, _, _ in edges} == {'Foyer'}
+
+    def test_render_map_native(self):
+        rendered = render_map(GameWorld, self.foyer, distance=2, renderer='native')
+        for _, _, to_room in edges_from_room(GameWorld, self.foyer, 2):
+            assert to_room in rendered
+
+    def test_render_map_cached(self):
+        MAP_CACHE.clear()
+        first = render_map(GameWorld, self.foyer, distance=2, renderer='native')
+        hits = MAP_CACHE.hits
+        assert render_map(GameWorld, self.foyer, distance=2, renderer='native') is first
+        assert MAP_CACHE.hits == hits + 1
+
+    def test_render_map_rename_invalidates(self):
+        MAP_CACHE.clear()
+        basement = GameObject.get(GameObject.shortname=='god/basement')
+        render_map(GameWorld, self.foyer, distance=2, renderer='native')
+        basement.set_data('name', 'Cellar')
+        try:
+            assert 'Cellar' in render_map(GameWorld, self.foyer, distance=2, renderer='native')
+        finally:
+            basement.set_data('name', 'Basement')
+        assert 'Cellar' not in render_map(GameWorld, self.foyer, distance=2, renderer='native')
+
+
+class TestMapCache(TildemushUnitTestCase):
+    def test_invalidates_dependents(self):
+        cache = MapCache(10)
+        cache.put((1, 2, 'native'), 'foyer map', {1, 2}, 0)
+        cache.put((3, 2, 'native'), 'attic map', {3}, 0)
+        cache.invalidate(2)
+        assert cache.get((1, 2, 'native')) is None
+        assert cache.get((3, 2, 'native')) == 'attic map'
+
+    def test_skips_stale_render(self):
+        cache = MapCache(10)
+        generation = cache.generation
+        cache.invalidate(2)
+        cache.put((1, 2, 'native'), 'foyer map', {1}, generation)
+        assert len(cache) == 0
+
+    def test_everything_changed(self):
+        cache = MapCache(10)
+        cache.put((1, 2, 'native'), 'foyer map', {1, 2}, 0)
+        cache.room_changed(None)
+        assert len(cache) == 0
+        assert cache.dependents == {}
+
+    def test_bounded(self):
+        cache = MapCache(2)
+        for room in ('a', 'b', 'c'):
+            cache.put((room, 2, 'native'), room, {room}, 0)
+        assert cache.get(('a', 2, 'native')) is None
+        assert len(cache) == 2
+        assert 'a' not in cache.dependents
+
+
+class TestMapRenderPool(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_render(self):
+        pool = MapRenderPool(self.loop, command=['cat'])
+        rendered = self.loop.run_until_complete(pool.render('[ Foyer ]'))
+        assert rendered == '[ Foyer ]'
+        assert pool.renders == 1
+
+    def test_timeout(self):
+        pool = MapRenderPool(self.loop, timeout=0.1, command=['sleep', '5'])
+        with self.assertRaisesRegex(ClientError, 'too long'):
+            self.loop.run_until_complete(pool.render(''))
+        assert pool.timeouts == 1
+
+    def test_queue_limit(self):
+        pool = MapRenderPool(self.loop, workers=1, queue_limit=1, command=['cat'])
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[pool.render(str(i)) for i in range(3)],
+            loop=self.loop, return_exceptions=True))
+        assert results[:2] == ['0', '1']
+        assert isinstance(results[2], ClientError)
+        assert pool.rejected == 1
+        assert pool.max_wait > 0
@@ -1,7 +1,7 @@
 import unittest.mock as mock
 from ..core import GameServer, UserSession
 from ..errors import UserError
-from ..models import UserAccount, GameObject, Contains
+from ..models import ROOM_GRAPH, UserAccount, GameObject, Contains, Exit
 from ..world import GameWorld
 
 from .tm_test_case import TildemushTestCase
@@ -89,3 +89,79 @@ class MoveTest(TildemushTestCase):
 
         GameWorld.handle_go(player_obj, 'n')
         assert self.cabin == player_obj.room
+
+    def test_exit_rows(self):
+        player_obj = self.same.player_obj
+        GameWorld.put_into(self.cabin, player_obj)
+        ladder = GameWorld.create_exit(player_obj, 'ladder', 'above roof a ladder')
+
+        rows = set(Exit.select(Exit.room, Exit.direction, Exit.target)\
+                       .where(Exit.exit_obj==ladder)\
+                       .tuples())
+        assert rows == {(self.cabin.id, 'above', self.roof.id),
+                        (self.roof.id, 'below', self.cabin.id)}
+
+        # rewriting the route moves the rows and the way out along with it
+        ladder.set_data('exit', {'cabin': ('north', 'roof'),
+                                 'roof': ('south', 'cabin')})
+        assert Exit.select().where(Exit.exit_obj==ladder,
+                                   Exit.direction=='above').count() == 0
+        with self.assertRaisesRegex(UserError, 'cannot go that way'):
+            GameWorld.handle_go(player_obj, 'above')
+
+        # and they're what the room graph is loaded from
+        ROOM_GRAPH.clear()
+        GameWorld.handle_go(player_obj, 'north')
+        assert self.roof == player_obj.room
+
+    def test_path_and_travel(self):
+        player_obj = self.same.player_obj
+        GameWorld.put_into(self.cabin, player_obj)
+        GameWorld.create_exit(player_obj, 'bridge', 'east pond a bridge')
+        GameWorld.handle_go(player_obj, 'east')
+        GameWorld.create_exit(player_obj, 'ladder', 'above roof a ladder')
+        GameWorld.handle_go(player_obj, 'west')
+
+        with mock.patch('tmserver.world.GameWorld.user_hears') as mock_hears:
+            GameWorld.dispatch_action(player_obj, 'path', 'roof')
+            mock_hears.assert_called_once_with(
+                player_obj, player_obj, 'To get to roof, go east, above (2 moves).')
+
+        with self.assertRaisesRegex(UserError, 'cannot find a way'):
+            GameWorld.dispatch_action(player_obj, 'path', 'yard')
+        with self.assertRaisesRegex(UserError, 'Could not find'):
+            GameWorld.dispatch_action(player_obj, 'path', 'nowhere')
+
+        GameWorld.dispatch_action(player_obj, 'travel', 'roof')
+        assert self.roof == player_obj.room
+
+        # a new exit makes for a shorter way back
+        GameWorld.create_exit(player_obj, 'slide', 'west cabin a slide')
+        assert [d for d, _, _ in GameWorld.find_path(self.roof, self.cabin)] == ['west']
+
+    def test_travel_stops_at_failed_step(self):
+        player_obj = self.same.player_obj
+        GameWorld.put_into(self.cabin, player_obj)
+        GameWorld.create_exit(player_obj, 'bridge', 'east pond a bridge')
+        GameWorld.handle_go(player_obj, 'east')
+        GameWorld.create_exit(player_obj, 'ladder', 'above roof a ladder')
+        GameWorld.handle_go(player_obj, 'west')
+
+        go = GameWorld.handle_go
+        def broken_ladder(sender_obj, direction):
+            if direction == 'above':
+                raise KeyError('broken ladder')
+            go(sender_obj, direction)
+
+        with mock.patch('tmserver.world.GameWorld.handle_go', side_effect=broken_ladder), \
+             mock.patch('tmserver.world.GameWorld.user_hears') as mock_hears, \
+             mock.patch('tmserver.world.logging.getLogger') as mock_logger:
+            GameWorld.dispatch_action(player_obj, 'travel', 'roof')
+        assert self.pond == player_obj.room
+        # the step that worked stuck
+        assert [c.outer_obj.id for c in Contains.select().where(
+            Contains.inner_obj == player_obj)] == [self.pond.id]
+        mock_hears.assert_any_call(
+            player_obj, player_obj, 'Something went wrong going above.')
+        assert mock_logger.return_value.exception.called
+        mock_hears.assert_any_call(player_obj, player_obj, 'You stop short of roof.')
@@ -0,0 +1,51 @@
+import asyncio
+
+from ..errors import ClientError
+from ..passwords import PasswordPool, hash_password, check_password
+from .tm_test_case import TildemushUnitTestCase
+
+
+class PasswordPoolTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_round_trip(self):
+        pool = PasswordPool(self.loop, workers=2)
+        password_hash = self.loop.run_until_complete(
+            pool.hash_password('foobarbazquux'))
+        assert check_password('foobarbazquux', password_hash)
+        assert check_password('foobarbazquux', password_hash.decode('utf-8'))
+        assert self.loop.run_until_complete(
+            pool.check_password('foobarbazquux', password_hash))
+        assert not self.loop.run_until_complete(
+            pool.check_password('quuxbazbarfoo', password_hash))
+        assert pool.completed == 3
+        pool.shutdown()
+
+    def test_refuses_when_queue_full(self):
+        pool = PasswordPool(self.loop, workers=1, queue_limit=1)
+        password_hash = hash_password('foobarbazquux')
+        async def check_all():
+            return await asyncio.gather(
+                *[pool.check_password('foobarbazquux', password_hash)
+                  for _ in range(3)],
+                return_exceptions=True)
+        results = self.loop.run_until_complete(check_all())
+        assert results[:2] == [True, True]
+        assert isinstance(results[2], ClientError)
+        assert pool.rejected == 1
+        pool.shutdown()
+
+    def test_counts_failures(self):
+        pool = PasswordPool(self.loop, workers=1)
+        with self.assertRaises(ValueError):
+            # not a bcrypt hash
+            self.loop.run_until_complete(
+                pool.check_password('foobarbazquux', 'nonsense'))
+        assert pool.failed == 1
+        assert pool.completed == 0
+        pool.shutdown()
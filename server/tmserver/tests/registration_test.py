@@ -1,9 +1,10 @@
+import asyncio
 import unittest.mock as mock
 import unittest
 
-from ..errors import ClientError
+from ..errors import ClientError, UserValidationError
 from ..models import UserAccount
-from ..core import GameServer, UserSession
+from ..core import GameServer, UserSession, LOOP
 from ..world import GameWorld
 from .tm_test_case import TildemushTestCase
 
@@ -35,21 +36,39 @@ class TestRegistration(TildemushTestCase):
 
     def test_creates_user(self):
         msg = 'REGISTER vilmibm:foobar1234567890-=_+!@#$%^&*()_+{}[]|/.,<>;:\'"'
-        self.server.handle_registration(self.mock_session, msg)
+        LOOP.run_until_complete(self.server.handle_registration(self.mock_session, msg))
         users = UserAccount.select().where(UserAccount.username == 'vilmibm')
         self.assertEqual(1, len(users))
 
     def test_validates_user(self):
         with mock.patch('tmserver.models.UserAccount.validate') as m:
             msg = 'REGISTER vilmibm:foobar'
-            self.server.handle_registration(self.mock_session, msg)
+            LOOP.run_until_complete(self.server.handle_registration(self.mock_session, msg))
         m.assert_called()
 
     def test_hashes_user_password(self):
-        with mock.patch('tmserver.models.UserAccount._hash_password') as m:
-            msg = 'REGISTER vilmibm:foobarbazquux'
-            self.server.handle_registration(self.mock_session, msg)
-        m.assert_called()
+        msg = 'REGISTER vilmibm:foobarbazquux'
+        LOOP.run_until_complete(self.server.handle_registration(self.mock_session, msg))
+        vil = UserAccount.get(UserAccount.username == 'vilmibm')
+        assert vil.password != 'foobarbazquux'
+        assert vil.check_password('foobarbazquux')
+        assert self.server.passwords.completed == 1
+
+    def test_concurrent_registrations(self):
+        other_session = mock.Mock()
+        other_session.associated = False
+        msg = 'REGISTER vilmibm:foobarbazquux'
+        async def register_twice():
+            return await asyncio.gather(
+                self.server.handle_registration(self.mock_session, msg),
+                self.server.handle_registration(other_session, msg),
+                return_exceptions=True)
+        results = LOOP.run_until_complete(register_twice())
+        errors = [r for r in results if r is not None]
+        assert len(errors) == 1
+        assert isinstance(errors[0], UserValidationError)
+        assert 'username taken' in str(errors[0])
+        assert 1 == len(UserAccount.select().where(UserAccount.username == 'vilmibm'))
 
     def test_detects_already_assoced_user_session(self):
         vil = UserAccount.create(username='vilmibm', password='foobarbazquux')
@@ -58,4 +77,4 @@ class TestRegistration(TildemushTestCase):
         with self.assertRaisesRegex(
                 ClientError,
                 'log out first'):
-            self.server.handle_registration(user_session, 'LOGIN vilmibm:foobarbazquux')
+            LOOP.run_until_complete(self.server.handle_registration(user_session, 'LOGIN vilmibm:foobarbazquux'))
@@ -1,9 +1,11 @@
 import json
-from unittest.mock import Mock, patch
+import threading
+from unittest.mock import Mock, PropertyMock, patch
 
 from ..core import GameServer, UserSession
 from ..errors import ClientError, RevisionError
-from ..models import GameObject, UserAccount, ScriptRevision
+from ..models import GameObject, UserAccount, ScriptRevision, LIVE_OBJECTS
+from ..revisions import REVISIONS, RevisionNotifier
 from ..world import GameWorld
 from .tm_test_case import TildemushTestCase, TildemushUnitTestCase
 
@@ -151,6 +153,7 @@ class GameWorldRevisionHandlingTest(TildemushTestCase):
 
     def test_witch_error(self):
         bad_code = '(lol)'
+        current_rev = self.snoozy.script_revision
         result = GameWorld.handle_revision(
             self.vil.player_obj,
             'vilmibm/snoozy',
@@ -169,7 +172,10 @@ class GameWorldRevisionHandlingTest(TildemushTestCase):
             'errors': [";_; There is a problem with your witch script: name 'lol' is not defined"]}
 
         assert latest_rev.code == bad_code
-        assert self.snoozy.script_revision.code != latest_rev.code
+        # broken code is saved as the object's revision (see handle_revision);
+        # self.snoozy is the live object, so it sees that too
+        assert latest_rev.id != current_rev.id
+        assert self.snoozy.script_revision.id == latest_rev.id
 
         assert expected == result
 
@@ -181,6 +187,7 @@ class GameWorldRevisionHandlingTest(TildemushTestCase):
           (hears "pet"
              (says "neigh")))
         """.rstrip().lstrip()
+        current_rev = self.snoozy.script_revision
         result = GameWorld.handle_revision(
             self.vil.player_obj,
             'vilmibm/snoozy',
@@ -199,7 +206,8 @@ class GameWorldRevisionHandlingTest(TildemushTestCase):
             'errors': []}
 
         assert latest_rev.code == new_code
-        assert self.snoozy.script_revision.code != latest_rev.code
+        assert latest_rev.id != current_rev.id
+        assert self.snoozy.script_revision.id == latest_rev.id
 
         assert expected == result
 
@@ -225,8 +233,10 @@ class GameObjectRevisionUpdateTest(TildemushTestCase):
     def test_witch_error(self):
         # I haven't really thought through the behavior here. currently, a
         # witch exception means that the game object just stays with its
-        # current _engine and current revision.
+        # current _engine, though the broken revision is saved as its
+        # revision so the author can keep working on it.
         assert self.snoozy._engine
+        current_engine = self.snoozy._engine
         new_code = "(lol)".rstrip().lstrip()
         current_rev = self.snoozy.script_revision
         result = GameWorld.handle_revision(
@@ -235,7 +245,9 @@ class GameObjectRevisionUpdateTest(TildemushTestCase):
             new_code,
             self.snoozy.script_revision.id)
         e = self.snoozy.engine
-        assert self.snoozy.script_revision.id == current_rev.id
+        assert e is current_engine
+        assert self.snoozy.script_revision.id != current_rev.id
+        assert self.snoozy.script_revision.id == self.snoozy.latest_script_rev.id
 
     def test_success(self):
         assert self.snoozy._engine
@@ -255,3 +267,93 @@ class GameObjectRevisionUpdateTest(TildemushTestCase):
         e = self.snoozy.engine
         assert self.snoozy.script_revision.id != current_rev.id
         assert 'pet' in e.handlers
+
+    def test_no_revision_query_when_unchanged(self):
+        self.snoozy.engine
+        with patch('tmserver.models.GameObject.latest_script_rev',
+                   new_callable=PropertyMock) as m:
+            self.snoozy.engine
+            self.snoozy.engine
+        assert not m.called
+
+    def test_other_objects_notified(self):
+        twin = GameObject.create(
+            author=self.vil,
+            shortname='vilmibm/snoozy-twin',
+            script_revision=self.snoozy.script_revision)
+        assert 'pet' not in twin.engine.handlers
+        new_code = """
+        (witch "snoozy"
+          (has {"name" "snoozy"
+                "description" "just a horse"})
+          (hears "pet"
+             (says "neigh")))
+        """.rstrip().lstrip()
+        GameWorld.handle_revision(
+            self.vil.player_obj,
+            'vilmibm/snoozy',
+            new_code,
+            self.snoozy.script_revision.id)
+        assert twin._revision_pending
+        assert 'pet' in twin.engine.handlers
+        assert twin.script_revision.id == self.snoozy.script_revision.id
+        assert not twin._revision_pending
+
+    def test_loaded_after_revision(self):
+        # no notification, as if it went to another process or we restarted
+        new_rev = ScriptRevision.create(
+            script=self.snoozy.script_revision.script,
+            code="""
+            (witch "snoozy"
+              (has {"name" "snoozy"
+                    "description" "just a horse"})
+              (hears "pet"
+                 (says "neigh")))
+            """.rstrip().lstrip())
+        LIVE_OBJECTS.remove(self.snoozy)
+        snoozy = GameObject.get(GameObject.id == self.snoozy.id)
+        assert 'pet' in snoozy.engine.handlers
+        assert snoozy.script_revision.id == new_rev.id
+
+    def test_resync_flags_live_objects(self):
+        twin = GameObject.create(
+            author=self.vil,
+            shortname='vilmibm/snoozy-twin',
+            script_revision=self.snoozy.script_revision)
+        twin.engine
+        assert not twin._revision_pending
+        for fn in REVISIONS.resync_subscribers:
+            fn()
+        assert twin._revision_pending
+
+    def test_reconnects(self):
+        notifier = RevisionNotifier(retry_delay=0.01)
+        resynced = threading.Event()
+        notifier.subscribe_resync(resynced.set)
+        dropped = Mock()
+        dropped.notifies = []
+        dropped.poll.side_effect = OSError('connection lost')
+        quiet = Mock()
+        quiet.notifies = []
+        connections = [OSError('no database'), dropped, quiet]
+        def connect():
+            conn = connections.pop(0)
+            if isinstance(conn, Exception):
+                raise conn
+            return conn
+        with patch.object(notifier, '_connect', connect), \
+             patch('tmserver.revisions.select.select', return_value=([1], [], [])):
+            notifier.listen()
+            assert resynced.wait(5)
+            notifier.stop()
+        assert notifier.reconnects == 1
+        assert dropped.close.called
+
+    def test_ignores_own_notifications(self):
+        notifier = RevisionNotifier()
+        heard = []
+        notifier.subscribe(lambda script_id, rev_id: heard.append((script_id, rev_id)))
+        notifier.handle_notify(json.dumps(dict(origin=notifier.origin, script=1, revision=2)))
+        assert heard == []
+        notifier.handle_notify(json.dumps(dict(origin='elsewhere', script=1, revision=2)))
+        assert heard == [(1, 2)]
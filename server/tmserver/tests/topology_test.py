@@ -0,0 +1,114 @@
+from ..containment import ContainmentIndex
+from ..topology import PathCache, RoomGraph
+from .tm_test_case import TildemushUnitTestCase
+
+# rooms are 1-4 and exits 11-13: foyer(1) -north-> hall(2) -east-> attic(3),
+# and a cellar(4) that's only reachable from the attic.
+ROUTES = [
+    (11, 1, 'north', 2), (11, 2, 'south', 1),
+    (12, 2, 'east', 3), (12, 3, 'west', 2),
+    (13, 3, 'below', 4), (13, 4, 'above', 3),
+]
+CONTAINS = [(1, 11), (2, 11), (2, 12), (3, 12), (3, 13), (4, 13), (1, 100)]
+
+
+class RoomGraphTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.containment = ContainmentIndex(lambda: CONTAINS)
+        self.graph = RoomGraph(self.containment, lambda: ROUTES)
+        self.containment.listeners.append(self.graph.room_changed)
+        # loads both; changes made before then would be lost, since the
+        # loaders stand in for the database
+        self.graph.exits(1)
+        self.changed = []
+        self.graph.listeners.append(self.changed.append)
+
+    def test_exits(self):
+        assert dict(self.graph.exits(2)) == {'south': (11, 1), 'east': (12, 3)}
+        assert self.graph.resolve(1, 'north') == (11, 2)
+        assert self.graph.resolve(1, 'south') is None
+
+    def test_exit_must_be_in_room(self):
+        self.containment.remove(4, 13)
+        assert self.graph.resolve(4, 'above') is None
+        assert self.graph.resolve(3, 'below') == (13, 4)
+
+    def test_neighbourhood(self):
+        assert dict(self.graph.neighbourhood(1, 0)) == {1: 0}
+        assert dict(self.graph.neighbourhood(1, 2)) == {1: 0, 2: 1, 3: 2}
+        assert list(self.graph.neighbourhood(1, 10)) == [1, 2, 3, 4]
+
+    def test_neighbourhood_is_shortest(self):
+        # a shortcut from the foyer straight down to the cellar
+        self.graph.update(14, {1: ('below', 4), 4: ('east', 1)})
+        self.containment.add(1, 14)
+        assert dict(self.graph.neighbourhood(1, 10)) == {1: 0, 2: 1, 4: 1, 3: 2}
+
+    def test_shortest_path(self):
+        assert self.graph.shortest_path(1, 4) == [
+            ('north', 11, 2), ('east', 12, 3), ('below', 13, 4)]
+        assert self.graph.shortest_path(4, 2) == [('above', 13, 3), ('west', 12, 2)]
+        assert self.graph.shortest_path(2, 2) == []
+
+    def test_shortest_path_unreachable(self):
+        self.containment.remove(3, 13)
+        assert self.graph.shortest_path(1, 4) is None
+
+    def test_moving_things_around_is_quiet(self):
+        self.containment.add(1, 101)
+        self.containment.remove(1, 100)
+        assert self.changed == []
+
+    def test_removing_an_exit(self):
+        self.graph.exits(3)
+        self.containment.remove(3, 13)
+        assert self.changed == [3]
+        assert self.graph.resolve(3, 'below') is None
+
+    def test_update(self):
+        self.graph.update(11, {1: ('east', 2), 2: ('west', 1)})
+        assert set(self.changed) == {1, 2}
+        assert self.graph.resolve(1, 'north') is None
+        assert self.graph.resolve(1, 'east') == (11, 2)
+
+    def test_update_removes(self):
+        self.graph.update(13, {})
+        assert set(self.changed) == {3, 4}
+        assert list(self.graph.neighbourhood(1, 10)) == [1, 2, 3]
+
+
+class PathCacheTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.containment = ContainmentIndex(lambda: CONTAINS)
+        self.graph = RoomGraph(self.containment, lambda: ROUTES)
+        self.containment.listeners.append(self.graph.room_changed)
+        self.graph.exits(1)
+        self.cache = PathCache(2)
+        self.graph.listeners.append(self.cache.room_changed)
+
+    def test_caches(self):
+        path = self.cache.shortest_path(self.graph, 1, 4)
+        assert self.cache.shortest_path(self.graph, 1, 4) is path
+        assert self.cache.hits == 1
+        assert self.cache.misses == 1
+
+    def test_caches_unreachable(self):
+        self.graph.update(13, {})
+        assert self.cache.shortest_path(self.graph, 1, 4) is None
+        assert self.cache.shortest_path(self.graph, 1, 4) is None
+        assert self.cache.hits == 1
+
+    def test_new_exit_clears(self):
+        assert len(self.cache.shortest_path(self.graph, 1, 4)) == 3
+        self.graph.update(14, {1: ('below', 4), 4: ('east', 1)})
+        self.containment.add(1, 14)
+        assert self.cache.shortest_path(self.graph, 1, 4) == [('below', 14, 4)]
+        assert self.cache.invalidations == 1
+
+    def test_bounded(self):
+        for target in (2, 3, 4):
+            self.cache.shortest_path(self.graph, 1, target)
+        assert len(self.cache) == 2
+        assert (1, 2) not in self.cache.entries
@@ -0,0 +1,192 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from ..config import get_db
+from ..core import ClientStateScheduler, UserSession, WorldRunner, msgpack
+from ..world import GameWorld
+from .tm_test_case import TildemushUnitTestCase
+
+
+class WorldRunnerTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_runs_off_the_loop(self):
+        runner = WorldRunner(self.loop)
+        result = self.loop.run_until_complete(
+            runner.run(lambda: threading.current_thread()))
+        assert result is not threading.current_thread()
+        assert runner.queue_depth == 0
+        assert runner.max_queue_depth == 1
+
+    def test_returns_connection(self):
+        db = get_db()
+        checkins = db.stats.checkins
+        runner = WorldRunner(self.loop)
+        self.loop.run_until_complete(runner.run(db.execute_sql, 'SELECT 1'))
+        assert db.stats.checkins == checkins + 1
+        assert db.stats.checkout_total > 0
+
+    def test_preserves_order(self):
+        runner = WorldRunner(self.loop, workers=1)
+        seen = []
+        self.loop.run_until_complete(asyncio.gather(
+            *[runner.run(seen.append, i) for i in range(10)],
+            loop=self.loop))
+        assert seen == list(range(10))
+        assert runner.max_queue_depth == 10
+
+    def test_hold_and_release(self):
+        sent = []
+        async def client_send(message):
+            sent.append(message)
+
+        session = UserSession(self.loop, GameWorld, mock.Mock())
+        session.client_send = client_send
+        runner = WorldRunner(self.loop)
+
+        async def handle():
+            session.hold()
+            await runner.run(session.send, 'second')
+            session.reply('first')
+            session.release()
+            await asyncio.sleep(0, loop=self.loop)
+
+        self.loop.run_until_complete(handle())
+        assert sent == ['first', 'second']
+
+
+class OutboxTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.sent = []
+        self.session = UserSession(self.loop, GameWorld, mock.Mock(), logger=mock.Mock(),
+                                   queue_limit=3)
+        self.session.client_send = self.client_send
+        self.session.close = mock.Mock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def client_send(self, message):
+        self.sent.append(message)
+
+    def drain(self):
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+
+    def test_batches(self):
+        self.session.negotiate(['batch'])
+        for message in ['one', 'two', 'three']:
+            self.session.reply(message)
+        self.drain()
+        assert self.sent == ['BATCH ["one", "two", "three"]']
+        assert self.session.frames == 1
+        assert self.session.queue_depth == 0
+
+    def test_no_batches_without_capability(self):
+        for message in ['one', 'two']:
+            self.session.reply(message)
+        self.drain()
+        assert self.sent == ['one', 'two']
+
+    def test_drops_chatter_when_full(self):
+        for i in range(5):
+            self.session._enqueue('hi {}'.format(i), True)
+        assert self.session.queue_depth == 3
+        assert self.session.dropped == 2
+        assert not self.session.close.called
+        self.drain()
+        assert self.sent == ['hi 0', 'hi 1', 'hi 2']
+
+    def test_disconnects_when_state_does_not_fit(self):
+        for i in range(4):
+            self.session._enqueue('OBJECT {}', False)
+        self.session.close.assert_called_once_with()
+
+    def test_disconnect_policy(self):
+        self.session.queue_policy = 'disconnect'
+        for i in range(4):
+            self.session._enqueue('hi', True)
+        self.session.close.assert_called_once_with()
+
+    def test_newer_state_replaces_older(self):
+        self.session._enqueue(('STATE', {'room': 'foyer'}), False)
+        self.session._enqueue('hi', True)
+        self.session._enqueue(('STATE', {'room': 'hall'}), False)
+        self.drain()
+        assert self.sent == ['hi', 'STATE {"room": "hall"}']
+
+    def test_batches_structured(self):
+        self.session.negotiate(['batch'])
+        self.session.reply('COMMAND OK')
+        self.session._enqueue(('OBJECT', {'shortname': 'horse'}), False)
+        self.drain()
+        assert self.sent == ['BATCH ["COMMAND OK", "OBJECT {\\"shortname\\": \\"horse\\"}"]']
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.session.negotiate(['batch', 'msgpack'])
+        self.session.reply('COMMAND OK')
+        self.session._enqueue(('STATE', {'room': 'foyer'}), False)
+        self.drain()
+        assert len(self.sent) == 1
+        assert msgpack.unpackb(self.sent[0], raw=False) == [
+            'COMMAND OK', ['STATE', {'room': 'foyer'}]]
+
+
+class ClientStateSchedulerTest(TildemushUnitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.session = mock.Mock()
+        self.session.game_world.get_session.return_value = self.session
+        self.session.game_world.client_state.return_value = {'room': 'foyer'}
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_coalesces(self):
+        scheduler = ClientStateScheduler(self.loop, WorldRunner(self.loop), tick=0.01)
+        for _ in range(5):
+            scheduler.request(self.session)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.session.handle_client_update.assert_called_once_with({'room': 'foyer'})
+        assert scheduler.requested == 5
+        assert scheduler.sent == 1
+
+    def test_skips_logged_out(self):
+        scheduler = ClientStateScheduler(self.loop, WorldRunner(self.loop), tick=0.01)
+        scheduler.request(self.session)
+        self.session.game_world.get_session.return_value = mock.Mock()
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        assert not self.session.handle_client_update.called
+        assert scheduler.sent == 0
+
+    def test_no_tick(self):
+        scheduler = ClientStateScheduler(self.loop, WorldRunner(self.loop), tick=0)
+        scheduler.request(self.session)
+        scheduler.request(self.session)
+        assert self.session.handle_client_update.call_count == 2
+        assert scheduler.sent == 2
+
+    def test_failure_skips_only_that_session(self):
+        logger = mock.Mock()
+        broken = mock.Mock()
+        broken.game_world.get_session.return_value = broken
+        broken.game_world.client_state.side_effect = KeyError('room')
+        scheduler = ClientStateScheduler(
+            self.loop, WorldRunner(self.loop), tick=0.01, logger=logger)
+        scheduler.request(broken)
+        scheduler.request(self.session)
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.session.handle_client_update.assert_called_once_with({'room': 'foyer'})
+        assert not broken.handle_client_update.called
+        assert logger.error.called
+        assert scheduler.sent == 1
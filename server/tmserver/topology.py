@@ -0,0 +1,229 @@
+import threading
+from collections import OrderedDict, deque
+
+from .constants import DIRECTION_ORDER
+
+
+class RoomGraph:
+    """An in-memory graph of how rooms connect, so that following exits is a
+    dictionary lookup rather than a scan of every object in a room.
+
+    An exit object's routes (its Exit rows, see models.py) say where it leads
+    from each room it joins. A route is only usable from a room the exit is
+    actually in, so the graph is built from two things: the routes of every
+    exit, loaded in one query the first time they're needed and kept up to
+    date through update(), and the ContainmentIndex, which says which exits
+    each room holds. A room's exits are worked out the first time they're
+    asked for and again whenever what that room contains changes.
+
+    Functions in `listeners` are called with a room id whenever that room's
+    exits change, or with None when it could be any room."""
+    def __init__(self, containment, loader):
+        # loader returns an iterable of (exit id, room id, direction, target
+        # room id) tuples
+        self.containment = containment
+        self.loader = loader
+        self.listeners = []
+        self._lock = threading.RLock()
+        self.clear()
+
+    def _changed(self, room_id):
+        for fn in self.listeners:
+            fn(room_id)
+
+    def clear(self):
+        """Forgets everything; routes are reloaded on next use."""
+        with self._lock:
+            # exit id -> {room id: (direction, target room id)}
+            self.routes = {}
+            # room id -> OrderedDict of direction -> (exit id, target room id)
+            self.adjacency = {}
+            # bumped by every change so that exits worked out while one was
+            # happening aren't kept
+            self.version = 0
+            self.loaded = False
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            for exit_id, room_id, direction, target_id in self.loader():
+                self.routes.setdefault(exit_id, {})[room_id] = (direction, target_id)
+            self.loaded = True
+
+    def _compute(self, room_id):
+        # called without holding the lock, since this takes the
+        # ContainmentIndex's and it calls room_changed holding its own
+        exits = OrderedDict()
+        for inner_id in self.containment.inners_of(room_id):
+            route = self.routes.get(inner_id, {}).get(room_id)
+            if route is None:
+                continue
+            direction, target_id = route
+            # as with resolve_exit, the first exit a room got wins
+            exits.setdefault(direction, (inner_id, target_id))
+        return exits
+
+    def exits(self, room_id):
+        """Returns an OrderedDict of direction -> (exit id, target room id)
+        for the ways out of room_id. Don't modify it."""
+        self._ensure_loaded()
+        exits = self.adjacency.get(room_id)
+        if exits is None:
+            version = self.version
+            exits = self._compute(room_id)
+            with self._lock:
+                if version == self.version:
+                    self.adjacency[room_id] = exits
+        return exits
+
+    def resolve(self, room_id, direction):
+        """Returns (exit id, target room id) for leaving room_id in
+        direction, or None."""
+        return self.exits(room_id).get(direction)
+
+    def neighbourhood(self, room_id, distance):
+        """Returns an OrderedDict of room id -> hops for every room within
+        distance exits of room_id, in breadth first order."""
+        hops = OrderedDict([(room_id, 0)])
+        pending = deque([room_id])
+        while pending:
+            current = pending.popleft()
+            if hops[current] >= distance:
+                continue
+            exits = self.exits(current)
+            for direction in DIRECTION_ORDER:
+                route = exits.get(direction)
+                if route is None or route[1] in hops:
+                    continue
+                hops[route[1]] = hops[current] + 1
+                pending.append(route[1])
+        return hops
+
+    def shortest_path(self, origin_id, target_id):
+        """Returns the fewest exits that lead from origin_id to target_id as a
+        list of (direction, exit id, room id) steps, [] if they're the same
+        room, or None if there's no way there."""
+        if origin_id == target_id:
+            return []
+        # room id -> (room id it was reached from, direction, exit id)
+        parents = {origin_id: None}
+        pending = deque([origin_id])
+        while pending:
+            current = pending.popleft()
+            exits = self.exits(current)
+            for direction in DIRECTION_ORDER:
+                route = exits.get(direction)
+                if route is None or route[1] in parents:
+                    continue
+                parents[route[1]] = (current, direction, route[0])
+                if route[1] == target_id:
+                    return self._steps(parents, target_id)
+                pending.append(route[1])
+        return None
+
+    def _steps(self, parents, room_id):
+        steps = []
+        while parents[room_id] is not None:
+            previous, direction, exit_id = parents[room_id]
+            steps.append((direction, exit_id, room_id))
+            room_id = previous
+        steps.reverse()
+        return steps
+
+    def room_changed(self, room_id):
+        """For CONTAINMENT.listeners."""
+        with self._lock:
+            self.version += 1
+            if room_id is None:
+                self.adjacency = {}
+                old = None
+            else:
+                old = self.adjacency.pop(room_id, None)
+        if room_id is None:
+            self._changed(None)
+        elif old is not None and self.exits(room_id) != old:
+            self._changed(room_id)
+
+    def routes_of(self, exit_id):
+        """Returns a copy of exit_id's routes as update() takes them."""
+        self._ensure_loaded()
+        with self._lock:
+            return dict(self.routes.get(exit_id, {}))
+
+    def update(self, exit_id, routes):
+        """Replaces exit_id's routes with routes, a dict of room id ->
+        (direction, target room id). An empty dict removes them."""
+        with self._lock:
+            if not self.loaded:
+                return
+            self.version += 1
+            old = self.routes.pop(exit_id, {})
+            if routes:
+                self.routes[exit_id] = dict(routes)
+            rooms = set(old) | set(routes)
+            for room_id in rooms:
+                self.adjacency.pop(room_id, None)
+        for room_id in rooms:
+            self._changed(room_id)
+
+
+class PathCache:
+    """A bounded LRU of RoomGraph.shortest_path results keyed by (origin room
+    id, target room id). Unreachable targets are remembered too.
+
+    Any new or changed exit can make a path shorter or take one away, so
+    every change to the graph empties the cache (see room_changed)."""
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped by every clear so that a path worked out while the graph was
+        # changing isn't kept
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries = OrderedDict()
+            self.generation += 1
+
+    def shortest_path(self, graph, origin_id, target_id):
+        key = (origin_id, target_id)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            generation = self.generation
+
+        path = graph.shortest_path(origin_id, target_id)
+        with self._lock:
+            if generation == self.generation:
+                self.entries[key] = path
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return path
+
+    def room_changed(self, room_id):
+        """For RoomGraph.listeners."""
+        with self._lock:
+            if self.entries:
+                self.invalidations += 1
+        self.clear()
+
+    @property
+    def stats(self):
+        return dict(
+            size=len(self.entries),
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations)
+
+    def __len__(self):
+        return len(self.entries)
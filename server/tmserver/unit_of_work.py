@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import threading
+
+from .config import get_db
+
+_local = threading.local()
+
+
+class UnitOfWork:
+    """Collects the reads and writes of game object data made while handling a
+    single command.
+
+    The first get_data on an object reads its data column once; every later
+    get_data and set_data for that object works against that snapshot, so
+    WITCH handlers see their own writes. Objects with written keys are saved
+    together, in one transaction, when the unit is flushed."""
+    def __init__(self):
+        self.snapshots = {}
+        self.dirty = {}
+
+    def read(self, obj):
+        if obj.id not in self.snapshots:
+            self.snapshots[obj.id] = obj._fetch_data()
+        return self.snapshots[obj.id]
+
+    def write(self, obj, key, value):
+        self.read(obj)[key] = value
+        self.dirty.setdefault(obj.id, (obj, set()))[1].add(key)
+
+    def settle(self, obj, key):
+        """Writes a pending value for key right away, for operations (like
+        incr_data) that have to work against what's stored."""
+        entry = self.dirty.get(obj.id)
+        if entry is None or key not in entry[1]:
+            return
+        obj._write_data(self.snapshots[obj.id], {key})
+        entry[1].discard(key)
+
+    def absorb(self, obj, key, value):
+        """Records a value that's already been written to the DB."""
+        self.read(obj)[key] = value
+
+    def flush(self):
+        if not self.dirty:
+            return
+        with get_db().atomic():
+            for obj, keys in self.dirty.values():
+                obj._write_data(self.snapshots[obj.id], keys)
+        self.dirty = {}
+
+
+def current_unit():
+    """Returns the unit of work open on this thread, if any."""
+    return getattr(_local, 'unit', None)
+
+
+@contextmanager
+def unit_of_work():
+    """Opens a unit of work for the duration of the block and flushes it at
+    the end, even if the block raised. Nested blocks join the outermost unit
+    rather than opening their own."""
+    unit = current_unit()
+    if unit is not None:
+        yield unit
+        return
+
+    unit = UnitOfWork()
+    _local.unit = unit
+    try:
+        yield unit
+    finally:
+        _local.unit = None
+        unit.flush()
@@ -1,4 +1,5 @@
 import itertools
+import logging
 import re
 
 from slugify import slugify
@@ -6,8 +7,11 @@ from slugify import slugify
 from .config import get_db
 from .constants import DIRECTIONS, REVERSE_DIRS
 from .errors import RevisionError, WitchError, ClientError, UserError
-from .mapping import render_map
-from .models import Contains, GameObject, Script, ScriptRevision, Permission, Editing, LastSeen
+from .mapping import plan_map
+from .models import CONTAINMENT, PATH_CACHE, ROOM_GRAPH, Contains, GameObject, Script, ScriptRevision, Permission, Editing, LastSeen
+from .revisions import REVISIONS
+from .scripting import ACTION_INTEREST, BROADCAST_MESSAGES
+from .unit_of_work import unit_of_work
 from .util import strip_color_codes, split_args, ARG_RE
 
 OBJECT_DENIED = 'You grab a hold of {} but no matter how hard you pull it stays rooted in place.'
@@ -23,10 +27,75 @@ SPECIAL_HANDLING = {'say'} # TODO i thought there were others but for now it's j
 class GameWorld:
     # TODO logging
     _sessions = {}
+    # room id -> {player obj id: (player obj, session)} for every logged in
+    # player, so finding who's listening in a room doesn't mean looking at
+    # everything in it.
+    _room_sessions = {}
+    # player obj id -> id of the room it's tracked in above
+    _player_rooms = {}
 
     @classmethod
     def reset(cls):
         cls._sessions = {}
+        cls._room_sessions = {}
+        cls._player_rooms = {}
+
+    @classmethod
+    def listeners(cls, room):
+        """Returns (player obj, session) for every logged in player directly
+        inside room."""
+        return list(cls._room_sessions.get(room.id, {}).values())
+
+    @classmethod
+    def broadcast(cls, room, sender_obj, msg, exclude=None):
+        """Has every logged in player in room, bar exclude, hear msg. The
+        message is built once by the caller and the same string is queued for
+        every session."""
+        for o, session in cls.listeners(room):
+            if o != exclude:
+                session.handle_hears(sender_obj, msg)
+
+    @classmethod
+    def hear_action(cls, objs, sender_obj, action, action_args):
+        """Has each of objs handle action. For the actions in
+        BROADCAST_MESSAGES, players without a handler of their own are sent
+        one message built for all of them instead of each running the default
+        handler."""
+        msg_fn = BROADCAST_MESSAGES.get(action)
+        msg = None
+        for o in objs:
+            if msg_fn is None or not o.is_player_obj or action in o.engine.actions:
+                o.handle_action(cls, sender_obj, action, action_args)
+                continue
+            if msg is None:
+                msg = msg_fn(sender_obj, action_args)
+            cls.get_session(o.author_id).handle_hears(sender_obj, msg)
+
+    @classmethod
+    def _track(cls, outer_obj, inner_obj):
+        if not inner_obj.is_player_obj:
+            return
+        get_db().on_rollback(cls._track_in, inner_obj, cls._player_rooms.get(inner_obj.id))
+        cls._track_in(inner_obj, outer_obj.id)
+
+    @classmethod
+    def _track_in(cls, player_obj, room_id):
+        cls._untrack(player_obj)
+        session = cls._sessions.get(player_obj.author_id)
+        if session is None or room_id is None:
+            return
+        cls._room_sessions.setdefault(room_id, {})[player_obj.id] = (player_obj, session)
+        cls._player_rooms[player_obj.id] = room_id
+
+    @classmethod
+    def _untrack(cls, player_obj):
+        room_id = cls._player_rooms.pop(player_obj.id, None)
+        if room_id is None:
+            return
+        room_sessions = cls._room_sessions.get(room_id, {})
+        room_sessions.pop(player_obj.id, None)
+        if not room_sessions:
+            cls._room_sessions.pop(room_id, None)
 
     @classmethod
     def register_session(cls, user_account, user_session):
@@ -44,9 +113,8 @@ class GameWorld:
             room = ls.room
         cls.put_into(room, player_obj)
         LastSeen.delete().where(LastSeen.user_account==user_account).execute()
-        affected = (o for o in room.contains if o.is_player_obj and o != player_obj)
-        for o in affected:
-            cls.user_hears(o, player_obj, '{} fades in.'.format(player_obj.name))
+        cls.broadcast(room, player_obj, '{} fades in.'.format(player_obj.name),
+                      exclude=player_obj)
 
     @classmethod
     def unregister_session(cls, user_account):
@@ -58,9 +126,7 @@ class GameWorld:
         room = player_obj.room
         if room is not None:
             cls.remove_from(player_obj.room, player_obj)
-            affected = (o for o in room.contains if o.is_player_obj)
-            for o in affected:
-                cls.user_hears(o, player_obj, '{} fades out.'.format(player_obj.name))
+            cls.broadcast(room, player_obj, '{} fades out.'.format(player_obj.name))
 
             LastSeen.create(user_account=user_account, room=room)
 
@@ -73,25 +139,22 @@ class GameWorld:
         return session
 
     @classmethod
-    def client_state(cls, user_account):
+    def client_state(cls, user_account, rooms=None):
         """Given a user account, returns a dictionary of information relevant
-        to the game client."""
+        to the game client. When building states for several users at once,
+        pass the same rooms dict to each call so that the part describing a
+        room is only built once per room."""
+        with unit_of_work():
+            return cls._client_state(user_account, rooms)
+
+    @classmethod
+    def _client_state(cls, user_account, rooms=None):
         player_obj = user_account.player_obj
         room = player_obj.room
-
-        exits = [o for o in room.contains if o.get_data('exit')]
-        exit_payload = {}
-        for e in exits:
-            route = e.get_data('exit', {}).get(room.shortname)
-            if route is None: continue
-
-            target_room_shortname = route[1]
-            target_room = GameObject.get_or_none(GameObject.shortname==target_room_shortname)
-            if target_room is None: continue
-
-            exit_payload[route[0]] = {
-                'exit_name': e.name,
-                'room_name': target_room.name}
+        if rooms is None:
+            rooms = {}
+        if room.id not in rooms:
+            rooms[room.id] = cls.room_state(room)
 
         return {
             'motd': 'welcome to tildemush',  # TODO
@@ -100,22 +163,37 @@ class GameWorld:
                 'display_name': player_obj.name,
                 'description': player_obj.description
             },
-            'room': {
-                'name': room.name,
-                'shortname': room.shortname,
-                'description': room.description,
-                'contains': [dict(name=o.name, description=o.description, shortname=o.shortname)
-                             for o in room.contains],
-                'exits': exit_payload,
-            },
+            'room': rooms[room.id],
             'inventory': cls.contains_tree(player_obj),
         }
 
+    @classmethod
+    def room_state(cls, room):
+        """The part of the client state describing room."""
+        exits = ROOM_GRAPH.exits(room.id)
+        objs = {o.id: o for o in GameObject.by_ids(
+            [obj_id for route in exits.values() for obj_id in route])}
+        exit_payload = {}
+        for direction, (exit_id, target_id) in exits.items():
+            if exit_id not in objs or target_id not in objs: continue
+
+            exit_payload[direction] = {
+                'exit_name': objs[exit_id].name,
+                'room_name': objs[target_id].name}
+
+        return {
+            'name': room.name,
+            'shortname': room.shortname,
+            'description': room.description,
+            'contains': [dict(name=o.name, description=o.description, shortname=o.shortname)
+                         for o in room.contains],
+            'exits': exit_payload,
+        }
+
     @classmethod
     def send_client_update(cls, user_account):
         if user_account.id in cls._sessions:
-            cls.get_session(user_account.id).handle_client_update(
-                cls.client_state(user_account))
+            cls.get_session(user_account.id).request_client_update()
 
     @classmethod
     def contains_tree(cls, obj):
@@ -134,6 +212,14 @@ class GameWorld:
 
     @classmethod
     def dispatch_action(cls, sender_obj, action, action_args):
+        """Handles a command. Game object data read and written while doing
+        so goes through a single unit of work that's flushed once the command
+        (and anything it set off) is done."""
+        with unit_of_work():
+            cls._dispatch_action(sender_obj, action, action_args)
+
+    @classmethod
+    def _dispatch_action(cls, sender_obj, action, action_args):
         # TODO this list is only going to grow. these are commands that have
         # special meaning to the game (ie unlike something a game object merely
         # listens for like "pet"). I'm considering generalizing this as a list
@@ -164,6 +250,12 @@ class GameWorld:
         elif action == 'go':
             cls.handle_go(sender_obj, action_args)
             return
+        elif action == 'path':
+            cls.handle_path(sender_obj, action_args)
+            return
+        elif action == 'travel':
+            cls.handle_travel(sender_obj, action_args)
+            return
         elif action == 'home':
             cls.move_obj(sender_obj, '{}/sanctum'.format(sender_obj.user_account.username))
         elif action == 'foyer':
@@ -198,9 +290,8 @@ class GameWorld:
 
         # if we make it here it means we've encountered a command that objects
         # in the area should all "hear"
-        aoe = cls.area_of_effect(sender_obj)
-        for o in aoe:
-            o.handle_action(cls, sender_obj, action, action_args)
+        cls.hear_action(
+            cls.interested_objects(sender_obj, action), sender_obj, action, action_args)
 
     @classmethod
     def resolve_obj(cls, scope, search_str, ignore=lambda o: False):
@@ -216,21 +307,12 @@ class GameWorld:
 
     @classmethod
     def resolve_exit(cls, room, direction):
-        resolved = None
-        for o in room.contains:
-            if o.is_player_obj: continue
-
-            exits_map = o.get_data('exit')
-            if exits_map is None: continue
-
-            route = exits_map.get(room.shortname)
-            if route is None: continue
+        route = ROOM_GRAPH.resolve(room.id, direction)
+        if route is None:
+            return None
 
-            if route[0] == direction:
-                resolved = o
-                break
-
-        return resolved
+        found = GameObject.by_ids([route[0]])
+        return found[0] if found else None
 
     @classmethod
     def all_active_objects(cls):
@@ -238,13 +320,7 @@ class GameWorld:
         else, it's "active" in the game; in other words, we're assuming that a
         player object connected to a not-logged-in user account won't exist in
         a room."""
-        all_containing_objects = set(GameObject.select()\
-                                               .join(Contains, on=Contains.outer_obj)\
-                                               .distinct(GameObject.id))
-        all_contained_objects = set(GameObject.select()\
-                                              .join(Contains, on=Contains.inner_obj)\
-                                              .distinct(GameObject.id))
-        return all_containing_objects.union(all_contained_objects)
+        return set(GameObject.by_ids(list(CONTAINMENT.all_ids())))
 
     @classmethod
     def handle_get(cls, sender_obj, action_args):
@@ -593,7 +669,7 @@ class GameWorld:
             owner_obj.user_account, shortname, 'portkey', {
             'name': name,
             'description': description,
-            'target_room_name': target.shortname})
+            'target': target.shortname})
 
     @classmethod
     def handle_mode(cls, sender_obj, action_args):
@@ -627,9 +703,7 @@ class GameWorld:
         if not sender_obj.user_account.is_god:
             raise UserError('you are not powerful enough to do that.')
 
-        aoe = cls.all_active_objects()
-        for o in aoe:
-            o.handle_action(cls, sender_obj, 'announce', action_args)
+        cls.hear_action(cls.all_active_objects(), sender_obj, 'announce', action_args)
 
     @classmethod
     def handle_whisper(cls, sender_obj, action_args):
@@ -680,12 +754,12 @@ class GameWorld:
         # objects can hook off of this if they want. By default, this does
         # nothing.
 
-        for o in cls.area_of_effect(sender_obj):
+        for o in cls.interested_objects(sender_obj, 'look'):
             o.handle_action(cls, sender_obj, 'look', action_args)
 
     @classmethod
     def move_obj(cls, target_obj, target_room_name):
-        target_room = GameObject.get_or_none(GameObject.shortname==target_room_name)
+        target_room = GameObject.by_shortname(target_room_name)
         if target_room is None:
             raise UserError('illegal move') # should have been caught earlier
         if target_obj.is_player_obj and target_obj == target_room:
@@ -705,6 +779,72 @@ class GameWorld:
 
         exit_obj.handle_action(cls, sender_obj, 'go', direction)
 
+    @classmethod
+    def find_path(cls, room, target_room):
+        """Returns the shortest way from room to target_room as a list of
+        (direction, exit id, room id) steps, or None if there isn't one."""
+        return PATH_CACHE.shortest_path(ROOM_GRAPH, room.id, target_room.id)
+
+    @classmethod
+    def resolve_path(cls, sender_obj, action_args):
+        shortname = action_args.strip()
+        if not shortname:
+            raise UserError('To find your way somewhere, try /path god/foyer')
+        target_room = GameObject.by_shortname(shortname)
+        if target_room is None:
+            raise UserError('Could not find a room with the ID {}'.format(shortname))
+        path = cls.find_path(sender_obj.room, target_room)
+        if path is None:
+            raise UserError('You cannot find a way to {}.'.format(target_room.name))
+        return target_room, path
+
+    @classmethod
+    def handle_path(cls, sender_obj, action_args):
+        if not sender_obj.is_player_obj:
+            return
+        target_room, path = cls.resolve_path(sender_obj, action_args)
+        if not path:
+            msg = 'You are already in {}.'.format(target_room.name)
+        else:
+            msg = 'To get to {}, go {} ({} {}).'.format(
+                target_room.name,
+                ', '.join(direction for direction, _, _ in path),
+                len(path),
+                'move' if len(path) == 1 else 'moves')
+        cls.user_hears(sender_obj, sender_obj, msg)
+
+    @classmethod
+    def handle_travel(cls, sender_obj, action_args):
+        """Goes each step of the way to a room in turn, as though sender_obj
+        had typed every /go. Each step is its own move, so a failed one leaves
+        them where the last one that worked took them. Stops early if a step
+        fails or an exit doesn't take them where the path said it would."""
+        if not sender_obj.is_player_obj:
+            return
+        target_room, path = cls.resolve_path(sender_obj, action_args)
+        for direction, _, room_id in path:
+            try:
+                cls.handle_go(sender_obj, direction)
+            except UserError as e:
+                cls.user_hears(sender_obj, sender_obj, str(e))
+                break
+            except (WitchError, ClientError) as e:
+                # from the exit's script
+                cls.user_hears(sender_obj, sender_obj, 'You could not go {}: {}'.format(
+                    direction, e))
+                break
+            except Exception:
+                logging.getLogger('tmserver').exception(
+                    'travel step {} from {} failed'.format(direction, sender_obj.room))
+                cls.user_hears(sender_obj, sender_obj, 'Something went wrong going {}.'.format(
+                    direction))
+                break
+            if sender_obj.room.id != room_id:
+                break
+
+        if sender_obj.room.id != target_room.id:
+            cls.user_hears(sender_obj, sender_obj, 'You stop short of {}.'.format(target_room.name))
+
     @classmethod
     def process_direction(cls, input_direction):
         """
@@ -756,6 +896,20 @@ class GameWorld:
         adjacent_objs = set(sender_obj.neighbors)
         return {sender_obj} | parent_objs | inventory | adjacent_objs
 
+    @classmethod
+    def interested_objects(cls, sender_obj, action):
+        """The members of area_of_effect(sender_obj) that actually handle
+        action. What's inside the sender and its containers comes from
+        ACTION_INTEREST rather than from asking every object."""
+        parent_objs = list(sender_obj.contained_by)
+        interested = set(ACTION_INTEREST.interested(sender_obj, action))
+        for parent in parent_objs:
+            interested.update(ACTION_INTEREST.interested(parent, action))
+        for o in [sender_obj] + parent_objs:
+            if o.handles(action):
+                interested.add(o)
+        return interested
+
     @classmethod
     def put_into(cls, outer_obj, inner_obj):
         if outer_obj == inner_obj:
@@ -764,20 +918,17 @@ class GameWorld:
         # Right now i'm thinking of just doing a raw Contains call when detecting
         # an exit.
 
-        for old_outer_obj in inner_obj.contained_by:
-            Contains.delete().where(Contains.inner_obj==inner_obj).execute()
-
+        Contains.unlink(inner_obj)
         Contains.create(outer_obj=outer_obj, inner_obj=inner_obj)
+        cls._track(outer_obj, inner_obj)
 
         for old_outer_obj in inner_obj.contained_by:
-            for o in old_outer_obj.contains:
-                if o.is_player_obj:
-                    cls.send_client_update(o.user_account)
-
-        for o in outer_obj.contains:
-            if o.is_player_obj:
+            for o, _ in cls.listeners(old_outer_obj):
                 cls.send_client_update(o.user_account)
 
+        for o, _ in cls.listeners(outer_obj):
+            cls.send_client_update(o.user_account)
+
         outer_obj.handle_action(cls, inner_obj, 'contain',  'acquired')
         inner_obj.handle_action(cls, outer_obj, 'contain',  'entered')
 
@@ -785,15 +936,16 @@ class GameWorld:
     def remove_from(cls, outer_obj, inner_obj):
         """This is only useful for player objects for when they disconnect;
         otherwise all object moving is done via put_into."""
-        Contains.delete().where(
-            Contains.outer_obj==outer_obj,
-            Contains.inner_obj==inner_obj).execute()
+        Contains.unlink(inner_obj, outer_obj)
+        if inner_obj.is_player_obj:
+            get_db().on_rollback(cls._track_in, inner_obj, cls._player_rooms.get(inner_obj.id))
+            cls._untrack(inner_obj)
 
         outer_obj.handle_action(cls, inner_obj, 'contain', 'lost')
         inner_obj.handle_action(cls, outer_obj, 'contain', 'freed')
 
-        for o in outer_obj.contains:
-            if o.is_player_obj and o != inner_obj:
+        for o, _ in cls.listeners(outer_obj):
+            if o != inner_obj:
                 cls.send_client_update(o.user_account)
 
     @classmethod
@@ -862,8 +1014,12 @@ class GameWorld:
             result = cls.object_state(obj)
             result['errors'] = witch_errors
 
+        REVISIONS.publish(rev.script_id, rev.id)
+
         return result
 
     @classmethod
     def handle_map(cls, player_obj):
-        return render_map(cls, player_obj.room, distance=2)
+        """Returns the map around player_obj, or a MapJob if it has to be
+        drawn by boxgraph (see GameServer)."""
+        return plan_map(cls, player_obj.room, distance=2)